@@ -59,11 +59,18 @@ catsoop.setTimeSince = function (name, start, sync){
 }
 
 
-catsoop.load_one_form_element = function(elt, name, into, action){
+catsoop.load_one_form_element = function(elt, name, into, action, files){
     return new Promise(function(resolve, reject){
         if (elt.getAttribute('type') === 'file'){
             if(elt.files.length > 0){
                 var file = elt.files[0];
+                if (typeof files !== 'undefined'){
+                    // the file itself is sent by send_request
+                    into[name] = [file.name, ''];
+                    files[name] = file;
+                    resolve();
+                    return;
+                }
                 var fr = new FileReader();
                 fr.onload = function(e){
                     into[name] = [file.name, e.target.result];
@@ -93,6 +100,7 @@ catsoop.ajaxrequest = function (names, action, done_function){
         }
     }
     var out = {};
+    var files = {};
 
     var promises = [];
     for (var i=0; i<names.length; i++){
@@ -104,13 +112,13 @@ catsoop.ajaxrequest = function (names, action, done_function){
             document.getElementById(name+'_score_display').style.display = 'none';
         }
         if(document.getElementById(name) !== null){
-            promises.push(catsoop.load_one_form_element(field, name, out, action));
+            promises.push(catsoop.load_one_form_element(field, name, out, action, files));
         }
     }
     Promise.all(promises).then(
     function(){
         //success.  all fields loaded, submit the request
-        catsoop.send_request(names, action, out, done_function);
+        catsoop.send_request(names, action, out, done_function, files);
     },
 
     function(){
@@ -206,7 +214,7 @@ catsoop.ajaxErrorCallback = function(name) {
 }
 
 
-catsoop.send_request = function(names,action,send,done_function){
+catsoop.send_request = function(names,action,send,done_function,files){
     var form = {};
     for (var key in send){if (send.hasOwnProperty(key)){form[key] = send[key];}}
     var d = {action: action,
@@ -215,11 +223,23 @@ catsoop.send_request = function(names,action,send,done_function){
              data: JSON.stringify(form)};
     if (catsoop.imp != '') d['as'] = catsoop.imp;
 
-    var encoded_form_pairs = [];
-    for (var name in d){
-        encoded_form_pairs.push(encodeURIComponent(name) + '=' + encodeURIComponent(d[name]));
+    var multipart = (typeof files !== 'undefined' && Object.keys(files).length > 0);
+    if (multipart){
+        // uploaded files are sent as they are, rather than as data URIs
+        var form = new FormData();
+        for (var name in d){
+            form.append(name, d[name]);
+        }
+        for (var name in files){
+            form.append('cs_upload_' + name, files[name], files[name].name);
+        }
+    }else{
+        var encoded_form_pairs = [];
+        for (var name in d){
+            encoded_form_pairs.push(encodeURIComponent(name) + '=' + encodeURIComponent(d[name]));
+        }
+        var form = encoded_form_pairs.join('&').replace(/%20/g, '+');
     }
-    var form = encoded_form_pairs.join('&').replace(/%20/g, '+');
 
     var request = new XMLHttpRequest();
     request.onload = function(){
@@ -235,7 +255,9 @@ catsoop.send_request = function(names,action,send,done_function){
         }
     }
     request.open('POST', catsoop.this_path, true);
-    request.setRequestHeader('Content-Type', 'application/x-www-form-urlencoded');
+    if (!multipart){
+        request.setRequestHeader('Content-Type', 'application/x-www-form-urlencoded');
+    }
     request.send(form);
 };
 
@@ -41,16 +41,9 @@ from bs4 import BeautifulSoup
 _prefix = "cs_defaulthandler_"
 
 
-def new_entry(context, qname, action):
+def job_desc(context, qname, action):
     """
-    Enqueue an asynchronous request to be processed (by the checker), e.g.
-    a problem submission for grading.
-
-    context = dict
-    qname = question name / ID
-    action = "check" or "submit"
-
-    Returns uuid for the new queue entry.
+    Return the description of a checker job for the given question and action
     """
     obj = {
         "path": context["cs_path_info"],
@@ -65,12 +58,63 @@ def new_entry(context, qname, action):
     session = context["cs_session_data"]
     if session.get("is_lti_user"):
         obj["lti_data"] = session.get("lti_data")
+    return obj
+
+
+def new_entry(context, qname, action):
+    """
+    Enqueue an asynchronous request to be processed (by the checker), e.g.
+    a problem submission for grading.
+
+    context = dict
+    qname = question name / ID
+    action = "check" or "submit"
 
+    Returns uuid for the new queue entry (or, if cs_checker_coalesce is set, for
+    the waiting entry this request was merged into).
+    """
     # safely save queue entry in database file (stage then mv)
-    id_ = context['csm_csqueue'].enqueue(context, obj)
+    id_ = context['csm_csqueue'].enqueue(context, job_desc(context, qname, action))
     return id_
 
 
+def grades_inline(context, question, args):
+    """
+    Return True if checks and submissions of the given question should be
+    graded within the request rather than by the checker (see
+    cs_inline_grading).
+    """
+    setting = context.get("cs_inline_grading", True)
+    if isinstance(setting, dict):
+        ok = setting.get(question["qtype"], question.get("inline_safe", False))
+    else:
+        ok = bool(setting) and question.get("inline_safe", False)
+    session = context.get("cs_session_data", {})
+    if session.get("is_lti_user") and context.get("cs_lti_config", {}).get(
+        "push_scores_to_lti_consumer", False
+    ):
+        ok = False  # scores are pushed to the LTI consumer by the checker
+    return _get(args, "csq_inline_grading", ok, bool)
+
+
+def grade_inline(context, qname, action, newstate):
+    """
+    Grade a check or submission of a question within this request, and store
+    the results just as the checker would (under a new uuid, which can be
+    given to get_results), updating newstate in place.
+
+    Returns the results row.
+    """
+    row = job_desc(context, qname, action)
+    row["magic"] = str(uuid.uuid4())
+    row["job_enqueued"] = row["job_started"] = time.time()
+    question, args = context[_n("name_map")][qname]
+    grader = context["csm_grader"]
+    grader.grade_question(context, row, qname, question, args)
+    grader.save_grader_results(None, context, qname, row, problemstate=newstate)
+    return row
+
+
 def _n(n):
     return "%s%s" % (_prefix, n)
 
@@ -920,6 +964,23 @@ def handle_check(context):
 
             newstate["cached_responses"][name] = out["message"]
             newstate["score_displays"][name] = ""
+        elif grades_inline(context, question, args):
+            if name in newstate.get("cached_responses", {}):
+                del newstate["cached_responses"][name]
+            row = grade_inline(context, name, "check", newstate)
+            entry_ids[name] = newstate["checker_ids"][name] = row["magic"]
+
+            rerender = args.get("csq_rerender", question.get("always_rerender", False))
+            if rerender is True:
+                out["rerender"] = question["render_html"](
+                    newstate["last_submit"], **args
+                )
+            elif rerender:
+                out["rerender"] = rerender
+
+            out["score_display"] = row["score_box"]
+            out["message"] = row["response"]
+            out["magic"] = row["magic"]
         else:
             magic = new_entry(context, name, "check")
 
@@ -1040,7 +1101,18 @@ def handle_submit(context):
 
         question, args = namemap[name]
         grading_mode = _get(args, "csq_grading_mode", "auto", str)
-        if grading_mode == "auto":
+        if grading_mode == "auto" and grades_inline(context, question, args):
+            # cheap question types are graded right away, but their results
+            # are stored just as the checker's would be.
+            row = grade_inline(context, name, "submit", newstate)
+            entry_ids[name] = entry_id = row["magic"]
+            out["message"] = row["response"]
+            out["magic"] = entry_id
+            out["score"] = row["score"]
+            out["score_display"] = row["score_box"]
+            newstate["checker_ids"][name] = entry_id
+            newstate["last_submit_id"][name] = entry_id
+        elif grading_mode == "auto":
             # 'auto' grading mode is the default.  sends things to the
             # asynchronous checker to be run.
             magic = new_entry(context, name, "submit")
@@ -1854,6 +1926,13 @@ def make_buttons(context, name):
     return out + aout
 
 
+def _uploaded_file(context, name):
+    # files are sent as parts of a multipart request alongside the "data"
+    # field (by current versions of cs_ajax.js), or as data URIs within it
+    upload = context["cs_form"].get("cs_upload_%s" % name)
+    return upload if hasattr(upload, "read") else None
+
+
 def pre_handle(context):
     # enumerate the questions in this problem
     context[_n("name_map")] = collections.OrderedDict()
@@ -1935,7 +2014,9 @@ def pre_handle(context):
                 if name == "__names__":
                     continue
                 if isinstance(value, list):
-                    data = csm_thirdparty.data_uri.DataURI(value[1]).data
+                    data = _uploaded_file(context, name)
+                    if data is None:
+                        data = csm_thirdparty.data_uri.DataURI(value[1]).data
                     value[0] = (
                         value[0]
                         .replace("<", "")
@@ -1946,7 +2027,18 @@ def pre_handle(context):
                     dirname = context['csm_csqueue'].store_file_upload(context, name, data, value[0])
                     value[1] = dirname
         elif context["cs_upload_management"] == "db":
-            pass
+            for name, value in context[_n("form")].items():
+                upload = _uploaded_file(context, name)
+                if isinstance(value, list) and upload is not None:
+                    try:
+                        value[1] = csm_thirdparty.data_uri.DataURI.make(
+                            upload.content_type, None, True, upload.read()
+                        )
+                    except ValueError:  # not a valid MIME type
+                        upload.seek(0)
+                        value[1] = csm_thirdparty.data_uri.DataURI.make(
+                            "application/octet-stream", None, True, upload.read()
+                        )
         else:
             raise Exception(
                 "unknown upload management style: %r" % context["cs_upload_management"]
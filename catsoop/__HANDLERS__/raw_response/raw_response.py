@@ -14,9 +14,16 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
+
 
 def handle(context):
     content = context["response"]
     typ = context.get("content_type", "text/plain")
-    headers = {"Content-type": typ, "Content-length": str(len(content))}
+    headers = {"Content-type": typ}
+    if hasattr(content, "read"):
+        # an open file, which is sent in blocks
+        headers["Content-length"] = str(os.fstat(content.fileno()).st_size)
+    elif isinstance(content, (str, bytes)):
+        headers["Content-length"] = str(len(content))
     return ("200", "OK"), headers, content
@@ -31,6 +31,7 @@ def escape(s):
 
 
 total_points = smbox["total_points"]
+inline_safe = smbox["inline_safe"]
 answer_display = smbox["answer_display"]
 handle_submission = smbox["handle_submission"]
 
@@ -373,6 +373,9 @@ def _all_mappings_helper(m):
     return out
 
 
+inline_safe = True  # cheap to grade; see cs_inline_grading
+
+
 def total_points(**info):
     return info["csq_npoints"]
 
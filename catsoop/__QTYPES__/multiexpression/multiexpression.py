@@ -23,6 +23,7 @@ defaults["csq_combine_results"] = lambda results: sum(any(i) for i in results) /
 )
 
 total_points = expression["total_points"]
+inline_safe = expression["inline_safe"]
 
 
 def get_parsed_reps(submissions, **info):
@@ -43,6 +43,9 @@ defaults = {
 }
 
 
+inline_safe = True  # cheap to grade; see cs_inline_grading
+
+
 def total_points(**info):
     return info["csq_npoints"]
 
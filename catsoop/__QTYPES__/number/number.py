@@ -16,6 +16,8 @@
 
 tutor.qtype_inherit("expression")
 
+inline_safe = True  # cheap to grade; see cs_inline_grading
+
 defaults["csq_render_result"] = False
 
 
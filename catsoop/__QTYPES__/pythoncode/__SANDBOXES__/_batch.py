@@ -0,0 +1,158 @@
+# This file is part of CAT-SOOP
+# Copyright (c) 2011-2019 by The CAT-SOOP Developers <catsoop-dev@mit.edu>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Harness for running several pythoncode tests in one sandbox (see
+csq_batch_tests), copied into the sandbox as run_catsoop_batch.py.
+
+Reads a JSON list of tests from stdin.  Each test is run in its own forked
+child, with its own rlimits, clock time and stdin, and writes its test module
+and run_catsoop_test.py (as made from _template.py) only once it is running,
+so that it runs exactly as it would have in a sandbox of its own.  Files
+created by a test are removed before the next one starts.  Prints a JSON list
+of {"out": ..., "err": ...} (one per test) to stdout.
+"""
+
+import os
+import sys
+import json
+import time
+import runpy
+import atexit
+import shutil
+import signal
+import resource
+import selectors
+import traceback
+
+
+def _exit_status(exc):
+    if exc.code is None:
+        return 0
+    if isinstance(exc.code, int):
+        return exc.code
+    print(exc.code, file=sys.stderr)
+    return 1
+
+
+def _run_test(test, fds):
+    for target, fd in enumerate(fds):
+        if fd != target:
+            os.dup2(fd, target)
+            os.close(fd)
+    with open("%s.py" % test["module"], "w") as f:
+        f.write(test["code"])
+    with open("run_catsoop_test.py", "w") as f:
+        f.write(test["harness"])
+    for res, limits in test["rlimits"]:
+        resource.setrlimit(res, tuple(limits))
+    test.clear()  # the other tests are not this test's business
+
+    script = os.path.abspath("run_catsoop_test.py")
+    sys.argv = ["run_catsoop_test.py"]
+    status = 0
+    try:
+        runpy.run_path(script, run_name="__main__")
+    except SystemExit as e:
+        status = _exit_status(e)
+    except BaseException:
+        etype, value, tb = sys.exc_info()
+        while tb is not None and tb.tb_frame.f_code.co_filename != script:
+            tb = tb.tb_next
+        traceback.print_exception(etype, value, tb)
+        status = 1
+    try:
+        atexit._run_exitfuncs()
+        sys.stdout.flush()
+        sys.stderr.flush()
+    finally:
+        os._exit(status)
+
+
+def _collect(pid, stdin, data, outputs, timeout):
+    """
+    Feed data to the test's stdin and read its stdout and stderr (the keys of
+    outputs) until they close, killing the test if it runs past timeout.
+    """
+    deadline = time.time() + timeout
+    with selectors.DefaultSelector() as sel:
+        for fd in outputs:
+            sel.register(fd, selectors.EVENT_READ)
+        if data:
+            sel.register(stdin, selectors.EVENT_WRITE)
+        else:
+            os.close(stdin)
+        killed = False
+        while sel.get_map():
+            remaining = deadline - time.time()
+            if remaining <= 0 and not killed:
+                os.kill(pid, signal.SIGKILL)
+                killed = True
+            for key, _ in sel.select(None if killed else remaining):
+                fd = key.fd
+                if fd == stdin:
+                    try:
+                        n = os.write(fd, data[:65536])
+                    except BrokenPipeError:
+                        n = len(data)
+                    data = data[n:]
+                    if not data:
+                        sel.unregister(fd)
+                        os.close(fd)
+                    continue
+                chunk = os.read(fd, 65536)
+                if chunk:
+                    outputs[fd].append(chunk)
+                else:
+                    sel.unregister(fd)
+                    os.close(fd)
+    os.waitpid(pid, 0)
+
+
+def main():
+    tests = json.loads(sys.stdin.read())
+    here = set(os.listdir("."))
+    results = []
+    while tests:
+        test = tests.pop(0)
+        stdin_r, stdin_w = os.pipe()
+        stdout_r, stdout_w = os.pipe()
+        stderr_r, stderr_w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            del tests[:]
+            for fd in (stdin_w, stdout_r, stderr_r):
+                os.close(fd)
+            _run_test(test, [stdin_r, stdout_w, stderr_w])
+        for fd in (stdin_r, stdout_w, stderr_w):
+            os.close(fd)
+        outputs = {stdout_r: [], stderr_r: []}
+        _collect(
+            pid, stdin_w, test["stdin"].encode(), outputs, test["clocktime"]
+        )
+        out, err = (b"".join(i).decode(errors="replace") for i in outputs.values())
+        results.append({"out": out, "err": err})
+        for name in set(os.listdir(".")) - here:
+            try:
+                os.unlink(name)
+            except IsADirectoryError:
+                shutil.rmtree(name, True)
+            except FileNotFoundError:
+                pass
+    print(json.dumps(results))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+# This file is part of CAT-SOOP
+# Copyright (c) 2011-2019 by The CAT-SOOP Developers <catsoop-dev@mit.edu>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Template interpreter for the "python" sandbox's WARM mode.
+
+Run as `python -E -B _forkserver.py SOCKET IDLE [MODULE ...]`.  This imports
+the given modules once, then listens on the unix socket SOCKET.  Each
+connection sends a JSON request (the test's directory, script, rlimits and
+clock time) along with the test's stdin, stdout and stderr pipes; the server
+forks a child which applies the rlimits, moves into the test's directory, and
+runs the script (usually run_catsoop_test.py) there as __main__, exactly as
+`python -E -B run_catsoop_test.py` would.  The pid of the child is sent back
+in reply.
+
+The server exits after IDLE seconds without any requests.
+"""
+
+import os
+import sys
+import json
+import array
+import runpy
+import atexit
+import signal
+import socket
+import resource
+import importlib
+import traceback
+
+
+def _recv_request(conn):
+    fds = array.array("i")
+    msg, ancdata, flags, addr = conn.recvmsg(
+        65536, socket.CMSG_SPACE(3 * fds.itemsize)
+    )
+    for level, typ, data in ancdata:
+        if level == socket.SOL_SOCKET and typ == socket.SCM_RIGHTS:
+            fds.frombytes(data[: len(data) - (len(data) % fds.itemsize)])
+    return json.loads(msg.decode()), list(fds)
+
+
+def _exit_status(exc):
+    if exc.code is None:
+        return 0
+    if isinstance(exc.code, int):
+        return exc.code
+    print(exc.code, file=sys.stderr)
+    return 1
+
+
+def _run_test(request, fds):
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    os.setsid()
+    for target, fd in enumerate(fds):
+        os.dup2(fd, target)
+    for fd in fds:
+        if fd > 2:
+            os.close(fd)
+    os.chdir(request["dir"])
+    for res, limits in request["rlimits"]:
+        resource.setrlimit(res, tuple(limits))
+    if request.get("clocktime"):
+        # backstop in case the process that asked for this test goes away
+        signal.alarm(int(request["clocktime"]) + 5)
+
+    # modules imported in the template share its random state; give each
+    # test a fresh one, as a new interpreter would have
+    if "numpy.random" in sys.modules:
+        sys.modules["numpy.random"].seed()
+
+    script = os.path.join(request["dir"], request.get("script", "run_catsoop_test.py"))
+    sys.argv = [os.path.basename(script)]
+    sys.path[0] = request["dir"]
+    status = 0
+    try:
+        runpy.run_path(script, run_name="__main__")
+    except SystemExit as e:
+        status = _exit_status(e)
+    except BaseException:
+        # report the error as the interpreter would, without the frames from
+        # this file and runpy
+        etype, value, tb = sys.exc_info()
+        while tb is not None and tb.tb_frame.f_code.co_filename != script:
+            tb = tb.tb_next
+        traceback.print_exception(etype, value, tb)
+        status = 1
+    try:
+        atexit._run_exitfuncs()
+        sys.stdout.flush()
+        sys.stderr.flush()
+    finally:
+        os._exit(status)
+
+
+def main(sockpath, idle, preload):
+    for name in preload:
+        importlib.import_module(name)
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)  # children reap themselves
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    tmp = "%s.%d" % (sockpath, os.getpid())
+    listener.bind(tmp)
+    os.chmod(tmp, 0o600)
+    listener.listen(64)
+    os.rename(tmp, sockpath)
+    ours = os.stat(sockpath).st_ino
+    listener.settimeout(idle)
+
+    while True:
+        try:
+            conn, _ = listener.accept()
+        except socket.timeout:
+            break
+        with conn:
+            conn.settimeout(10)
+            try:
+                request, fds = _recv_request(conn)
+            except Exception:
+                continue
+            pid = os.fork()
+            if pid == 0:
+                listener.close()
+                conn.close()
+                _run_test(request, fds)
+            for fd in fds:
+                os.close(fd)
+            try:
+                conn.sendall(b"%d\n" % pid)
+            except OSError:
+                pass
+
+    try:
+        if os.stat(sockpath).st_ino == ours:
+            os.unlink(sockpath)
+    except FileNotFoundError:
+        pass
+
+
+if __name__ == "__main__":
+    main(sys.argv[1], float(sys.argv[2]), sys.argv[3:])
@@ -17,18 +17,18 @@
 import os
 import re
 import ast
+import sys
+import time
+import fcntl
+import shutil
+import hashlib
 import logging
+import tempfile
+import importlib.util
 
 LOGGER = logging.getLogger("cs")
 
 
-def _execfile(*args):
-    fn = args[0]
-    with open(fn) as f:
-        c = compile(f.read(), fn, "exec")
-    exec(c, *args[1:])
-
-
 def prep_code(code, test, **kwargs):
     # code is whatever code we need to test; test is the dictionary describing
     # what test we should be running
@@ -56,6 +56,28 @@ def prep_code(code, test, **kwargs):
     return code
 
 
+def sandbox_backend(context, name, function="run_code"):
+    """
+    Return the given function (by default run_code) of the named sandbox (e.g.
+    "python"), or None if it has no such function.  Sandboxes are loaded once
+    per process, and again only if their file changes.
+    """
+    sandbox_file = os.path.join(
+        context["cs_fs_root"], "__QTYPES__", "pythoncode", "__SANDBOXES__", "%s.py" % name
+    )
+    mtime = os.stat(sandbox_file).st_mtime_ns
+    modname = "catsoop_sandbox_%s" % name
+    module = sys.modules.get(modname)
+    if module is None or module.__file__ != sandbox_file or module._cs_mtime != mtime:
+        LOGGER.info("[pythoncode.sandbox.base] loading sandbox_file=%s" % sandbox_file)
+        spec = importlib.util.spec_from_file_location(modname, sandbox_file)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        module._cs_mtime = mtime
+        sys.modules[modname] = module
+    return getattr(module, function, None)
+
+
 def sandbox_run_code(
     context,
     code,
@@ -64,19 +86,12 @@ def sandbox_run_code(
     opcode_limit=None,
     result_as_string=False,
 ):
-    s = context.get("csq_python_sandbox", "remote")
-    sandbox_file = os.path.join(
-        context["cs_fs_root"], "__QTYPES__", "pythoncode", "__SANDBOXES__", "%s.py" % s
-    )
-
-    LOGGER.info("[pythoncode.sandbox.base] sandbox_file=%s" % sandbox_file)
+    run_code = sandbox_backend(context, context.get("csq_python_sandbox", "remote"))
     opts = dict(DEFAULT_OPTIONS)
     opts.update(context.get("csq_sandbox_options", {}))
     opts.update(options)
-    sandbox = dict(context)
-    _execfile(sandbox_file, sandbox)
     try:
-        return sandbox["run_code"](
+        return run_code(
             context,
             code,
             opts,
@@ -92,6 +107,95 @@ def sandbox_run_code(
         raise
 
 
+def sandbox_workspace_template(context, files):
+    """
+    Return the location of a directory containing the given extra files (as
+    in the FILES sandbox option), which is built the first time it is needed
+    and again whenever one of the files changes.  It is meant to be shared
+    between tests only in ways that the tests cannot write through: mounted
+    read-only (bwrap), or cloned copy-on-write (see sandbox_link_files).
+    """
+    spec = []
+    for f in files:
+        typ = f[0].strip().lower()
+        if typ == "copy":
+            st = os.stat(f[1])
+            spec.append((typ, f[2], os.path.abspath(f[1]), st.st_mtime_ns, st.st_size))
+        elif typ == "string":
+            spec.append((typ, f[1], hashlib.sha1(f[2].encode()).hexdigest()))
+    root = os.path.join(context.get("csq_sandbox_dir", "/tmp/sandbox"), "_workspaces")
+    loc = os.path.join(root, hashlib.sha1(repr(spec).encode()).hexdigest())
+    try:
+        os.utime(loc)  # marks the template as recently used
+        return loc
+    except FileNotFoundError:
+        pass
+
+    # clean up templates which have not been used in a day
+    os.makedirs(root, exist_ok=True)
+    for name in os.listdir(root):
+        old = os.path.join(root, name)
+        try:
+            if time.time() - os.stat(old).st_mtime > 86400:
+                shutil.rmtree(old, True)
+        except FileNotFoundError:
+            pass
+
+    tmp = tempfile.mkdtemp(dir=root, prefix=".")
+    for f in files:
+        typ = f[0].strip().lower()
+        if typ == "copy":
+            dest = os.path.join(tmp, f[2])
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            shutil.copyfile(f[1], dest)
+        elif typ == "string":
+            dest = os.path.join(tmp, f[1])
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            with open(dest, "w") as fileobj:
+                fileobj.write(f[2])
+        else:
+            continue
+        os.chmod(dest, 0o444)
+    try:
+        os.rename(tmp, loc)
+    except OSError:
+        shutil.rmtree(tmp, True)  # another process built it first
+    return loc
+
+
+_FICLONE = 0x40049409  # from linux/fs.h
+
+
+def _clone_file(src, dest):
+    """
+    Copy src to dest as a copy-on-write clone (reflink) where the filesystem
+    supports it, so that no data is copied, and writes to dest never reach
+    src; otherwise, copy it.  The copy is writable.
+    """
+    with open(src, "rb") as fsrc, open(dest, "wb") as fdest:
+        try:
+            fcntl.ioctl(fdest.fileno(), _FICLONE, fsrc.fileno())
+        except OSError:
+            shutil.copyfileobj(fsrc, fdest)
+    os.chmod(dest, 0o644)
+
+
+def sandbox_link_files(context, files, tmpdir):
+    """
+    Put the given extra files (as in the FILES sandbox option) in the test
+    directory tmpdir, by cloning them from their workspace template (see
+    _clone_file).  They are never hardlinked: the test could then change the
+    template's files (and every later test's) by writing to its own.
+    """
+    template = sandbox_workspace_template(context, files)
+    for root, dirs, fs in os.walk(template):
+        dest = os.path.join(tmpdir, os.path.relpath(root, template))
+        for d in dirs:
+            os.makedirs(os.path.join(dest, d), exist_ok=True)
+        for f in fs:
+            _clone_file(os.path.join(root, f), os.path.join(dest, f))
+
+
 def fix_error_msg(fname, err, offset, sub):
     sublen = sub.count("\n")
 
@@ -134,6 +238,16 @@ DEFAULT_OPTIONS = {
     "BADVAR": [],
     "FILES": [],
     "STDIN": "",
+    # "python" sandbox only: fork each test from a long-lived interpreter
+    # which has already imported the modules in PRELOAD, instead of starting
+    # a new interpreter for every test
+    "WARM": False,
+    "PRELOAD": [],
+    # share the FILES between tests from a template (see
+    # sandbox_workspace_template) rather than writing them out for every test:
+    # "bwrap" mounts them read-only (so tests cannot modify them), and
+    # "python" clones them copy-on-write where the filesystem supports it
+    "LINK_FILES": False,
 }
 
 
@@ -176,6 +290,51 @@ def sandbox_run_test(context, code, test):
     return out.strip(), err.strip(), results["info"]
 
 
+def sandbox_run_tests(context, code, tests):
+    """
+    Run all of the given tests on the given code, returning a list of (out,
+    err, log) like those of sandbox_run_test.  If csq_batch_tests is set and
+    the sandbox supports it, tests which share the same extra FILES are run
+    together in one sandbox (see _batch.py); otherwise each test is run in a
+    sandbox of its own.
+    """
+    run_batch = None
+    if context.get("csq_batch_tests", False):
+        run_batch = sandbox_backend(
+            context, context.get("csq_python_sandbox", "remote"), "run_code_batch"
+        )
+    if run_batch is None or len(tests) < 2:
+        return [sandbox_run_test(context, code, test) for test in tests]
+
+    results = [None] * len(tests)
+    batches = {}
+    for ix, test in enumerate(tests):
+        options = dict(DEFAULT_OPTIONS)
+        options.update(context.get("csq_sandbox_options", {}))
+        options.update(test.get("sandbox_options", {}))
+        safe = safety_check(code, options["BADIMPORT"], options["BADVAR"])
+        if isinstance(safe, tuple):
+            results[ix] = ("", ("On line %d: " % safe[0]) + safe[1], "")
+            continue
+        job = {
+            "code": prep_code(code, test, **context),
+            "options": options,
+            "count_opcodes": test["count_opcodes"],
+            "opcode_limit": test["opcode_limit"],
+            "result_as_string": test["result_as_string"],
+        }
+        batches.setdefault(repr(options["FILES"]), []).append((ix, job))
+
+    offset = context["csq_code_pre"].count("\n") + 2
+    for batch in batches.values():
+        for (ix, _), res in zip(batch, run_batch(context, [j for _, j in batch])):
+            err = truncate(res["err"], "ERROR OUTPUT")
+            err = fix_error_msg(res["fname"], err, offset, code)
+            out = truncate(res["out"], "OUTPUT")
+            results[ix] = (out.strip(), err.strip(), res["info"])
+    return results
+
+
 def _ast_downward_search(node, testfunc):
     """
     recursive search through AST.  if a node causes testfunc to return true,
@@ -67,13 +67,17 @@ def run_code(
     os.makedirs(tmpdir, 0o777)
     with open(os.path.join(tmpdir, "run_catsoop_test.py"), "w") as f:
         f.write(template)
-    for f in options["FILES"]:
-        typ = f[0].strip().lower()
-        if typ == "copy":
-            shutil.copyfile(f[1], os.path.join(tmpdir, f[2]))
-        elif typ == "string":
-            with open(os.path.join(tmpdir, f[1]), "w") as fileobj:
-                fileobj.write(f[2])
+    template = None
+    if options["FILES"] and options.get("LINK_FILES", False):
+        template = context["sandbox_workspace_template"](context, options["FILES"])
+    else:
+        for f in options["FILES"]:
+            typ = f[0].strip().lower()
+            if typ == "copy":
+                shutil.copyfile(f[1], os.path.join(tmpdir, f[2]))
+            elif typ == "string":
+                with open(os.path.join(tmpdir, f[1]), "w") as fileobj:
+                    fileobj.write(f[2])
     ofname = fname = "%s.py" % this_one
     with open(os.path.join(tmpdir, fname), "w") as fileobj:
         fileobj.write(code.replace("\r\n", "\n"))
@@ -83,6 +87,10 @@ def run_code(
     )
 
     args = ["bwrap", "--bind", tmpdir, "/run"]
+    if template is not None:
+        # mount the extra files read-only over the test's directory
+        for name in os.listdir(template):
+            args.extend(["--ro-bind", os.path.join(template, name), "/run/" + name])
     supplied_args = context.get("csq_bwrap_arguments", None)
     if supplied_args is None:
         args.extend(
@@ -122,14 +130,6 @@ def run_code(
     out = out.decode()
     err = err.decode()
 
-    files = []
-    for root, _, fs in os.walk(tmpdir):
-        lr = len(root)
-        for f in fs:
-            fname = os.path.join(root, f)
-            with open(fname, "rb") as f:
-                files.append((fname[lr:], f.read()))
-
     shutil.rmtree(tmpdir, True)
 
     n = out.rsplit("---", 1)
@@ -17,14 +17,19 @@
 import os
 import ast
 import sys
+import json
 import time
 import uuid
+import array
 import fcntl
 import shutil
+import signal
+import socket
 import hashlib
 import logging
 import tempfile
 import resource
+import selectors
 import subprocess
 
 LOGGER = logging.getLogger("cs")
@@ -36,14 +41,164 @@ _resource_mapper = {
 }
 
 
-def run_code(
-    context,
-    code,
-    options,
-    count_opcodes=False,
-    opcode_limit=None,
-    result_as_string=False,
-):
+# contents of the files used by this sandbox, with their modification times
+_FILES = {}
+
+
+def _read_file(fname):
+    mtime = os.stat(fname).st_mtime_ns
+    if _FILES.get(fname, (None,))[0] != mtime:
+        with open(fname) as f:
+            _FILES[fname] = (mtime, f.read())
+    return _FILES[fname][1]
+
+
+# seconds a warm template interpreter waits for requests before exiting
+WARM_IDLE = 600
+
+# the warm template interpreters started by this process
+_TEMPLATES = []
+
+
+class WarmProcess:
+    """
+    Stand-in for subprocess.Popen for a test run by a warm template
+    interpreter (see _forkserver.py), which is not a child of this process
+    """
+
+    def __init__(self, pid, stdin, stdout, stderr):
+        self.pid = pid
+        self._input = None
+        self._output = {stdout: [], stderr: []}
+        self._selector = selectors.DefaultSelector()
+        self._stdin = stdin
+        for fd in self._output:
+            self._selector.register(fd, selectors.EVENT_READ)
+
+    def communicate(self, input=None, timeout=None):
+        if self._input is None:
+            self._input = input.encode() if isinstance(input, str) else input or b""
+            if self._input:
+                self._selector.register(self._stdin, selectors.EVENT_WRITE)
+            else:
+                os.close(self._stdin)
+        deadline = None if timeout is None else time.time() + timeout
+        while self._selector.get_map():
+            remaining = None if deadline is None else deadline - time.time()
+            if remaining is not None and remaining <= 0:
+                raise subprocess.TimeoutExpired("sandbox", timeout)
+            for key, _ in self._selector.select(remaining):
+                fd = key.fd
+                if fd == self._stdin:
+                    try:
+                        n = os.write(fd, self._input[:65536])
+                    except BrokenPipeError:
+                        n = len(self._input)
+                    self._input = self._input[n:]
+                    if not self._input:
+                        self._selector.unregister(fd)
+                        os.close(fd)
+                    continue
+                data = os.read(fd, 65536)
+                if data:
+                    self._output[fd].append(data)
+                else:
+                    self._selector.unregister(fd)
+                    os.close(fd)
+        self._selector.close()
+        return tuple(b"".join(i) for i in self._output.values())
+
+    def kill(self):
+        try:
+            os.killpg(self.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    def wait(self):
+        # the template reaps its own children; the test is gone once its
+        # output is closed, which communicate waits for
+        pass
+
+
+def _warm_start(context, interp, tmpdir, script, rlimits, options):
+    """
+    Start the given script in tmpdir from a warm template interpreter (with the
+    modules in options["PRELOAD"] already imported), starting that template
+    first if needed.  Returns a WarmProcess.
+    """
+    server = _sandbox_file(context, "_forkserver.py")
+    source = _read_file(server)
+    preload = sorted(options.get("PRELOAD", []))
+    key = hashlib.sha1(repr((interp, preload, source)).encode()).hexdigest()
+    sockpath = os.path.join(os.path.dirname(tmpdir), "_warm_%s.sock" % key[:16])
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(sockpath)
+    except (FileNotFoundError, ConnectionRefusedError):
+        with open(sockpath + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                sock.connect(sockpath)
+            except (FileNotFoundError, ConnectionRefusedError):
+                if os.path.exists(sockpath):
+                    os.unlink(sockpath)  # left behind by a template that died
+                with open(sockpath + ".log", "ab") as log:
+                    template = subprocess.Popen(
+                        [interp, "-E", "-B", server, sockpath, str(WARM_IDLE)]
+                        + preload,
+                        start_new_session=True,
+                        stdin=subprocess.DEVNULL,
+                        stdout=subprocess.DEVNULL,
+                        stderr=log,
+                    )
+                _TEMPLATES[:] = [i for i in _TEMPLATES if i.poll() is None]
+                _TEMPLATES.append(template)
+                start = time.time()
+                while not os.path.exists(sockpath):
+                    if template.poll() is not None or time.time() - start > 60:
+                        raise Exception(
+                            "warm sandbox template failed to start; see %s.log"
+                            % sockpath
+                        )
+                    time.sleep(0.01)
+                sock.connect(sockpath)
+
+    with sock:
+        sock.settimeout(10)
+        stdin_r, stdin_w = os.pipe()
+        stdout_r, stdout_w = os.pipe()
+        stderr_r, stderr_w = os.pipe()
+        theirs = [stdin_r, stdout_w, stderr_w]
+        request = {
+            "dir": os.path.abspath(tmpdir),
+            "script": script,
+            "rlimits": rlimits,
+            "clocktime": options["CLOCKTIME"],
+        }
+        try:
+            sock.sendmsg(
+                [json.dumps(request).encode()],
+                [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", theirs))],
+            )
+            pid = int(sock.makefile("rb").readline())
+        except:
+            for fd in (stdin_w, stdout_r, stderr_r):
+                os.close(fd)
+            raise
+        finally:
+            for fd in theirs:
+                os.close(fd)
+    return WarmProcess(pid, stdin_w, stdout_r, stderr_r)
+
+
+def _sandbox_file(context, name):
+    return os.path.join(
+        context["cs_fs_root"], "__QTYPES__", "pythoncode", "__SANDBOXES__", name
+    )
+
+
+def _rlimits(options):
     if options.get("do_rlimits", True):
         rlimits = [(resource.RLIMIT_NPROC, (0, 0))]
         for key, val in _resource_mapper.items():
@@ -52,45 +207,45 @@ def run_code(
             rlimits.append((val[0], val[1](options[key])))
     else:
         rlimits = []
+    return rlimits
 
-    def limiter():
-        os.setsid()
-        for i in rlimits:
-            resource.setrlimit(*i)
-        context["csm_process"].set_pdeathsig()()
 
-    tmpdir = context.get("csq_sandbox_dir", "/tmp/sandbox")
-    this_one = "_%s" % uuid.uuid4().hex
-    tmpdir = os.path.join(tmpdir, this_one)
-    with open(
-        os.path.join(
-            context["cs_fs_root"],
-            "__QTYPES__",
-            "pythoncode",
-            "__SANDBOXES__",
-            "_template.py",
-        )
-    ) as f:
-        template = f.read()
-    template %= {
+def _harness(context, test_module, count_opcodes, opcode_limit, result_as_string):
+    template = _read_file(_sandbox_file(context, "_template.py"))
+    return template % {
         "enable_opcode_count": count_opcodes,
         "result_as_string": result_as_string,
-        "test_module": this_one,
+        "test_module": test_module,
         "opcode_limit": opcode_limit or float("inf"),
     }
+
+
+def _make_dir(context, options, name):
+    tmpdir = os.path.join(context.get("csq_sandbox_dir", "/tmp/sandbox"), name)
     os.makedirs(tmpdir, 0o777)
-    with open(os.path.join(tmpdir, "run_catsoop_test.py"), "w") as f:
-        f.write(template)
-    for f in options["FILES"]:
-        typ = f[0].strip().lower()
-        if typ == "copy":
-            shutil.copyfile(f[1], os.path.join(tmpdir, f[2]))
-        elif typ == "string":
-            with open(os.path.join(tmpdir, f[1]), "w") as fileobj:
-                fileobj.write(f[2])
-    fname = "%s.py" % this_one
-    with open(os.path.join(tmpdir, fname), "w") as fileobj:
-        fileobj.write(code.replace("\r\n", "\n"))
+    if options["FILES"] and options.get("LINK_FILES", False):
+        context["sandbox_link_files"](context, options["FILES"], tmpdir)
+    else:
+        for f in options["FILES"]:
+            typ = f[0].strip().lower()
+            if typ == "copy":
+                shutil.copyfile(f[1], os.path.join(tmpdir, f[2]))
+            elif typ == "string":
+                with open(os.path.join(tmpdir, f[1]), "w") as fileobj:
+                    fileobj.write(f[2])
+    return tmpdir
+
+
+def _start(context, tmpdir, script, rlimits, options):
+    """
+    Start running the given script in tmpdir, from a warm template
+    interpreter if options["WARM"] is set, or else in a new interpreter
+    """
+    def limiter():
+        os.setsid()
+        for i in rlimits:
+            resource.setrlimit(*i)
+        context["csm_process"].set_pdeathsig()()
 
     LOGGER.debug(
         "[pythoncode.sandbox.python] context cs_version=%s, cs_python_interpreter=%s"
@@ -101,9 +256,18 @@ def run_code(
         "csq_python_interpreter", context.get("cs_python_interpreter", "python3")
     )
 
+    if options.get("WARM", False):
+        try:
+            return _warm_start(context, interp, tmpdir, script, rlimits, options)
+        except Exception as err:
+            LOGGER.warning(
+                "[pythoncode.sandbox.python] could not use a warm interpreter, starting a new one: %s"
+                % err
+            )
+
     try:
-        p = subprocess.Popen(
-            [interp, "-E", "-B", "run_catsoop_test.py"],
+        return subprocess.Popen(
+            [interp, "-E", "-B", script],
             cwd=tmpdir,
             preexec_fn=limiter,
             bufsize=0,
@@ -113,27 +277,26 @@ def run_code(
         )
     except Exception as err:
         LOGGER.error(
-            "[pythoncode.sandbox.python] error executing subprocess, interp=%s, fname=%s, tmpdir=%s, preexec_fn=%s"
-            % (interp, fname, tmpdir, limiter)
+            "[pythoncode.sandbox.python] error executing subprocess, interp=%s, script=%s, tmpdir=%s, preexec_fn=%s"
+            % (interp, script, tmpdir, limiter)
         )
         raise Exception(
             "[cs.qtypes.pythoncode.python] Failed to execute subprocess interp=%s (need to set csq_python_interpreter?), err=%s"
             % (interp, err)
         )
 
-    out = ""
-    err = ""
+
+def _communicate(p, stdin, timeout):
     try:
-        out, err = p.communicate(options["STDIN"] or "", timeout=options["CLOCKTIME"])
+        out, err = p.communicate(stdin.encode(), timeout=timeout)
     except subprocess.TimeoutExpired:
         p.kill()
         p.wait()
         out, err = p.communicate()
-    out = out.decode()
-    err = err.decode()
+    return out.decode(), err.decode()
 
-    shutil.rmtree(tmpdir, True)
 
+def _parse_output(context, fname, out, err):
     n = out.rsplit("---", 1)
     log = {}
     if len(n) == 2:  # should be this
@@ -158,3 +321,79 @@ def run_code(
         err = "BAD CODE - this will be logged"
 
     return {"fname": fname, "out": out, "err": err, "info": log}
+
+
+def run_code(
+    context,
+    code,
+    options,
+    count_opcodes=False,
+    opcode_limit=None,
+    result_as_string=False,
+):
+    this_one = "_%s" % uuid.uuid4().hex
+    tmpdir = _make_dir(context, options, this_one)
+    with open(os.path.join(tmpdir, "run_catsoop_test.py"), "w") as f:
+        f.write(
+            _harness(context, this_one, count_opcodes, opcode_limit, result_as_string)
+        )
+    fname = "%s.py" % this_one
+    with open(os.path.join(tmpdir, fname), "w") as fileobj:
+        fileobj.write(code.replace("\r\n", "\n"))
+
+    p = _start(context, tmpdir, "run_catsoop_test.py", _rlimits(options), options)
+    out, err = _communicate(p, options["STDIN"] or "", options["CLOCKTIME"])
+
+    shutil.rmtree(tmpdir, True)
+
+    return _parse_output(context, fname, out, err)
+
+
+def run_code_batch(context, jobs):
+    """
+    Run several pieces of code (each a dict with the keys "code", "options",
+    "count_opcodes", "opcode_limit" and "result_as_string", like the
+    arguments to run_code) in one sandbox, using the _batch.py harness.  The
+    FILES, WARM and PRELOAD options are taken from the first job.  Returns a
+    list of results, one per job, like those of run_code.
+    """
+    options = jobs[0]["options"]
+    tmpdir = _make_dir(context, options, "_%s" % uuid.uuid4().hex)
+    with open(os.path.join(tmpdir, "run_catsoop_batch.py"), "w") as f:
+        f.write(_read_file(_sandbox_file(context, "_batch.py")))
+
+    tests = []
+    for job in jobs:
+        module = "_%s" % uuid.uuid4().hex
+        tests.append(
+            {
+                "module": module,
+                "code": job["code"].replace("\r\n", "\n"),
+                "harness": _harness(
+                    context,
+                    module,
+                    job["count_opcodes"],
+                    job["opcode_limit"],
+                    job["result_as_string"],
+                ),
+                "rlimits": _rlimits(job["options"]),
+                "clocktime": job["options"]["CLOCKTIME"],
+                "stdin": job["options"]["STDIN"] or "",
+            }
+        )
+    # each test's own limits are applied by the harness
+    total = sum(i["clocktime"] for i in tests) + 5
+    p = _start(context, tmpdir, "run_catsoop_batch.py", [], dict(options, CLOCKTIME=total))
+    out, err = _communicate(p, json.dumps(tests), total)
+
+    shutil.rmtree(tmpdir, True)
+
+    try:
+        outputs = json.loads(out)
+    except ValueError:
+        LOGGER.error("[pythoncode.sandbox.python] batch harness failed: %s" % err)
+        outputs = [{"out": "", "err": err}] * len(tests)
+    return [
+        _parse_output(context, "%s.py" % test["module"], i["out"], i["err"])
+        for test, i in zip(tests, outputs)
+    ]
@@ -88,6 +88,9 @@ defaults = {
     "csq_test_defaults": {},
     "csq_use_simple_checker": False,
     "csq_result_as_string": False,
+    # run all of the tests in one sandbox (each still in its own process,
+    # with its own limits), rather than starting a sandbox for each test
+    "csq_batch_tests": False,
 }
 
 
@@ -283,12 +286,15 @@ def handle_submission(submissions, **info):
         test["result_as_string"] = test.get(
             "result_as_string", info.get("csq_result_as_string", False)
         )
-        out, err, log = info["sandbox_run_test"](info, code, test)
+    results = info["sandbox_run_tests"](info, code, info["csq_tests"])
+    soln_tests = [i for i in info["csq_tests"] if "cached_result" not in i]
+    soln_results = iter(info["sandbox_run_tests"](info, info["csq_soln"], soln_tests))
+    for test, (out, err, log) in zip(info["csq_tests"], results):
         if "cached_result" in test:
             log_s = repr(test["cached_result"])
             err_s = "Loaded cached result"
         else:
-            out_s, err_s, log_s = info["sandbox_run_test"](info, info["csq_soln"], test)
+            out_s, err_s, log_s = next(soln_results)
         if count != 1:
             msg += "\n<p></p><hr/><p></p>"
         msg += "\n<center><h3>Test %02d</h3>" % count
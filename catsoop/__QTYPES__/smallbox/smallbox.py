@@ -29,6 +29,9 @@ def escape(s):
     return s.replace("&", "&amp;").replace('"', "&quot;")
 
 
+inline_safe = True  # cheap to grade; see cs_inline_grading
+
+
 def total_points(**info):
     return info["csq_npoints"]
 
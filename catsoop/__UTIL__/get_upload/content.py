@@ -43,8 +43,11 @@ if error is None:
             mimetypes.guess_type(csm_cslog.unprep(f.read())["filename"])[0]
             or "text/plain"
         )
-    with open(os.path.join(loc, "content"), "rb") as f:
-        response = csm_cslog.decompress_decrypt(f.read())
+    # sent in blocks (see the raw_response handler), rather than read into
+    # memory in full
+    response = csm_cslog.decompress_decrypt_stream(
+        open(os.path.join(loc, "content"), "rb")
+    )
 
 # except:
 #    error = 'There was an error retrieving the file.'
@@ -0,0 +1,247 @@
+# This file is part of CAT-SOOP
+# Copyright (c) 2011-2019 by The CAT-SOOP Developers <catsoop-dev@mit.edu>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Fingerprinted URLs and precompressed copies of static files.
+
+`dispatch.get_real_url` gives the files in the `__STATIC__` directories of
+handlers, question types, authentication types and plugins URLs containing a
+hash of their contents (so `_handler/default/cs_ajax.js` is served as
+`.../_handler/default/cs_ajax.0123456789ab.js`), which browsers may cache
+indefinitely.  Files from CAT-SOOP's own `__STATIC__` directory are mostly
+third-party libraries which find their other files by name, so they keep their
+names and get the hash as a `v` parameter instead.
+
+Gzipped copies of text files are kept in `cs_data_root/_cached/_static`,
+named by the hash of their contents.  They are made the first time each file
+is served, or ahead of time by `catsoop assets`.
+"""
+
+import os
+import re
+import gzip
+import hashlib
+import threading
+
+from . import base_context
+
+HASH_LENGTH = 12
+"""Number of hex digits of a file's hash to use in its fingerprinted name"""
+
+COMPRESSIBLE = {
+    ".js",
+    ".css",
+    ".html",
+    ".htm",
+    ".svg",
+    ".json",
+    ".map",
+    ".txt",
+    ".xml",
+    ".ttf",
+    ".eot",
+}
+"""Extensions of the files for which gzipped copies are served"""
+
+MIN_COMPRESS_SIZE = 512
+"""Files smaller than this (in bytes) are never compressed"""
+
+HASHED_NAME = re.compile(r"^(.+)\.([0-9a-f]{%d})(\.[^./]+)$" % HASH_LENGTH)
+
+_DIGESTS = {}  # filename -> ((size, mtime, inode), sha256 hexdigest)
+_LOCK = threading.Lock()
+
+
+def _stat_key(fname):
+    st = os.stat(fname)
+    return st.st_size, st.st_mtime_ns, st.st_ino
+
+
+def digest(fname):
+    """
+    Compute the SHA-256 hash of a file's contents, cached until the file
+    changes.
+
+    **Parameters:**
+
+    * `fname`: the location of the file on disk
+
+    **Returns:** the hash, as a string of hex digits
+    """
+    key = _stat_key(fname)
+    cached = _DIGESTS.get(fname)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    h = hashlib.sha256()
+    with open(fname, "rb") as f:
+        for block in iter(lambda: f.read(65536), b""):
+            h.update(block)
+    with _LOCK:
+        _DIGESTS[fname] = key, h.hexdigest()
+    return h.hexdigest()
+
+
+def fingerprint(fname):
+    """
+    **Parameters:**
+
+    * `fname`: the location of the file on disk
+
+    **Returns:** a short hash of the file's contents, as used in its
+    fingerprinted name or `v` parameter
+    """
+    return digest(fname)[:HASH_LENGTH]
+
+
+def hashed_name(fname):
+    """
+    **Parameters:**
+
+    * `fname`: the location of a file on disk
+
+    **Returns:** the fingerprinted version of the file's name (without its
+    directory), e.g. `cs_ajax.0123456789ab.js` for `.../cs_ajax.js`
+    """
+    base, ext = os.path.splitext(os.path.basename(fname))
+    return "%s.%s%s" % (base, fingerprint(fname), ext)
+
+
+def unhashed(fname):
+    """
+    Find the file which a fingerprinted name refers to.
+
+    **Parameters:**
+
+    * `fname`: the location on disk that a request for a static file maps to
+
+    **Returns:** a tuple `(location, fingerprint)`.  If `fname` is a
+    fingerprinted name for a file which exists, these are the location of
+    that file and the fingerprint from the name (which may not be the file's
+    current fingerprint if it has changed since); otherwise, they are `fname`
+    and `None`.
+    """
+    dirname, name = os.path.split(fname)
+    m = HASHED_NAME.match(name)
+    if m is not None:
+        original = os.path.join(dirname, m.group(1) + m.group(3))
+        if os.path.isfile(original):
+            return original, m.group(2)
+    return fname, None
+
+
+def compressed_location(sha):
+    return os.path.join(
+        base_context.cs_data_root, "_cached", "_static", sha[:2], sha + ".gz"
+    )
+
+
+def compressed(fname):
+    """
+    Find (making it if necessary) a gzipped copy of a static file.
+
+    **Parameters:**
+
+    * `fname`: the location of the file on disk
+
+    **Returns:** the location of the gzipped copy, or `None` if the file is not
+    worth compressing
+    """
+    if os.path.splitext(fname)[1].lower() not in COMPRESSIBLE:
+        return None
+    if os.path.getsize(fname) < MIN_COMPRESS_SIZE:
+        return None
+    loc = compressed_location(digest(fname))
+    if os.path.isfile(loc):
+        return loc
+    with open(fname, "rb") as f:
+        data = f.read()
+    # name the copy by what was actually read, in case the file just changed
+    loc = compressed_location(hashlib.sha256(data).hexdigest())
+    os.makedirs(os.path.dirname(loc), exist_ok=True)
+    tmp = "%s.%d.%d" % (loc, os.getpid(), threading.get_ident())
+    with open(tmp, "wb") as f:
+        with gzip.GzipFile(fileobj=f, mode="wb", compresslevel=9, mtime=0) as gz:
+            gz.write(data)
+    os.replace(tmp, loc)
+    return loc
+
+
+def accepts_gzip(environment):
+    """
+    **Parameters:**
+
+    * `environment`: the environment variables associated with a request
+
+    **Returns:** `True` if the client's `Accept-Encoding` header allows a
+    gzipped response, and `False` otherwise
+    """
+    for coding in environment.get("HTTP_ACCEPT_ENCODING", "").split(","):
+        name, _, params = coding.partition(";")
+        if name.strip().lower() not in {"gzip", "x-gzip", "*"}:
+            continue
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                return float(q[2:]) > 0
+            except ValueError:
+                return False
+        return True
+    return False
+
+
+def static_directories():
+    """
+    **Returns:** a list of the `__STATIC__` directories whose files are
+    served at fixed URLs: CAT-SOOP's own, and those of its handlers, question
+    types and authentication types, and of installed plugins
+    """
+    root = base_context.cs_fs_root
+    out = [os.path.join(root, "__STATIC__")]
+    for kind in ("__HANDLERS__", "__QTYPES__", "__AUTH__"):
+        kind_dir = os.path.join(root, kind)
+        for name in sorted(os.listdir(kind_dir)):
+            out.append(os.path.join(kind_dir, name, "__STATIC__"))
+    plugins = os.path.join(base_context.cs_data_root, "plugins")
+    if os.path.isdir(plugins):
+        for name in sorted(os.listdir(plugins)):
+            out.append(os.path.join(plugins, name, "__STATIC__"))
+    return [i for i in out if os.path.isdir(i)]
+
+
+def build(directories=None):
+    """
+    Make the gzipped copies of all the static files in the given directories
+    ahead of time.
+
+    **Optional Parameters:**
+
+    * `directories` (default: the result of `static_directories()`): the
+        directories to search
+
+    **Returns:** a tuple `(files, compressed, original size, compressed size)`
+    """
+    nfiles = ncompressed = before = after = 0
+    for directory in directories or static_directories():
+        for dirpath, dirnames, filenames in os.walk(directory):
+            dirnames.sort()
+            for name in sorted(filenames):
+                fname = os.path.join(dirpath, name)
+                nfiles += 1
+                loc = compressed(fname)
+                if loc is not None:
+                    ncompressed += 1
+                    before += os.path.getsize(fname)
+                    after += os.path.getsize(loc)
+    return nfiles, ncompressed, before, after
@@ -267,6 +267,51 @@ cs_checker_parallel_checks = 1
 Special: The number of checks the checker should run simultaneously.
 """
 
+cs_checker_lease = 60
+"""
+Special: The number of seconds a checker's claim on a running job lasts
+without being renewed.  Checkers renew the leases on their running jobs
+several times per lease period; a job whose lease expires (because its checker
+died or hung) is put back in the queue, to be run by another checker.  This
+allows several checkers, on one or several machines, to share a queue.
+"""
+
+cs_checker_lanes = [("check", None), ("submit", None), ("regrade", 1)]
+"""
+Special: The checker's priority lanes, highest priority first, as a list of
+`(lane_name, max_running)` tuples, where `max_running` is the maximum number of
+jobs from that lane that may run simultaneously (or `None` for no limit).  A
+job's lane is its `"lane"` field if it has one, or else its action (`"check"`
+or `"submit"`).  Jobs in lanes not listed here run after all others.
+"""
+
+cs_checker_fair_share = ["course", "username"]
+"""
+Special: The fields across which the checker shares its time fairly within a
+lane.  With the default, the course whose jobs were started least recently
+goes first, and within a course, the user whose jobs were started least
+recently.  An empty list makes each lane first-in first-out.
+"""
+
+cs_checker_coalesce = True
+"""
+Special: Whether identical requests should share one checker job while it is
+still waiting in the queue.  If `True`, a request with the same user, page,
+question names, form data and action as a queued job is attached to that job
+(and both browsers are shown its result), and a new "check" of a question
+replaces the same user's still-queued "check" of that question.
+"""
+
+cs_inline_grading = True
+"""
+Special: Whether questions whose type declares itself cheap to grade
+(`inline_safe = True` in the question type) are graded within the request
+itself, rather than by the asynchronous checker.  Their results are stored just
+as the checker's would be.  Can also be a dictionary mapping question type names
+to `True` or `False`, to override the question types' own declarations.  A
+single question can override this with its `csq_inline_grading` option.
+"""
+
 # UWSGI Server
 
 cs_wsgi_server = "cheroot"
@@ -279,6 +324,14 @@ cs_wsgi_server_port = 6010
 Special: The local port on which the WSGI server should run.
 """
 
+cs_wsgi_server_workers = 1
+"""
+Special: The number of worker processes to fork for each port when using
+cheroot.  With more than one, the application is loaded (and its main pages
+rendered once) before forking, and the workers share the listening socket.
+Send SIGHUP to a port's `wsgi_server.py` process to reload it gracefully.
+"""
+
 cs_wsgi_server_min_processes = 1
 """
 Special: The minimum number of worker processes the UWSGI server should have
@@ -291,6 +344,48 @@ Special: The maximum number of worker processes the UWSGI server should have
 running
 """
 
+cs_response_compression = True
+"""
+Special: Whether dynamically-generated responses (pages, JSON, etc.) should be
+gzipped for browsers which accept that.  Static files are gzipped regardless
+(see `catsoop.assets`).
+"""
+
+cs_response_compression_level = 6
+"""
+Special: The gzip compression level (1-9) used for dynamically-generated
+responses
+"""
+
+cs_response_compression_min_size = 1024
+"""
+Special: Dynamically-generated responses smaller than this many bytes are not
+compressed
+"""
+
+# request timing (see catsoop.timing)
+
+cs_server_timing = True
+"""
+Special: Whether responses to staff (users with the `view_all` or `admin`
+permission) should include a `Server-Timing` header, showing how long each
+phase of handling the request took (visible in browsers' developer tools).
+"""
+
+cs_slow_request_threshold = 2.0
+"""
+Special: Requests which take at least this many seconds are logged (along with
+the time spent in each phase) to `<cs_data_root>/_logs/_timing`, which `catsoop
+requeststats` summarizes.  Set to `None` to log no slow requests.
+"""
+
+cs_request_timing_sample = 0.01
+"""
+Special: The fraction of all requests (slow or not) which are logged to
+`<cs_data_root>/_logs/_timing`, so that `catsoop requeststats` can show typical
+times as well as slow ones.  Set to 0 to log only slow requests.
+"""
+
 # user interface configuration flags
 
 cs_ui_config_flags = {
@@ -323,6 +418,21 @@ cs_log_encryption = False
 Special: Boolean indicating whether log entries should be encrypted.
 """
 
+# Log Archival
+
+cs_log_retention = {"problemstate": 1}
+"""
+Special: A dictionary mapping log names to the number of most recent entries
+that `catsoop logcompact` and `catsoop logarchive` should keep.  Logs whose
+names are not listed here are kept in full.
+"""
+
+cs_log_archive_mmap = True
+"""
+Special: Boolean indicating whether log archives (created by `catsoop
+logarchive`) should be memory-mapped when they are read.
+"""
+
 # File Upload Type
 
 cs_upload_management = "file"
@@ -331,12 +441,26 @@ Special: defines how CAT-SOOP should handle file uploads.  Must be `'file'` or
 `'db'`.
 
 In `'file'` mode, CAT-SOOP will store the uploaded files on disk, under
-`<cs_data_root>/_logs/_uploads`.
+`<cs_data_root>/_logs/_uploads`.  Files with the same contents are stored only
+once; `catsoop uploadgc` removes those which are no longer used.
 
 In `'db'` mode, CAT-SOOP will store the contents of the files directly in the
 CAT-SOOP logs.
 """
 
+cs_max_request_size = 128 * 1024 * 1024
+"""
+Special: The largest request body (e.g., a form with uploaded files), in bytes,
+that CAT-SOOP will accept.  Larger requests are refused with a 413 error.  Set
+to `None` for no limit.
+"""
+
+cs_max_form_memory_size = 1024 * 1024
+"""
+Special: Uploaded files larger than this many bytes are written to a temporary
+file on disk while a request is being handled, rather than kept in memory.
+"""
+
 cs_python_intepreter = "python3"
 """
 Path to python interpreter used for sandboxed python execution of checking code
@@ -349,6 +473,15 @@ except:
     pass
 cs_lti_debug_level = "WARNING"
 
+cs_lti_outbox_retry = (30, 3600)
+"""
+Special: Scores for LTI tool consumers are sent from an outbox by a separate
+process, so that grading never waits on the consumer.  When sending a score
+fails, it is retried after the first number of seconds given here, doubling
+each time up to the second number, until it succeeds (or a newer score
+replaces it).
+"""
+
 # Debugging Function
 
 import os
@@ -34,6 +34,7 @@ In particular, it provides ways to retrieve the Python objects in a log, or to
 add new Python objects to a log.
 """
 
+import io
 import os
 import ast
 import sys
@@ -44,6 +45,7 @@ import pickle
 import struct
 import hashlib
 import importlib
+import threading
 import contextlib
 from . import debug_log
 
@@ -75,6 +77,7 @@ _nodoc = {
     "RawFernet",
     "compress_encrypt",
     "decompress_decrypt",
+    "decompress_decrypt_stream",
     "default_backend",
     "log_lock",
     "prep",
@@ -139,6 +142,40 @@ def decompress_decrypt(x):
     return x
 
 
+def decompress_decrypt_stream(f, blocksize=65536):
+    """
+    Helper function to read data written by `compress_encrypt` from an open
+    file without decompressing all of it into memory at once.  Returns the file
+    itself if the data is stored as-is, or else an iterator of blocks of bytes
+    (or the bytes themselves if they are encrypted but not compressed, since
+    encrypted data must be read in full so that it can be verified).
+    """
+    if ENCRYPT_KEY is not None:
+        with f:
+            data = FERNET.decrypt(f.read())
+        if not COMPRESS:
+            return data
+        f = io.BytesIO(data)
+    if not COMPRESS:
+        return f
+    return _lzma_blocks(f, blocksize)
+
+
+def _lzma_blocks(f, blocksize):
+    d = lzma.LZMADecompressor()
+    with f:
+        while not d.eof:
+            if d.needs_input:
+                block = f.read(blocksize)
+                if not block:
+                    raise EOFError("compressed data ended unexpectedly")
+            else:
+                block = b""
+            out = d.decompress(block, blocksize)
+            if out:
+                yield out
+
+
 def unprep(x):
     """
     Helper function to deserialize a Python object.
@@ -193,6 +230,169 @@ def get_log_filename(db_name, path, logname):
             base_context.cs_data_root, "_logs", db_name, *path, "%s.log" % logname
         )
 
+#-----------------------------------------------------------------------------
+# read-only log archives (filesystem backend)
+#
+# An archive packs all of the log files of one course into a single file.  Each
+# log is stored as its raw on-disk bytes (so entries stay encrypted/compressed
+# exactly as they were), lzma-compressed as a block.  The file ends with a
+# pickled index mapping the log's path (relative to the course's log
+# directory) to (offset, length), followed by the offset of that index and a
+# magic string.
+
+ARCHIVE_MAGIC = b"CSARCH01"
+
+_ARCHIVES = {}
+
+
+def archive_location(course_dir):
+    """
+    Helper function, returns the location of the archive for the course whose
+    logs are stored (on disk) in the directory named `course_dir`.
+    """
+    return os.path.join(
+        base_context.cs_data_root, "_logs", "_archive", "%s.archive" % course_dir
+    )
+
+
+def split_log_filename(fname):
+    """
+    Helper function, given the name of a log file on disk, return a tuple
+    `(course_dir, key)` identifying the archive it would live in and its name
+    within that archive, or `(None, None)` for logs not associated with a course.
+    """
+    base = os.path.join(base_context.cs_data_root, "_logs", "_courses", "")
+    if not fname.startswith(base):
+        return None, None
+    fields = fname[len(base) :].split(os.sep, 1)
+    if len(fields) != 2:
+        return None, None
+    return fields[0], fields[1]
+
+
+def iter_log_frames(f):
+    """
+    Helper function, yields the raw (still `prep`ped) entries of the log file
+    opened as `f`.
+    """
+    while True:
+        length = f.read(8)
+        if len(length) < 8:
+            return
+        length = struct.unpack("<Q", length)[0]
+        yield f.read(length)
+        f.seek(8, os.SEEK_CUR)
+
+
+def pack_log_frames(frames):
+    """
+    Helper function, the inverse of `iter_log_frames`: returns the bytes of a
+    log file containing the given raw entries.
+    """
+    out = []
+    for frame in frames:
+        length = struct.pack("<Q", len(frame))
+        out.extend((length, frame, length))
+    return b"".join(out)
+
+
+class LogArchive:
+    """
+    Read-only view of a log archive created by `catsoop logarchive`.
+    """
+
+    def __init__(self, fname, use_mmap=None):
+        if use_mmap is None:
+            use_mmap = getattr(base_context, "cs_log_archive_mmap", True)
+        self.fname = fname
+        self._file = open(fname, "rb")
+        if use_mmap:
+            import mmap
+
+            self.data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.data = self._file.read()
+        trailer = self.data[-16:]
+        if trailer[8:] != ARCHIVE_MAGIC:
+            raise ValueError("%s is not a CAT-SOOP log archive" % fname)
+        index_start = struct.unpack("<Q", trailer[:8])[0]
+        self.index = pickle.loads(self.data[index_start:-16])
+
+    def get(self, key):
+        """
+        Return the raw bytes of the log stored under `key`, or `None` if the
+        archive does not contain that log.
+        """
+        try:
+            offset, length = self.index[key]
+        except KeyError:
+            return None
+        return lzma.decompress(self.data[offset : offset + length])
+
+    def close(self):
+        if not isinstance(self.data, bytes):
+            self.data.close()
+        self._file.close()
+
+
+def get_archive(course_dir):
+    """
+    Return the (cached) `LogArchive` for the given course directory, or `None`
+    if that course has not been archived.  The cache is invalidated whenever
+    the archive file is replaced.
+    """
+    fname = archive_location(course_dir)
+    try:
+        st = os.stat(fname)
+    except FileNotFoundError:
+        cached = _ARCHIVES.pop(fname, None)
+        if cached is not None:
+            cached[1].close()
+        return None
+    stamp = (st.st_ino, st.st_mtime)
+    cached = _ARCHIVES.get(fname)
+    if cached is None or cached[0] != stamp:
+        if cached is not None:
+            cached[1].close()
+        _ARCHIVES[fname] = (stamp, LogArchive(fname))
+    return _ARCHIVES[fname][1]
+
+
+def read_archived_log(fname):
+    """
+    Return the raw bytes of the log that would be stored on disk at `fname`,
+    as found in its course's archive, or `None` if it has not been archived.
+    """
+    course_dir, key = split_log_filename(fname)
+    if course_dir is None:
+        return None
+    archive = get_archive(course_dir)
+    if archive is None:
+        return None
+    return archive.get(key)
+
+
+def write_archive(fname, logs):
+    """
+    Write a new log archive to `fname`.  `logs` is an iterable of
+    `(key, compressed_bytes)` tuples, where `compressed_bytes` is the
+    lzma-compressed content of a log file.  The archive is written to a
+    temporary file first and atomically moved into place.
+    """
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    tmpname = "%s.%s.tmp" % (fname, os.getpid())
+    index = {}
+    with open(tmpname, "wb") as f:
+        for key, blob in logs:
+            index[key] = (f.tell(), len(blob))
+            f.write(blob)
+        index_start = f.tell()
+        f.write(pickle.dumps(index, -1))
+        f.write(struct.pack("<Q", index_start))
+        f.write(ARCHIVE_MAGIC)
+    os.replace(tmpname, fname)
+    return index
+
 #-----------------------------------------------------------------------------
 
 def update_log(db_name, path, logname, new, lock=True):
@@ -277,6 +477,13 @@ class CatsoopLogsWithFilesystem:
         os.makedirs(os.path.dirname(fname), exist_ok=True)
         entry = prep(new)
         length = struct.pack("<Q", len(entry))
+        if mode[0] == "a" and not os.path.isfile(fname):
+            # archived logs are read-only; bring this one back to hot storage
+            # before appending to it.
+            archived = read_archived_log(fname)
+            if archived:
+                with open(fname, "wb") as f:
+                    f.write(archived)
         with open(fname, mode) as f:
             f.write(length)
             f.write(entry)
@@ -313,8 +520,12 @@ class CatsoopLogsWithFilesystem:
         os.makedirs(dname, exist_ok=True)
         lockname = os.path.basename(dname)
         with log_lock([lockname, sid]):
-            with open(fn, "wb") as f:
+            # replace the file rather than rewriting it, so that readers never
+            # see part of a write (and session.py can tell that it changed)
+            tmp = fn + ".tmp"
+            with open(tmp, "wb") as f:
                 f.write(prep(data))
+            os.replace(tmp, fn)
 
     @staticmethod
     def clear_old_log_files(dname, expire):
@@ -339,14 +550,16 @@ class CatsoopLogsWithFilesystem:
         cm = log_lock([db_name] + path + [logname]) if lock else passthrough()
         with cm:
             try:
-                with open(fname, "rb") as f:
-                    while True:
-                        try:
-                            length = struct.unpack("<Q", f.read(8))[0]
-                            yield unprep(f.read(length))
-                        except EOFError:
-                            break
-                        f.seek(8, os.SEEK_CUR)
+                try:
+                    f = open(fname, "rb")
+                except FileNotFoundError:
+                    archived = read_archived_log(fname)
+                    if archived is None:
+                        return
+                    f = io.BytesIO(archived)
+                with f:
+                    for frame in iter_log_frames(f):
+                        yield unprep(frame)
                     return
             except:
                 return
@@ -377,12 +590,17 @@ class CatsoopLogsWithFilesystem:
         the log.
         """
         fname = get_log_filename(db_name, path, logname)
-        if not os.path.isfile(fname):
-            return default
         # get an exclusive lock on this file before reading it
         cm = log_lock([db_name] + path + [logname]) if lock else passthrough()
         with cm:
-            with open(fname, "rb") as f:
+            try:
+                f = open(fname, "rb")
+            except FileNotFoundError:
+                archived = read_archived_log(fname)
+                if not archived:
+                    return default
+                f = io.BytesIO(archived)
+            with f:
                 f.seek(-8, os.SEEK_END)
                 length = struct.unpack("<Q", f.read(8))[0]
                 f.seek(-length - 8, os.SEEK_CUR)
@@ -556,14 +774,57 @@ class CatsoopLogsWithFirestore:
 class CatsoopLogsWithMongoDB:
     '''
     Logs based on mongo DB
+
+    Each log entry is its own document, {'fn': ..., 'data': ..., 'seq': ...},
+    where seq is a monotonically increasing sequence number giving the order
+    of the entries (entries written before seq was introduced fall back to
+    _id order).
     '''
     COLLECTION = "LOGS"
+    OLDEST_FIRST = [('seq', 1), ('_id', 1)]
+    LATEST_FIRST = [('seq', -1), ('_id', -1)]
+
+    COUNTERS = "_counters"
 
     def __init__(self, pymongo):
         self.pymongo = pymongo
         self.init_db()
         return
 
+    def collection(self, dname, *indexes):
+        '''
+        Return the collection with the given name, making sure (once per process)
+        that the given indexes exist on it.  Each index is a list of (key, direction)
+        tuples, as expected by pymongo's create_index.
+        '''
+        col = self.db[dname]
+        for index in indexes:
+            key = (dname, tuple(index))
+            if key not in self.indexed:
+                col.create_index(index)
+                self.indexed.add(key)
+        return col
+
+    def log_collection(self, dname):
+        '''
+        Return the collection holding log entries, indexed by (fn, seq)
+        '''
+        return self.collection(dname, [("fn", 1), ("seq", 1)])
+
+    def next_seq(self):
+        '''
+        Return the next value of the monotonically increasing sequence number used
+        to order log entries (mongodb's $natural ordering is not guaranteed, e.g.
+        on sharded clusters)
+        '''
+        doc = self.db[self.COUNTERS].find_one_and_update(
+            {"_id": "logs"},
+            {"$inc": {"seq": 1}},
+            upsert=True,
+            return_document=True,		# ie pymongo.ReturnDocument.AFTER
+        )
+        return doc["seq"]
+
     def fname_to_doc(self, fn):
         '''
         Return collection name and document name, for a given filename-path
@@ -610,10 +871,11 @@ class CatsoopLogsWithMongoDB:
         fn = os.path.join(dname, "none")
         (dname, fnb, col) = self.fname_to_doc(fn)
         now = time.time()
-        ref = self.db[dname].find({"mtime": {"$lt": now - expire}})
+        col = self.collection(dname, [("mtime", 1)])
+        ref = col.find({"mtime": {"$lt": now - expire}}, projection={"_id": 1})
         for doc in ref:
             LOGGER.warning("[catsoop.cslog] deleting %s from %s" % (doc['_id'], dname))
-            self.db[dname].delete_one({"_id": doc['_id']})
+            col.delete_one({"_id": doc['_id']})
 
 
     def _modify_log(self, fname, new, mode):
@@ -631,24 +893,28 @@ class CatsoopLogsWithMongoDB:
         newdoc = {'fn': fnb,
                   'data': new,
                   'time': time.time(),
+                  'seq': self.next_seq(),
         }
 
+        col = self.log_collection(dname)
         if mode[0]=='a':
-            ref = self.db[dname].insert_one(newdoc)	# mongodb: just make new doc
+            ref = col.insert_one(newdoc)	# mongodb: just make new doc
         else:
-            doc = self.db[dname].find_one_and_update({'fn': fnb},
-                                                     {"$set": newdoc},
-                                                     sort = [('$natural', -1)],
-                                                     upsert=True,
+            doc = col.find_one_and_update({'fn': fnb},
+                                          {"$set": newdoc},
+                                          sort=self.LATEST_FIRST,
+                                          projection={'_id': 1},
+                                          upsert=True,
             )
             
     def _read_log(self, db_name, path, logname, lock=True, most_recent=False, include_id=False):
         fname = get_log_filename(db_name, path, logname)
         (dname, fnb, col) = self.fname_to_doc(fname)
 
+        col = self.log_collection(dname)
         if most_recent:
             # return only data from most recent document
-            doc = self.db[dname].find_one({'fn': fnb}, sort=[('$natural', -1)])
+            doc = col.find_one({'fn': fnb}, projection={'data': 1}, sort=self.LATEST_FIRST)
             if doc:
                 docid = doc.get("_id")
                 data = unprep(doc.get('data'))
@@ -661,7 +927,7 @@ class CatsoopLogsWithMongoDB:
 
         # return list of data from all documents
         data = []
-        for doc in self.db[dname].find({'fn': fnb}):
+        for doc in col.find({'fn': fnb}, projection={'data': 1, '_id': 0}, sort=self.OLDEST_FIRST):
             data.append( unprep(doc.get("data")) )
         return data
     
@@ -678,6 +944,7 @@ class CatsoopLogsWithMongoDB:
         mongourl = os.environ.get("MONGODB", None)
         self.client = self.pymongo.MongoClient(mongourl)
         self.db = self.client.catsoop
+        self.indexed = set()		# (collection, index) pairs already ensured by this process
 
     def modify_most_recent(self,
         db_name,
@@ -729,21 +996,64 @@ class CatsoopLogsWithMongoDB:
 procs = ["_modify_log", "_read_log", "most_recent", "modify_most_recent", "init_db",
          "read_log_file", "write_log_file", "clear_old_log_files"]
 
-def initialize():
-    global LOGS
-    USE_CLOUD_DB = os.environ.get("USE_CLOUD_DB")
-    if USE_CLOUD_DB=="mongodb":
-        import pymongo
-        LOGS = CatsoopLogsWithMongoDB(pymongo)
-        
-    elif USE_CLOUD_DB:
-        from google.cloud import firestore
-        LOGS = CatsoopLogsWithFirestore(firestore)
-    
-    else:
-        LOGS = CatsoopLogsWithFilesystem()
-    
+_INIT_LOCK = threading.Lock()
+_INIT_PID = None
+
+
+def initialize(force=False):
+    '''
+    Create the log backend for this process, and bind the module-level
+    functions listed in procs to it.
+
+    The backend (and so its database connection pool) is created once per
+    process, and shared between threads; calling this again is a no-op unless
+    force is set, or unless the process has forked since the backend was
+    created (database clients are not fork-safe, so each child gets its own).
+    Returns the backend.
+    '''
+    global LOGS, _INIT_PID
+    if not force and _INIT_PID == os.getpid():
+        return LOGS
+    with _INIT_LOCK:
+        if force or _INIT_PID != os.getpid():
+            USE_CLOUD_DB = os.environ.get("USE_CLOUD_DB")
+            if USE_CLOUD_DB=="mongodb":
+                import pymongo
+                LOGS = CatsoopLogsWithMongoDB(pymongo)
+
+            elif USE_CLOUD_DB:
+                from google.cloud import firestore
+                LOGS = CatsoopLogsWithFirestore(firestore)
+
+            else:
+                LOGS = CatsoopLogsWithFilesystem()
+
+            for pname in procs:
+                globals()[pname] = getattr(LOGS, pname)
+            _INIT_PID = os.getpid()
+    return LOGS
+
+
+def _call_after_fork(pname):
+    def call(*args, **kwargs):
+        initialize()
+        return globals()[pname](*args, **kwargs)
+    return call
+
+
+def _after_fork_in_child():
+    '''
+    Don't use the parent's backend in a forked child: rebind the module-level
+    functions so that the first call made in the child creates a new backend.
+    Nothing is created here, so children that exec right away (e.g. sandboxes)
+    pay nothing.
+    '''
+    global _INIT_LOCK, _INIT_PID
+    _INIT_LOCK = threading.Lock()
+    _INIT_PID = None
     for pname in procs:
-        exec("%s = LOGS.%s" % (pname, pname), globals(), globals())
+        globals()[pname] = _call_after_fork(pname)
+
 
+os.register_at_fork(after_in_child=_after_fork_in_child)
 initialize()
@@ -3,11 +3,17 @@ Interface to asynchronous grading queue
 '''
 
 import os
+import hmac
+import json
 import time
 import uuid
+import socket
+import bisect
 import shutil
 import hashlib
 import traceback
+import threading
+import collections
 from . import cslog
 from . import debug_log
 from . import base_context
@@ -21,7 +27,304 @@ LOGGER = debug_log.LOGGER
 
 CURRENT = {"queued": [], "running": set()}
 
+
+def worker_id():
+    '''
+    Return the name identifying this checker process among all of the checkers
+    sharing the queue (possibly on several machines)
+    '''
+    return "%s.%d" % (socket.gethostname(), os.getpid())
+
+
+def lease_time(context=None):
+    '''
+    Return the number of seconds after its last heartbeat that a running job's
+    lease expires (see cs_checker_lease)
+    '''
+    return (context or {}).get("cs_checker_lease", base_context.cs_checker_lease)
+
 #-----------------------------------------------------------------------------
+# scheduling policy (see cs_checker_lanes and cs_checker_fair_share)
+
+def job_lane(job_desc):
+    '''
+    Return the name of the priority lane a job belongs to: its "lane" field if
+    set (e.g. "regrade"), or else its action ("check" or "submit")
+    '''
+    return job_desc.get("lane") or job_desc.get("action")
+
+
+def lane_rank(lane, lanes=None):
+    '''
+    Return the priority of the given lane (0 is highest); lanes not listed in
+    cs_checker_lanes come after all listed lanes
+    '''
+    lanes = base_context.cs_checker_lanes if lanes is None else lanes
+    for ix, (name, cap) in enumerate(lanes):
+        if name == lane:
+            return ix
+    return len(lanes)
+
+
+def job_info(magic, enqueued, job_desc):
+    '''
+    Return the information about a waiting job that is used to schedule it
+    '''
+    path = job_desc.get("path") or [None]
+    return {"magic": magic,
+            "time": enqueued,
+            "lane": job_lane(job_desc),
+            "course": path[0],
+            "username": job_desc.get("username"),
+            "digest": job_desc.get("digest"),
+            "slot": job_desc.get("slot"),
+    }
+
+#-----------------------------------------------------------------------------
+# coalescing of duplicate jobs (see cs_checker_coalesce)
+
+def _hash_fields(job_desc, fields):
+    data = json.dumps([job_desc.get(k) for k in fields], sort_keys=True, default=repr)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def add_coalesce_keys(job_desc):
+    '''
+    Add the keys used to coalesce waiting jobs to the given job description:
+    "digest" identifies identical jobs (same user, page, questions, form data,
+    action and lane), and "slot" identifies the jobs that a newer "check" of the
+    same questions by the same user may replace.
+    '''
+    job_desc["digest"] = _hash_fields(job_desc, ("username", "path", "names", "form", "action", "lane"))
+    job_desc["slot"] = _hash_fields(job_desc, ("username", "path", "names", "action", "lane"))
+    return job_desc
+
+
+def should_coalesce(context, job_desc):
+    '''
+    Return True if the given job may be merged into a waiting job
+    '''
+    if not (context or {}).get("cs_checker_coalesce", base_context.cs_checker_coalesce):
+        return False
+    return "names" in job_desc and "username" in job_desc
+
+
+def coalesce_with(job_desc, waiting):
+    '''
+    Decide what to do with a new job given the job_info of the waiting job in
+    the same slot (or None): return "attach" if the waiting job is identical,
+    "replace" if the new job should take its place, or None to enqueue the new
+    job separately.
+    '''
+    if waiting is None:
+        return None
+    if waiting.get("digest") == job_desc["digest"]:
+        return "attach"
+    if job_desc.get("action") == "check":
+        return "replace"
+    return None
+
+
+class Scheduler:
+    '''
+    Decide which waiting job the checker should run next.
+
+    Jobs are first ordered by lane, following cs_checker_lanes; a lane with a
+    concurrency cap is skipped while that many of its jobs are running.  Within
+    a lane, jobs are shared among the values of the cs_checker_fair_share fields
+    (e.g. course, then username): the job whose course (then user) was served
+    least recently goes first, with ties broken by enqueue time.  With no
+    fair-share fields, each lane is first-in first-out.
+    '''
+
+    def __init__(self, lanes=None, fair_share=None):
+        self.lanes = base_context.cs_checker_lanes if lanes is None else lanes
+        if fair_share is None:
+            fair_share = base_context.cs_checker_fair_share
+        self.fair_share = list(fair_share)
+        self.caps = {name: cap for (name, cap) in self.lanes if cap is not None}
+        self.last_served = {}
+        self.nserved = 0
+        self.cached = (None, [])
+
+    def key(self, info):
+        served = tuple(self.last_served.get((f, info.get(f)), -1) for f in self.fair_share)
+        return (lane_rank(info["lane"], self.lanes),) + served + (info["time"],)
+
+    def candidates(self, waiting, running=(), version=None):
+        '''
+        Return the magic numbers of the waiting jobs that may be started now,
+        best first.
+
+        waiting: iterable of job_info dicts, or a function returning one
+        running: iterable of the job descriptions currently running
+        version: if given, a value that changes whenever the set of waiting
+        jobs does (see waiting_version).  While it, the set of full lanes and
+        the jobs served are all unchanged, the previous answer is returned
+        without looking at (or calling) waiting.
+        '''
+        nrunning = collections.Counter(job_lane(row) for row in running)
+        full = frozenset(lane for (lane, cap) in self.caps.items() if nrunning[lane] >= cap)
+        token = (version, full, self.nserved)
+        if version is not None and self.cached[0] == token:
+            return self.cached[1]
+        if callable(waiting):
+            waiting = waiting()
+        ok = [info for info in waiting if info["lane"] not in full]
+        out = [info["magic"] for info in sorted(ok, key=self.key)]
+        self.cached = (token, out)
+        return out
+
+    def served(self, info):
+        '''
+        Record that the given job has been started
+        '''
+        for f in self.fair_share:
+            self.last_served[(f, info.get(f))] = self.nserved
+        self.nserved += 1
+
+
+def get_next_from_queue(context, scheduler, running=()):
+    '''
+    Move the waiting job chosen by the given Scheduler to running, and return
+    its job spec (with job_data["magic"] = job_id), or None if no job may be
+    started now.
+
+    running: iterable of the job descriptions currently running
+    '''
+    version = waiting_version(context)
+    for magic in scheduler.candidates(lambda: list_waiting(context), running, version):
+        row = claim_from_queue(context, magic)
+        if row is not None:
+            scheduler.served(job_info(magic, None, row))
+            return row
+    return None
+
+#-----------------------------------------------------------------------------
+
+class QueueIndex:
+    '''
+    Ordered in-memory index of the entries in a filesystem queue directory.
+
+    Entries are named "<time>_<magic>", and are kept sorted by (time, name) so
+    that the oldest entry, and the position of any given job, can be found
+    without listing and sorting the directory.  Changes made by this process
+    are applied incrementally (add / discard); changes made by other processes
+    are picked up by refresh, which only lists the directory when its mtime has
+    changed, and only inserts / removes the entries that differ.  version is
+    bumped on every change, so that callers can tell when the set of entries is
+    unchanged.
+    '''
+
+    RACY_NS = 10**9  # mtimes this recent may hide changes made in the same tick
+
+    def __init__(self, dirname, load_info=None):
+        '''
+        load_info: if given, a function mapping an entry's name to its job_info
+        (or None if it cannot be read).  The index then also keeps each lane's
+        entries in order, so that positions reflect lane priorities.
+        '''
+        self.dirname = dirname
+        self.load_info = load_info
+        self.entries = []	# sorted list of (time, name)
+        self.by_magic = {}	# magic -> (time, name)
+        self.info = {}		# magic -> job_info (only if load_info is given)
+        self.lanes = {}		# lane -> sorted list of (time, name) (only if load_info is given)
+        self.by_slot = {}	# coalescing slot -> magic (only if load_info is given)
+        self.stamp = None
+        self.version = 0
+
+    @staticmethod
+    def _key(name):
+        t, magic = name.split("_", 1)
+        try:
+            return (float(t), name), magic
+        except ValueError:
+            return (0.0, name), magic
+
+    @staticmethod
+    def _remove(entries, key):
+        ix = bisect.bisect_left(entries, key)
+        if ix < len(entries) and entries[ix] == key:
+            del entries[ix]
+
+    def add(self, name, info=None):
+        key, magic = self._key(name)
+        if magic in self.by_magic:
+            self.discard(self.by_magic[magic][1])
+        bisect.insort(self.entries, key)
+        self.by_magic[magic] = key
+        self.version += 1
+        if self.load_info is not None:
+            info = info or self.load_info(name) or job_info(magic, key[0], {})
+            self.info[magic] = info
+            bisect.insort(self.lanes.setdefault(info["lane"], []), key)
+            if info.get("slot") is not None:
+                self.by_slot[info["slot"]] = magic
+
+    def discard(self, name):
+        key, magic = self._key(name)
+        self._remove(self.entries, key)
+        if self.by_magic.get(magic) == key:
+            del self.by_magic[magic]
+            self.version += 1
+            info = self.info.pop(magic, None)
+            if info is not None:
+                self._remove(self.lanes[info["lane"]], key)
+                if self.by_slot.get(info.get("slot")) == magic:
+                    del self.by_slot[info["slot"]]
+
+    def refresh(self):
+        try:
+            stamp = os.stat(self.dirname).st_mtime_ns
+        except FileNotFoundError:
+            if self.entries:
+                self.version += 1
+            self.entries, self.by_magic, self.stamp = [], {}, None
+            self.info, self.lanes, self.by_slot = {}, {}, {}
+            return
+        if stamp == self.stamp:
+            return
+        names = set(os.listdir(self.dirname))
+        known = {name for (_, name) in self.by_magic.values()}
+        for name in known - names:
+            self.discard(name)
+        for name in names - known:
+            self.add(name)
+        # if the directory was modified very recently, another change may land
+        # without changing its mtime; list it again next time in that case.
+        racy = time.time_ns() - stamp < self.RACY_NS
+        self.stamp = None if racy else stamp
+
+    def oldest(self):
+        '''
+        Return the name of the oldest entry, or None if there are none
+        '''
+        return self.entries[0][1] if self.entries else None
+
+    def position(self, magic):
+        '''
+        Return the (1-based) position of the given job in the queue, or None.
+        If the index knows about lanes, jobs in higher-priority lanes count as
+        being ahead of it (fair-share reordering within a lane is not
+        predicted).
+        '''
+        key = self.by_magic.get(magic)
+        if key is None:
+            return None
+        if self.load_info is None:
+            return bisect.bisect_left(self.entries, key) + 1
+        lane = self.info[magic]["lane"]
+        rank = lane_rank(lane)
+        ahead = sum(len(v) for (l, v) in self.lanes.items() if lane_rank(l) < rank)
+        return ahead + bisect.bisect_left(self.lanes[lane], key) + 1
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return (self._key(name)[1] for (_, name) in self.entries)
+
 
 class CatsoopQueueWithFilesystem:
     def __init__(self):
@@ -33,27 +336,157 @@ class CatsoopQueueWithFilesystem:
         self.running = os.path.join(self.checker_db_loc, "running")
         self.results = os.path.join(self.checker_db_loc, "results")
         self.queued  = os.path.join(self.checker_db_loc, "queued")
+        self.leases = os.path.join(self.checker_db_loc, "leases")
+        self.workers = os.path.join(self.checker_db_loc, "workers")
+        self.uploads = os.path.join(self.cs_data_root, "_logs", "_uploads")
+        self.index = QueueIndex(self.queued, load_info=self._load_info)
+        self.index.refresh()
         return
 
+    def _load_info(self, name):
+        '''
+        Read the scheduling information for the given queue entry
+        '''
+        try:
+            with open(os.path.join(self.queued, name), "rb") as f:
+                job_desc = cslog.unprep(f.read())
+        except Exception:
+            return None
+        key, magic = self.index._key(name)
+        return job_info(magic, key[0], job_desc)
+
     def enqueue(self, context, job_desc):
         '''
         job_desc: dict describing job to be queued
     
         Return UUID for the job
         '''
+        job_desc["job_enqueued"] = time.time()
+        if should_coalesce(context, job_desc):
+            add_coalesce_keys(job_desc)
+            id_ = self._coalesce(context, job_desc)
+            if id_ is not None:
+                return id_
         id_ = str(uuid.uuid4())
         loc = os.path.join(self.staging, id_)
         os.makedirs(os.path.dirname(loc), exist_ok=True)
         with open(loc, "wb") as f:
             f.write(context["csm_cslog"].prep(job_desc))
-        newloc = os.path.join(
-            self.queued,
-            "%s_%s" % (time.time(), id_),	# use time as prefix, for queue entry ordering
-        )
+        qname = "%s_%s" % (job_desc["job_enqueued"], id_)	# use time as prefix, for queue entry ordering
+        newloc = os.path.join(self.queued, qname)
         os.makedirs(os.path.dirname(newloc), exist_ok=True)				# make 'queued' directory if needed 
         LOGGER.info("[catsoop.queue.enqueue] moving %s to %s" % (loc, newloc))
         shutil.move(loc, newloc)
+        self.index.add(qname, job_info(id_, float(qname.split("_", 1)[0]), job_desc))
         return id_
+
+    def _coalesce(self, context, job_desc):
+        '''
+        Attach the given job to an identical waiting job, or let it replace a
+        waiting job in the same slot (keeping that job's place in the queue).
+        Return the magic of the waiting job, or None if the job must be
+        enqueued separately.
+        '''
+        self.index.refresh()
+        magic = self.index.by_slot.get(job_desc["slot"])
+        if magic is None:
+            return None
+        # another process may have replaced the entry since it was indexed, so
+        # read it again
+        what = coalesce_with(job_desc, self._load_info(self.index.by_magic[magic][1]))
+        if what == "attach":
+            LOGGER.info("[catsoop.queue.enqueue] attaching duplicate job to %s" % magic)
+            return magic
+        if what == "replace":
+            # take the entry out of the queue first, so that it cannot be
+            # started while it is being rewritten
+            key = self.index.by_magic[magic]
+            name = key[1]
+            loc = os.path.join(self.staging, name)
+            os.makedirs(self.staging, exist_ok=True)
+            try:
+                os.rename(os.path.join(self.queued, name), loc)
+            except FileNotFoundError:
+                self.index.discard(name)	# already started
+                return None
+            with open(loc, "wb") as f:
+                f.write(context["csm_cslog"].prep(job_desc))
+            os.rename(loc, os.path.join(self.queued, name))
+            self.index.add(name, job_info(magic, key[0], job_desc))
+            LOGGER.info("[catsoop.queue.enqueue] replaced waiting job %s" % magic)
+            return magic
+        return None
+
+    def list_waiting(self, context):
+        '''
+        Return a list of job_info dicts for the jobs waiting in the queue, oldest first
+        '''
+        self.index.refresh()
+        return [self.index.info[magic] for magic in self.index]
+
+    def waiting_version(self, context):
+        '''
+        Return a value that changes whenever the set of waiting jobs does
+        (the queue directory is only listed again if its mtime has changed)
+        '''
+        self.index.refresh()
+        return self.index.version
+
+    def claim_from_queue(self, context, magic):
+        '''
+        Move the given waiting job to running, and return its job spec (or None
+        if it is no longer waiting)
+        '''
+        key = self.index.by_magic.get(magic)
+        if key is None:
+            return None
+        name = key[1]
+        os.makedirs(self.running, exist_ok=True)
+        try:
+            os.rename(os.path.join(self.queued, name), os.path.join(self.running, magic))
+        except FileNotFoundError:
+            self.index.discard(name)	# taken by another process
+            return None
+        self.index.discard(name)
+        self._take_lease(magic)
+        with open(os.path.join(self.running, magic), "rb") as f:
+            row = cslog.unprep(f.read())
+        row["magic"] = magic
+        LOGGER.debug("Moving from queued to  running: %s " % name)
+        return row
+
+    def _take_lease(self, magic):
+        '''
+        Record that this worker holds the lease on the given running job.  The
+        lease file's mtime is the time of the last heartbeat.
+        '''
+        os.makedirs(self.leases, exist_ok=True)
+        loc = os.path.join(self.leases, magic)
+        tmp = "%s.%s.tmp" % (loc, worker_id())  # other workers may race us
+        with open(tmp, "w") as f:
+            f.write(worker_id())
+        os.rename(tmp, loc)
+
+    def renew_leases(self, context, magics):
+        '''
+        Renew this worker's leases on the given running jobs.  Return the list
+        of those jobs whose lease this worker no longer holds (because it
+        expired, and the job was given to another worker).
+        '''
+        me = worker_id()
+        lost = []
+        for magic in magics:
+            loc = os.path.join(self.leases, magic)
+            try:
+                with open(loc) as f:
+                    holder = f.read()
+                if holder != me:
+                    lost.append(magic)
+                    continue
+                os.utime(loc)
+            except FileNotFoundError:
+                lost.append(magic)
+        return lost
         
     def get_oldest_from_queue(self, context, move_to_running=True):
         '''
@@ -61,18 +494,24 @@ class CatsoopQueueWithFilesystem:
     
         return None if quene is empty, else return job spec
         '''
-        waiting = sorted(os.listdir(self.queued))
-        if not waiting:
-            return None
-        first = waiting[0]
-        qfn = os.path.join(self.queued, first)
-        with open(qfn, "rb") as f:
+        self.index.refresh()
+        while True:
+            first = self.index.oldest()
+            if first is None:
+                return None
+            qfn = os.path.join(self.queued, first)
             try:
-                row = cslog.unprep(f.read())
-            except Exception as err:
-                LOGGER.error("[checker] failed to read queue log file %s, error=%s, traceback=%s" % 
-                             (qfn, err, traceback.format_exc()))
-                row = None
+                with open(qfn, "rb") as f:
+                    try:
+                        row = cslog.unprep(f.read())
+                    except Exception as err:
+                        LOGGER.error("[checker] failed to read queue log file %s, error=%s, traceback=%s" % 
+                                     (qfn, err, traceback.format_exc()))
+                        row = None
+            except FileNotFoundError:
+                self.index.discard(first)	# taken by another process since the index was refreshed
+                continue
+            break
     
         if row:
             _, magic = first.split("_")
@@ -83,6 +522,8 @@ class CatsoopQueueWithFilesystem:
     
         if row and move_to_running:
             shutil.move(os.path.join(self.queued, first), os.path.join(self.running, magic))
+            self.index.discard(first)
+            self._take_lease(magic)
             LOGGER.debug("Moving from queued to  running: %s " % first)
     
         return row
@@ -105,13 +546,34 @@ class CatsoopQueueWithFilesystem:
         except:
             row = None
         return row
+
+    def iter_results(self, context, since=None):
+        '''
+        Yield the result rows of all finished jobs (which completed after the
+        given time, if since is given)
+        '''
+        for dirpath, dirnames, filenames in os.walk(self.results):
+            for fname in filenames:
+                loc = os.path.join(dirpath, fname)
+                try:
+                    if since is not None and os.stat(loc).st_mtime < since:
+                        continue
+                    with open(loc, "rb") as fp:
+                        row = cslog.unprep(fp.read())
+                except Exception:
+                    continue
+                row.setdefault("magic", fname)
+                yield row
     
     def save_results(self, context, id_, data, remove_from_running=True):
         '''
         Save results from async job run
         '''
         magic = id_	        # make temporary file to write results to
-        temploc = os.path.join(self.staging, "results.%s" % magic)
+        # (named for this worker: if its lease expired, another worker may be
+        # saving results for the same job)
+        temploc = os.path.join(self.staging, "results.%s.%s" % (magic, worker_id()))
+        os.makedirs(self.staging, exist_ok=True)
         with open(temploc, "wb") as f:
             f.write(cslog.prep(data))
         # move that file to results, close the handle to it.
@@ -120,22 +582,186 @@ class CatsoopQueueWithFilesystem:
         shutil.move(temploc, newloc)
     
         if remove_from_running:
-            os.unlink(os.path.join(self.running, id_))
-            
-    def move_running_back_to_queued(self, context):
+            if not self._holds_lease(magic):
+                # the lease expired, and the job was requeued (and maybe taken
+                # by another worker, whose running entry and lease these now are)
+                LOGGER.warning("[catsoop.queue] saved results for job %s without holding its lease" % magic)
+                return
+            for loc in (os.path.join(self.running, id_), os.path.join(self.leases, id_)):
+                try:
+                    os.unlink(loc)
+                except FileNotFoundError:
+                    pass
+
+    def _holds_lease(self, magic):
         '''
-        Move anything running to back of queue
-        Called at start of grader.watch_queue_and_run process
+        Return True if this worker holds the lease on the given running job
         '''
+        try:
+            with open(os.path.join(self.leases, magic)) as f:
+                return f.read() == worker_id()
+        except FileNotFoundError:
+            return False
+            
+    def move_running_back_to_queued(self, context, expiration=None):
+        '''
+        Move running jobs whose lease has expired (ie whose worker died or
+        hung) to the front of the queue.  Jobs held by live workers, on this
+        machine or others, are left alone.
+        Called by grader.watch_queue_and_run, at startup and periodically.
+        expiration: number of seconds without a heartbeat after which a lease
+        has expired (default: cs_checker_lease)
+        '''
+        if expiration is None:
+            expiration = lease_time(context)
+        if not os.path.isdir(self.running):
+            return
+        now = time.time()
         for f in os.listdir(self.running):
-            shutil.move(os.path.join(self.running, f), os.path.join(self.queued, "0_%s" % f))
+            lease = os.path.join(self.leases, f)
+            try:
+                last = os.stat(lease).st_mtime
+            except FileNotFoundError:
+                # no lease yet (or ever, for jobs started by older checkers);
+                # the rename into running/ set the ctime.
+                try:
+                    last = os.stat(os.path.join(self.running, f)).st_ctime
+                except FileNotFoundError:
+                    continue
+            if now - last < expiration:
+                continue
+            try:
+                os.unlink(lease)
+            except FileNotFoundError:
+                pass
+            try:
+                os.rename(os.path.join(self.running, f), os.path.join(self.queued, "0_%s" % f))
+            except FileNotFoundError:
+                continue	# finished, or recovered by another worker
+            self.index.add("0_%s" % f)
+            LOGGER.warning("[catsoop.queue] lease on job %s expired; moved back to queue" % f)
+
+    def register_worker(self, context, worker, info):
+        '''
+        Record that the given worker is alive, with some information about it
+        (a dict); also used as the worker's heartbeat
+        '''
+        os.makedirs(self.workers, exist_ok=True)
+        loc = os.path.join(self.workers, worker)
+        with open(loc + ".tmp", "wb") as f:
+            f.write(cslog.prep(info))
+        os.rename(loc + ".tmp", loc)
+
+    def unregister_worker(self, context, worker):
+        '''
+        Remove the given worker (which is exiting) from the list of workers
+        '''
+        for loc in (worker, worker + ".drain"):
+            try:
+                os.unlink(os.path.join(self.workers, loc))
+            except FileNotFoundError:
+                pass
+
+    def list_workers(self, context):
+        '''
+        Return a dict mapping the name of each registered worker to its
+        information, plus "seen" (time of the last heartbeat) and "drain"
+        (whether it has been asked to drain)
+        '''
+        out = {}
+        if not os.path.isdir(self.workers):
+            return out
+        names = set(os.listdir(self.workers))
+        for name in names:
+            if name.endswith((".drain", ".tmp")):
+                continue
+            loc = os.path.join(self.workers, name)
+            try:
+                with open(loc, "rb") as f:
+                    info = cslog.unprep(f.read())
+                info["seen"] = os.stat(loc).st_mtime
+            except (FileNotFoundError, EOFError):
+                continue
+            info["drain"] = (name + ".drain") in names
+            out[name] = info
+        return out
+
+    def request_drain(self, context, worker):
+        '''
+        Ask the given worker to stop taking new jobs, and to exit once its
+        running jobs are finished
+        '''
+        os.makedirs(self.workers, exist_ok=True)
+        open(os.path.join(self.workers, worker + ".drain"), "w").close()
+
+    def drain_requested(self, context, worker):
+        '''
+        Return True if the given worker has been asked to drain
+        '''
+        return os.path.exists(os.path.join(self.workers, worker + ".drain"))
     
+    def _upload_blob(self, hstring):
+        '''
+        Return the location of the single stored copy of all uploaded files
+        whose contents have the given SHA-256 hash
+        '''
+        name = hstring
+        if cslog.ENCRYPT_KEY is not None:
+            # don't reveal which files (e.g., in different courses) are the same
+            name = hmac.new(cslog.ENCRYPT_KEY, name.encode(), hashlib.sha256).hexdigest()
+        if cslog.COMPRESS:
+            name += ".xz"
+        return os.path.join(self.uploads, "_blobs", name[:2], name)
+
+    def _link_upload(self, blob, dest, tmp, data):
+        '''
+        Make dest a hard link to blob, first creating blob (by moving the file
+        tmp there, or if tmp is None, by writing data) if this is the first
+        upload with its contents.  On file systems without hard links, dest is
+        a copy of its own.
+        '''
+        try:
+            os.link(blob, dest)
+            if tmp is not None:
+                os.unlink(tmp)
+            return
+        except FileNotFoundError:
+            pass
+        except OSError:  # no hard links here, or too many links to blob
+            blob = None
+        if tmp is None:
+            tmp = dest + ".tmp"
+            with open(tmp, "wb") as f:
+                f.write(cslog.compress_encrypt(data))
+        if blob is not None:
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            # dest is linked before blob appears, so that collect_file_uploads
+            # never sees a new blob without any references
+            try:
+                os.link(tmp, dest)
+                os.replace(tmp, blob)
+                return
+            except OSError:
+                pass
+        os.replace(tmp, dest)
+
     def store_file_upload(self, context, question_name, data, filename):
         '''
-        Upload file content and metadata info
+        Upload file content and metadata info.  data can be a bytestring or
+        a file-like object (which is copied in blocks when the logs are
+        neither compressed nor encrypted).
+
+        Each upload gets a directory of its own, containing its metadata
+        (info) and its contents (content).  Uploads with the same contents
+        share a single stored copy, of which each content file is a hard
+        link, so the link count of the copy is the number of uploads using
+        it (see collect_file_uploads).
         
         Return name of directory where this was stored
         '''
+        logs = context["csm_cslog"]
+        if hasattr(data, "read") and (logs.COMPRESS or logs.ENCRYPT_KEY is not None):
+            data = data.read()
         if context["csm_cslog"].ENCRYPT_KEY is not None:
             seed = (
                 context["cs_path_info"][0]
@@ -148,11 +774,20 @@ class CatsoopQueueWithFilesystem:
             ]
         else:
             _path = context["cs_path_info"]
-        dir_ = os.path.join(
-            self.cs_data_root, "_logs", "_uploads", *_path
-        )
+        dir_ = os.path.join(self.uploads, *_path)
         os.makedirs(dir_, exist_ok=True)
-        hstring = hashlib.sha256(data).hexdigest()
+        tmp = None
+        if hasattr(data, "read"):
+            h = hashlib.sha256()
+            tmp = os.path.join(dir_, "_cstmp.%s" % uuid.uuid4().hex)
+            with open(tmp, "wb") as f:
+                for block in iter(lambda: data.read(65536), b""):
+                    h.update(block)
+                    f.write(block)
+            hstring = h.hexdigest()
+        else:
+            hstring = hashlib.sha256(data).hexdigest()
+        blob = self._upload_blob(hstring)
         info = {
             "filename": filename,
             "username": context["cs_username"],
@@ -161,34 +796,66 @@ class CatsoopQueueWithFilesystem:
             ),
             "question": question_name,
             "hash": hstring,
+            "blob": os.path.basename(blob),
         }
     
         disk_fname = "_csfile.%s%s" % (uuid.uuid4().hex, hstring)
         dirname = os.path.join(dir_, disk_fname)
         os.makedirs(dirname, exist_ok=True)
-        with open(os.path.join(dirname, "content"), "wb") as f:
-            f.write(context["csm_cslog"].compress_encrypt(data))
+        self._link_upload(blob, os.path.join(dirname, "content"), tmp, data)
         with open(os.path.join(dirname, "info"), "wb") as f:
             f.write(context["csm_cslog"].prep(info))
         return dirname
-    
+
+    def collect_file_uploads(self, max_age=86400):
+        '''
+        Remove the stored copies of uploaded files that are no longer used by
+        any upload (i.e., whose upload directories have all been removed), and
+        temporary files left behind by uploads that were interrupted more than
+        max_age seconds ago.
+
+        Return a tuple (number of files removed, number of bytes freed)
+        '''
+        removed = freed = 0
+        cutoff = time.time() - max_age
+        for root, dirs, files in os.walk(self.uploads):
+            in_blobs = os.path.dirname(root) == os.path.join(self.uploads, "_blobs")
+            for name in files:
+                fname = os.path.join(root, name)
+                try:
+                    st = os.stat(fname)
+                    if in_blobs:
+                        stale = st.st_nlink <= 1
+                    else:
+                        stale = (
+                            name.startswith("_cstmp.") or name.endswith(".tmp")
+                        ) and st.st_mtime < cutoff
+                    if stale:
+                        os.unlink(fname)
+                        removed += 1
+                        freed += st.st_size
+                except FileNotFoundError:
+                    pass
+        return removed, freed
 
     def clear_all_queues(self, context):
         '''
         Clear waiting queue and all running (used for unit testing, to start from a standard state)
         '''
-        for qdir in [self.running, self.queued]:
+        for qdir in [self.running, self.queued, self.leases]:
             if not os.path.exists(qdir):
                 continue
             for f in os.listdir(qdir):
                 os.unlink(os.path.join(qdir, f))
+        self.index.refresh()
     
     def update_current_job_status(self):
         '''
         Update local information about status of current jobs.
         Used by reporter.
         '''
-        self.CURRENT["queued"] = [i.split("_")[1] for i in sorted(os.listdir(self.queued))]
+        self.index.refresh()
+        self.CURRENT["queued"] = self.index
         self.CURRENT["running"] = {i.name for i in os.scandir(self.running)}
         crun = self.CURRENT["running"]
         if crun:
@@ -217,10 +884,8 @@ class CatsoopQueueWithFilesystem:
         or as an int, giving the position in the queue.
         Used by reporter.
         '''
-        status = None
-        try:
-            status = self.CURRENT["queued"].index(jobid) + 1
-        except:
+        status = self.index.position(jobid)
+        if status is None:
             if jobid in self.CURRENT["running"]:
                 status = "running"
             elif os.path.isfile(os.path.join(self.results, jobid[0], jobid[1], jobid)):
@@ -247,6 +912,7 @@ class CatsoopQueueWithFirestore:
     '''
     COLLECTION = "QUEUE"
     FILE_COLLECTION = "FILE_UPLOADS"
+    WORKER_COLLECTION = "QUEUE_WORKERS"
 
     def __init__(self, firestore):
         self.firestore = firestore
@@ -259,15 +925,50 @@ class CatsoopQueueWithFirestore:
     
         Return UUID for the job
         '''
+        job_desc["job_enqueued"] = time.time()
+        if should_coalesce(context, job_desc):
+            add_coalesce_keys(job_desc)
+            id_ = self._coalesce(context, job_desc)
+            if id_ is not None:
+                return id_
         id_ = str(uuid.uuid4())
         col = self.COLLECTION + "_waiting"
         ref = self.db.collection(col).document(id_)
         data = {'job': job_desc,
-                'time': time.time(),
+                'time': job_desc["job_enqueued"],
         }
         ref.set(data)
         return id_
         
+    def _coalesce(self, context, job_desc):
+        '''
+        Attach the given job to an identical waiting job, or let it replace a
+        waiting job in the same slot (keeping that job's place in the queue).
+        Return the magic of the waiting job, or None if the job must be
+        enqueued separately.
+        '''
+        wref = self.db.collection(self.COLLECTION + "_waiting")
+        docs = list(wref.where("job.slot", "==", job_desc["slot"]).limit(1).stream())
+        if not docs:
+            return None
+        job_id = docs[0].id
+        what = coalesce_with(job_desc, docs[0].to_dict().get("job", {}))
+        if what == "attach":
+            LOGGER.info("[catsoop.queue.enqueue] attaching duplicate job to %s" % job_id)
+            return job_id
+        if what == "replace":
+            @self.firestore.transactional
+            def update_in_transaction(transaction, dref):	# only replace the job if it is still waiting
+                if not dref.get(transaction=transaction).exists:
+                    return False
+                transaction.update(dref, {"job": job_desc})
+                return True
+
+            if update_in_transaction(self.db.transaction(), wref.document(job_id)):
+                LOGGER.info("[catsoop.queue.enqueue] replaced waiting job %s" % job_id)
+                return job_id
+        return None
+
     def get_oldest_from_queue(self, context, move_to_running=True):
         '''
         Get the top job from the queue
@@ -298,6 +999,7 @@ class CatsoopQueueWithFirestore:
     
                 job_id = next_to_run.id
                 data = next_to_run.to_dict()
+                data.update(self._lease_fields(context))
                 transaction.set(rref.document(job_id), data)		# create running job
                 transaction.delete(wref.document(job_id))		# delete waiting job
                 return job_id, data
@@ -314,6 +1016,84 @@ class CatsoopQueueWithFirestore:
             return row
         return None
     
+    def waiting_version(self, context):
+        '''
+        The set of waiting jobs is not tracked here: return None, so that it is
+        always listed again
+        '''
+        return None
+
+    def list_waiting(self, context):
+        '''
+        Return a list of job_info dicts for the jobs waiting in the queue, oldest first
+        '''
+        wref = self.db.collection(self.COLLECTION + "_waiting")
+        docs = wref.order_by("time").select(["time", "job.lane", "job.action", "job.path", "job.username"]).stream()
+        out = []
+        for doc in docs:
+            data = doc.to_dict()
+            out.append(job_info(doc.id, data["time"], data.get("job", {})))
+        return out
+
+    def claim_from_queue(self, context, magic):
+        '''
+        Move the given waiting job to running, and return its job spec (or None
+        if it is no longer waiting).  Done atomically.
+        '''
+        wref = self.db.collection(self.COLLECTION + "_waiting").document(magic)
+        rref = self.db.collection(self.COLLECTION + "_running").document(magic)
+
+        @self.firestore.transactional
+        def update_in_transaction(transaction, wref, rref):
+            snapshot = wref.get(transaction=transaction)
+            if not snapshot.exists:
+                return None
+            data = snapshot.to_dict()
+            data.update(self._lease_fields(context))
+            transaction.set(rref, data)
+            transaction.delete(wref)
+            return data
+
+        data = update_in_transaction(self.db.transaction(), wref, rref)
+        if data is None:
+            return None
+        LOGGER.debug("[catsoop.queue] Moving from queued to running: %s " % magic)
+        row = data['job']
+        row["magic"] = magic
+        return row
+
+    def _lease_fields(self, context):
+        '''
+        Return the fields recording that this worker holds the lease on a
+        running job, until the returned expiry time
+        '''
+        now = time.time()
+        return {'worker': worker_id(), 'lease': now + lease_time(context), 'start': now}
+
+    def renew_leases(self, context, magics):
+        '''
+        Renew this worker's leases on the given running jobs.  Return the list
+        of those jobs whose lease this worker no longer holds (because it
+        expired, and the job was given to another worker).
+        '''
+        rref = self.db.collection(self.COLLECTION + "_running")
+        me = worker_id()
+        lost = []
+        for magic in magics:
+            dref = rref.document(magic)
+
+            @self.firestore.transactional
+            def update_in_transaction(transaction, dref):
+                snapshot = dref.get(transaction=transaction)
+                if not snapshot.exists or snapshot.to_dict().get("worker") != me:
+                    return False
+                transaction.update(dref, {"lease": time.time() + lease_time(context)})
+                return True
+
+            if not update_in_transaction(self.db.transaction(), dref):
+                lost.append(magic)
+        return lost
+
     def get_results(self, id_):
         '''
         Get results from job execution, if available
@@ -332,7 +1112,22 @@ class CatsoopQueueWithFirestore:
             row = None
         return row
     
-    def save_results(self, context, id_, data):
+    def iter_results(self, context, since=None):
+        '''
+        Yield the result rows of all finished jobs (which completed after the
+        given time, if since is given)
+        '''
+        for doc in self.db.collection(self.COLLECTION + "_results").stream():
+            try:
+                row = cslog.unprep(doc.to_dict().get("data"))
+            except Exception:
+                continue
+            if since is not None and row.get("job_complete", 0) < since:
+                continue
+            row.setdefault("magic", doc.id)
+            yield row
+
+    def save_results(self, context, id_, data, remove_from_running=True):
         '''
         Save results from async job run
         '''
@@ -342,38 +1137,50 @@ class CatsoopQueueWithFirestore:
         doc = {'data': cslog.prep(data)}
         ref.set(doc)
         LOGGER.debug("[catsoop.queue] saved queue results for %s" % id_)
+        if not remove_from_running:
+            return
 
         ref = self.db.collection(rcol).document(id_)
+        snapshot = ref.get()
+        if snapshot.exists and snapshot.to_dict().get("worker") != worker_id():
+            # the lease expired, and the job was taken by another worker
+            LOGGER.warning("[catsoop.queue] saved results for job %s without holding its lease" % id_)
+            return
         ref.delete()
         LOGGER.debug("[catsoop.queue] removed %s from running" % id_)
             
-    def move_running_back_to_queued(self, context, expiration=30):
+    def move_running_back_to_queued(self, context, expiration=None):
         '''
-        Move anything running and "too old", to back of waiting queue
-        Called at start of grader.watch_queue_and_run process
-        expiration: number of seconds after which a job is "too old"
+        Move running jobs whose lease has expired (ie whose worker died or
+        hung) back to the waiting queue.  Jobs held by live workers are left
+        alone.
+        Called by grader.watch_queue_and_run, at startup and periodically.
+        expiration: unused (leases carry their own expiry time)
         '''
-        cutoff = time.time() - expiration
-        rcol = self.COLLECTION + "_running"
-        wcol = self.COLLECTION + "_waiting"
+        now = time.time()
+        rref = self.db.collection(self.COLLECTION + "_running")
+        wref = self.db.collection(self.COLLECTION + "_waiting")
 
-        rref = self.db.collection(rcol)
-        query = rref.where("time", "<", cutoff)
-        for doc in query.stream():
+        for doc in rref.where("lease", "<", now).stream():
             dref = rref.document(doc.id)
 
-            @firestore.transactional
+            @self.firestore.transactional
             def update_in_transaction(transaction, dref, wref):		# atomic move from running to waiting
-                doc = dref.get(transaction=transaction)
-                job_id = doc.id
-                data = doc.to_dict()
-                transaction.set(wref.document(job_jd), data)		# create waiting
-                translaction.delete(dref)				# delete running
-                return job_id, data
-            
-            transaction = self.db.transaction()
-            job_id, data = update_in_transaction(transaction, dref, wref)
-            LOGGER.warning("[catsoop.queue] moved job %s from running to waiting (job creation time=%s)" % (job_id, data.get("time")))
+                snapshot = dref.get(transaction=transaction)
+                if not snapshot.exists:
+                    return None
+                data = snapshot.to_dict()
+                if data.get("lease", 0) >= now:
+                    return None		# renewed in the meantime
+                for k in ("worker", "lease", "start"):
+                    data.pop(k, None)
+                transaction.set(wref.document(snapshot.id), data)		# create waiting
+                transaction.delete(dref)				# delete running
+                return data
+
+            data = update_in_transaction(self.db.transaction(), dref, wref)
+            if data is not None:
+                LOGGER.warning("[catsoop.queue] lease on job %s expired; moved from running to waiting (job creation time=%s)" % (doc.id, data.get("time")))
 
     def clear_all_queues(self, context):
         '''
@@ -386,12 +1193,55 @@ class CatsoopQueueWithFirestore:
                 doc.reference.delete()
                 LOGGER.warning("[catsoop.queue] deleting %s from %s" % (doc.id, col))
 
+    def register_worker(self, context, worker, info):
+        '''
+        Record that the given worker is alive, with some information about it
+        (a dict); also used as the worker's heartbeat
+        '''
+        info = dict(info, seen=time.time())
+        self.db.collection(self.WORKER_COLLECTION).document(worker).set(info, merge=True)
+
+    def unregister_worker(self, context, worker):
+        '''
+        Remove the given worker (which is exiting) from the list of workers
+        '''
+        self.db.collection(self.WORKER_COLLECTION).document(worker).delete()
+
+    def list_workers(self, context):
+        '''
+        Return a dict mapping the name of each registered worker to its
+        information, plus "seen" (time of the last heartbeat) and "drain"
+        (whether it has been asked to drain)
+        '''
+        out = {}
+        for doc in self.db.collection(self.WORKER_COLLECTION).stream():
+            info = doc.to_dict()
+            info.setdefault("drain", False)
+            out[doc.id] = info
+        return out
+
+    def request_drain(self, context, worker):
+        '''
+        Ask the given worker to stop taking new jobs, and to exit once its
+        running jobs are finished
+        '''
+        self.db.collection(self.WORKER_COLLECTION).document(worker).set({"drain": True}, merge=True)
+
+    def drain_requested(self, context, worker):
+        '''
+        Return True if the given worker has been asked to drain
+        '''
+        doc = self.db.collection(self.WORKER_COLLECTION).document(worker).get()
+        return bool(doc.exists and doc.to_dict().get("drain"))
+
     def store_file_upload(self, context, question_name, data, filename):
         '''
         Upload file content and metadata info
         
         Return name of directory where this was stored
         '''
+        if hasattr(data, "read"):
+            data = data.read()
         col = self.FILE_COLLECTION
 
         hstring = hashlib.sha256(data).hexdigest()
@@ -429,6 +1279,13 @@ class CatsoopQueueWithFirestore:
         results = [ x.to_dict() for x in doc ]
         return results
         
+    def collect_file_uploads(self, max_age=86400):
+        '''
+        Uploads are stored as documents of their own, which are not shared, so
+        there is nothing to collect
+        '''
+        return 0, 0
+
     def init_db(self):
         '''
         Initializae database connection
@@ -444,14 +1301,20 @@ class CatsoopQueueWithMongoDB:
     All jobs are stored in a single collection.  The "status" field is either
     "waiting", "running", or "completed".  Each mongodb action is atomic, and
     this atomicity is used to guarantee that only one worker gets each job.
+
+    Jobs are ordered by their enqueue time, using the (status, time) index
+    created by init_db.
     '''
     COLLECTION = "QUEUE"
     FILE_COLLECTION = "FILE_UPLOADS"
+    WORKER_COLLECTION = "QUEUE_WORKERS"
+    OLDEST_FIRST = [('time', 1)]
 
     def __init__(self, pymongo):
         global CURRENT
         self.pymongo = pymongo
         self.CURRENT = CURRENT
+        self.positions = {}
         self.init_db()
         return
 
@@ -461,10 +1324,11 @@ class CatsoopQueueWithMongoDB:
     
         Return UUID for the job
         '''
+        job_desc["job_enqueued"] = time.time()
         id_ = str(uuid.uuid4())
         col = self.db[self.COLLECTION]
         data = {'job': job_desc,
-                'time': time.time(),
+                'time': job_desc["job_enqueued"],
                 'status': 'waiting',
         }
         try:		# mongo cannot serialize set data ; convert set to list, if exists
@@ -476,7 +1340,13 @@ class CatsoopQueueWithMongoDB:
                 rui['p'] = list(rui['p'])
         except Exception as err:
             pass
-            
+
+        if should_coalesce(context, job_desc):
+            add_coalesce_keys(job_desc)
+            magic = self._coalesce(context, job_desc)
+            if magic is not None:
+                return magic
+
         try:
             ref = col.replace_one({"_id": id_}, data, upsert=True)
         except Exception as err:
@@ -485,9 +1355,36 @@ class CatsoopQueueWithMongoDB:
             raise
         return id_
         
+    def _coalesce(self, context, job_desc):
+        '''
+        Attach the given job to an identical waiting job, or let it replace a
+        waiting job in the same slot (keeping that job's place in the queue).
+        Return the magic of the waiting job, or None if the job must be
+        enqueued separately.
+        '''
+        col = self.db[self.COLLECTION]
+        doc = col.find_one({'status': 'waiting', 'job.slot': job_desc['slot']},
+                           projection={'job.digest': 1})
+        if not doc:
+            return None
+        what = coalesce_with(job_desc, doc.get('job', {}))
+        if what == "attach":
+            LOGGER.info("[catsoop.queue.enqueue] attaching duplicate job to %s" % doc['_id'])
+            return doc['_id']
+        if what == "replace":
+            # only replace the job if it has not been started in the meantime
+            ret = col.find_one_and_update({'_id': doc['_id'], 'status': 'waiting'},
+                                          {"$set": {'job': job_desc}},
+                                          projection={'_id': 1},
+            )
+            if ret:
+                LOGGER.info("[catsoop.queue.enqueue] replaced waiting job %s" % doc['_id'])
+                return doc['_id']
+        return None
+
     def get_oldest_from_queue(self, context, move_to_running=True):
         '''
-        Get the oldest job waiting on the queue (ie oldest, based on mongodb natural ordering)
+        Get the oldest job waiting on the queue (ie oldest, based on enqueue time)
         return None if quene is empty, else return job spec, and move job to running.
         Do this atomically.
 
@@ -497,7 +1394,7 @@ class CatsoopQueueWithMongoDB:
         col = self.db[self.COLLECTION]
 
         if not move_to_running:
-            doc = col.find_one({'status': 'waiting'}, sort=[('$natural', 1)])
+            doc = col.find_one({'status': 'waiting'}, sort=self.OLDEST_FIRST)
             if not doc:
                 return None
 
@@ -508,10 +1405,8 @@ class CatsoopQueueWithMongoDB:
                 return None
         else:        
             doc = col.find_one_and_update({'status': 'waiting'},
-                                          {"$set": {'status': 'running',
-                                                    'start': time.time(),
-                                          }},
-                                          sort=[('$natural', 1)],
+                                          {"$set": self._lease_fields(context, start=True)},
+                                          sort=self.OLDEST_FIRST,
             )
             if not doc:
                 return None
@@ -524,6 +1419,65 @@ class CatsoopQueueWithMongoDB:
         LOGGER.debug("[catsoop.queue] get_oldest_from_queue: returning %s" % row)
         return row
     
+    def waiting_version(self, context):
+        '''
+        The set of waiting jobs is not tracked here: return None, so that it is
+        always listed again
+        '''
+        return None
+
+    def list_waiting(self, context):
+        '''
+        Return a list of job_info dicts for the jobs waiting in the queue, oldest first
+        '''
+        col = self.db[self.COLLECTION]
+        docs = col.find({'status': 'waiting'},
+                        projection={'time': 1, 'job.lane': 1, 'job.action': 1, 'job.path': 1, 'job.username': 1},
+                        sort=self.OLDEST_FIRST)
+        return [job_info(doc["_id"], doc["time"], doc.get("job", {})) for doc in docs]
+
+    def claim_from_queue(self, context, magic):
+        '''
+        Move the given waiting job to running, and return its job spec (or None
+        if it is no longer waiting).  Done atomically.
+        '''
+        col = self.db[self.COLLECTION]
+        doc = col.find_one_and_update({'_id': magic, 'status': 'waiting'},
+                                      {"$set": self._lease_fields(context, start=True)},
+                                      projection={'job': 1},
+        )
+        if not doc:
+            return None
+        LOGGER.debug("[catsoop.queue] Moving from queued to running: %s " % magic)
+        row = doc['job']
+        row["magic"] = magic
+        return row
+
+    def _lease_fields(self, context, start=False):
+        '''
+        Return the fields recording that this worker holds the lease on a
+        running job, until the returned expiry time
+        '''
+        now = time.time()
+        out = {'worker': worker_id(), 'lease': now + lease_time(context)}
+        if start:
+            out.update({'status': 'running', 'start': now})
+        return out
+
+    def renew_leases(self, context, magics):
+        '''
+        Renew this worker's leases on the given running jobs.  Return the list
+        of those jobs whose lease this worker no longer holds (because it
+        expired, and the job was given to another worker).
+        '''
+        if not magics:
+            return []
+        col = self.db[self.COLLECTION]
+        mine = {'_id': {'$in': list(magics)}, 'status': 'running', 'worker': worker_id()}
+        col.update_many(mine, {"$set": self._lease_fields(context)})
+        held = {doc['_id'] for doc in col.find(mine, projection={'_id': 1})}
+        return [magic for magic in magics if magic not in held]
+
     def get_results(self, id_):
         '''
         Get results from job execution, if available
@@ -531,7 +1485,7 @@ class CatsoopQueueWithMongoDB:
         '''
         col = self.db[self.COLLECTION]
 
-        doc = col.find_one({'_id': id_, 'status': 'completed'})
+        doc = col.find_one({'_id': id_, 'status': 'completed'}, projection={'results': 1})
         if not doc:
             return None
         data = doc.get("results")
@@ -542,37 +1496,79 @@ class CatsoopQueueWithMongoDB:
             row = None
         return row
     
-    def save_results(self, context, id_, data):
+    def iter_results(self, context, since=None):
+        '''
+        Yield the result rows of all finished jobs (which completed after the
+        given time, if since is given)
+        '''
+        col = self.db[self.COLLECTION]
+        query = {'status': 'completed'}
+        if since is not None:
+            query['end'] = {"$gte": since}
+        for doc in col.find(query, projection={'results': 1}):
+            try:
+                row = cslog.unprep(doc['results'])
+            except Exception:
+                continue
+            row.setdefault("magic", doc['_id'])
+            yield row
+
+    def save_results(self, context, id_, data, remove_from_running=True):
         '''
         Save results from async job run: move status from running to completed
+
+        remove_from_running: False for jobs which were never queued (ie graded
+        inline), which are stored as completed directly
         '''
         col = self.db[self.COLLECTION]
+        if not remove_from_running:
+            now = time.time()
+            col.replace_one({'_id': id_},
+                            {'time': now,
+                             'end': now,
+                             'status': 'completed',
+                             'results': cslog.prep(data)},
+                            upsert=True)
+            return
         doc = col.find_one_and_update({"_id": id_,
-                                       'status': 'running'},
+                                       'status': 'running',
+                                       'worker': worker_id()},
                                       {"$set": {'status': 'completed',
                                                 'end': time.time(),
                                                 'results': cslog.prep(data) },
-                                      }
+                                      },
+                                      projection={'_id': 1},
         )
         if not doc:
-            LOGGER.error("[catsoop.queue.save_results] Tried to save results for %s, but no doc found!" % id_)
+            LOGGER.error("[catsoop.queue.save_results] Tried to save results for %s, but it is not running with this worker's lease!" % id_)
             return None
         
         LOGGER.debug("[catsoop.queue] saved queue results for %s and moved from running to completed" % id_)
             
-    def move_running_back_to_queued(self, context, expiration=30):
-        '''
-        Move anything running and "too old", to back of waiting queue
-        Called at start of grader.watch_queue_and_run process
-        expiration: number of seconds after which a job is "too old"
-        '''
-        cutoff = time.time() - expiration
+    def move_running_back_to_queued(self, context, expiration=None):
+        '''
+        Move running jobs whose lease has expired (ie whose worker died or
+        hung) back to the waiting queue.  Jobs held by live workers are left
+        alone.
+        Called by grader.watch_queue_and_run, at startup and periodically.
+        expiration: number of seconds without a heartbeat after which a lease
+        has expired (default: cs_checker_lease); only used for jobs started by
+        checkers which did not take leases
+        '''
+        if expiration is None:
+            expiration = lease_time(context)
+        now = time.time()
         col = self.db[self.COLLECTION]
+        expired = {'status': 'running',
+                   '$or': [{'lease': {"$lt": now}},
+                           {'lease': {"$exists": False}, 'start': {"$lt": now - expiration}}]}
 
         cnt = 0
         while True:
-            doc = col.find_one_and_update({'status': 'running', 'time': {"$lt": cutoff}},
-                                          {"$set": {'status': 'waiting'}},
+            doc = col.find_one_and_update(expired,
+                                          {"$set": {'status': 'waiting'},
+                                           "$unset": {'worker': "", 'lease': ""}},
+                                          projection={'time': 1},
             )
             if not doc:
                 break
@@ -589,16 +1585,15 @@ class CatsoopQueueWithMongoDB:
         '''
         col = self.db[self.COLLECTION]
 
-        queued = []
+        queued = [info["magic"] for info in sorted(self.list_waiting(None),
+                                                   key=lambda i: (lane_rank(i["lane"]), i["time"]))]
         running = []
-        for doc in col.find({'status': 'waiting'}, sort=[('$natural', 1)]):
-            queued.append(doc.get("_id"))
-
-        for doc in col.find({'status': 'running'}, sort=[('$natural', 1)]):
+        for doc in col.find({'status': 'running'}, projection={'_id': 1}, sort=self.OLDEST_FIRST):
             running.append(doc.get("_id"))
 
         self.CURRENT["queued"] = queued
         self.CURRENT["running"] = running
+        self.positions = {magic: ix + 1 for ix, magic in enumerate(queued)}
 
     def current_queue_length(self):
         '''
@@ -618,7 +1613,7 @@ class CatsoopQueueWithMongoDB:
         Used by reporter.
         '''
         col = self.db[self.COLLECTION]
-        ret = col.find_one({"_id": jobid, 'status': "running"})
+        ret = col.find_one({"_id": jobid, 'status': "running"}, projection={'start': 1})
         if not ret:
             return None
         return ret.get("start")
@@ -629,14 +1624,12 @@ class CatsoopQueueWithMongoDB:
         or as an int, giving the position in the queue.
         Used by reporter.
         '''
-        status = None
         col = self.db[self.COLLECTION]
-        try:
-            status = self.CURRENT["queued"].index(jobid) + 1
-        except:
+        status = self.positions.get(jobid)
+        if status is None:
             if jobid in self.CURRENT["running"]:
                 status = "running"
-            elif col.find_one({"_id": jobid, "status": "completed"}):
+            elif col.find_one({"_id": jobid, "status": "completed"}, projection={'_id': 1}):
                 status = "results"
         return status
 
@@ -649,12 +1642,55 @@ class CatsoopQueueWithMongoDB:
         ret = col.delete_many({})
         LOGGER.error("[catsoop.queue.clear_all_queues] deleted %s queue jobs" % ret.deleted_count)
 
+    def register_worker(self, context, worker, info):
+        '''
+        Record that the given worker is alive, with some information about it
+        (a dict); also used as the worker's heartbeat
+        '''
+        info = dict(info, seen=time.time())
+        self.db[self.WORKER_COLLECTION].update_one({'_id': worker}, {"$set": info}, upsert=True)
+
+    def unregister_worker(self, context, worker):
+        '''
+        Remove the given worker (which is exiting) from the list of workers
+        '''
+        self.db[self.WORKER_COLLECTION].delete_one({'_id': worker})
+
+    def list_workers(self, context):
+        '''
+        Return a dict mapping the name of each registered worker to its
+        information, plus "seen" (time of the last heartbeat) and "drain"
+        (whether it has been asked to drain)
+        '''
+        out = {}
+        for doc in self.db[self.WORKER_COLLECTION].find():
+            name = doc.pop('_id')
+            doc.setdefault('drain', False)
+            out[name] = doc
+        return out
+
+    def request_drain(self, context, worker):
+        '''
+        Ask the given worker to stop taking new jobs, and to exit once its
+        running jobs are finished
+        '''
+        self.db[self.WORKER_COLLECTION].update_one({'_id': worker}, {"$set": {'drain': True}})
+
+    def drain_requested(self, context, worker):
+        '''
+        Return True if the given worker has been asked to drain
+        '''
+        doc = self.db[self.WORKER_COLLECTION].find_one({'_id': worker}, projection={'drain': 1})
+        return bool(doc and doc.get('drain'))
+
     def store_file_upload(self, context, question_name, data, filename):
         '''
         Upload file content and metadata info
         
         Return name of collection where this was stored
         '''
+        if hasattr(data, "read"):
+            data = data.read()
         col = self.db[self.FILE_COLLECTION]
 
         hstring = hashlib.sha256(data).hexdigest()
@@ -690,6 +1726,13 @@ class CatsoopQueueWithMongoDB:
         doc = col.find_one(kwargs)
         return doc
         
+    def collect_file_uploads(self, max_age=86400):
+        '''
+        Uploads are stored as documents of their own, which are not shared, so
+        there is nothing to collect
+        '''
+        return 0, 0
+
     def init_db(self):
         '''
         Initializae database connection
@@ -697,31 +1740,80 @@ class CatsoopQueueWithMongoDB:
         mongourl = os.environ.get("MONGODB", None)
         self.client = self.pymongo.MongoClient(mongourl)
         self.db = self.client.catsoop
+        self.db[self.COLLECTION].create_index([('status', 1), ('time', 1)])
+        self.db[self.COLLECTION].create_index([('status', 1), ('job.slot', 1)])
+        self.db[self.COLLECTION].create_index([('status', 1), ('lease', 1)])
 
 #-----------------------------------------------------------------------------
 
-procs = ['enqueue', 'get_oldest_from_queue', 'get_results', 'save_results',
+procs = ['enqueue', 'get_oldest_from_queue', 'list_waiting', 'waiting_version', 'claim_from_queue',
+         'get_results', 'save_results', 'iter_results',
          'move_running_back_to_queued', 'store_file_upload', 'get_file_upload',
          'get_current_job_status', 'get_running_job_start_time',
          'update_current_job_status', "current_queue_length",
          'clear_all_queues', 'init_db',
+         'renew_leases', 'register_worker', 'unregister_worker', 'list_workers',
+         'request_drain', 'drain_requested', 'collect_file_uploads',
 ]
 
-def initialize():
-    global QUEUE
-    USE_CLOUD_DB = os.environ.get("USE_CLOUD_DB")
-    if USE_CLOUD_DB=="mongodb":
-        import pymongo
-        QUEUE = CatsoopQueueWithMongoDB(pymongo)
-    
-    elif USE_CLOUD_DB:
-        from google.cloud import firestore
-        QUEUE = CatsoopQueueWithFirestore(firestore)
-    
-    else:
-        QUEUE = CatsoopQueueWithFilesystem()
-    
+_INIT_LOCK = threading.Lock()
+_INIT_PID = None
+
+
+def initialize(force=False):
+    '''
+    Create the queue backend for this process, and bind the module-level
+    functions listed in procs to it.
+
+    The backend (and so its database connection pool) is created once per
+    process, and shared between threads; calling this again is a no-op unless
+    force is set, or unless the process has forked since the backend was
+    created (database clients are not fork-safe, so each child gets its own).
+    Returns the backend.
+    '''
+    global QUEUE, _INIT_PID
+    if not force and _INIT_PID == os.getpid():
+        return QUEUE
+    with _INIT_LOCK:
+        if force or _INIT_PID != os.getpid():
+            USE_CLOUD_DB = os.environ.get("USE_CLOUD_DB")
+            if USE_CLOUD_DB=="mongodb":
+                import pymongo
+                QUEUE = CatsoopQueueWithMongoDB(pymongo)
+
+            elif USE_CLOUD_DB:
+                from google.cloud import firestore
+                QUEUE = CatsoopQueueWithFirestore(firestore)
+
+            else:
+                QUEUE = CatsoopQueueWithFilesystem()
+
+            for pname in procs:
+                globals()[pname] = getattr(QUEUE, pname)
+            _INIT_PID = os.getpid()
+    return QUEUE
+
+
+def _call_after_fork(pname):
+    def call(*args, **kwargs):
+        initialize()
+        return globals()[pname](*args, **kwargs)
+    return call
+
+
+def _after_fork_in_child():
+    '''
+    Don't use the parent's backend in a forked child: rebind the module-level
+    functions so that the first call made in the child creates a new backend.
+    Nothing is created here, so children that exec right away (e.g. sandboxes)
+    pay nothing.
+    '''
+    global _INIT_LOCK, _INIT_PID
+    _INIT_LOCK = threading.Lock()
+    _INIT_PID = None
     for pname in procs:
-        exec("%s = QUEUE.%s" % (pname, pname), globals(), globals())
-        
+        globals()[pname] = _call_after_fork(pname)
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
 initialize()
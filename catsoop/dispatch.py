@@ -18,7 +18,6 @@ Methods for handling requests, or for routing them to the proper handlers
 """
 
 import os
-import cgi
 import string
 import hashlib
 import colorsys
@@ -26,23 +25,26 @@ import mimetypes
 import traceback
 import urllib.parse
 
-from email.utils import formatdate
+from datetime import timezone
+from email.utils import formatdate, parsedate_to_datetime
 
 from . import lti
 from . import auth
 from . import time
 from . import tutor
-from . import cslog
 from . import loader
 from . import errors
-from . import csqueue
 from . import session
 from . import language
 from . import debug_log
 from . import base_context
 from . import broadcast
+from . import forms
+from . import assets
+from . import timing
+from . import profiling
 
-_nodoc = {"CSFormatter", "formatdate", "dict_from_cgi_form", "LOGGER", "md5"}
+_nodoc = {"CSFormatter", "formatdate", "LOGGER", "md5"}
 
 LOGGER = debug_log.LOGGER
 
@@ -223,10 +225,75 @@ def content_file_location(context, path):
     return None
 
 
-def serve_static_file(context, fname, environment=None, stream=False, streamchunk=4096):
+def _etag(st):
+    return '"%x-%x-%x"' % (st.st_size, st.st_mtime_ns, st.st_ino)
+
+
+def _etag_matches(header, etag):
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag == "*" or (tag[2:] if tag.startswith("W/") else tag) == etag:
+            return True
+    return False
+
+
+def _not_modified_since(header, mtime):
+    try:
+        since = parsedate_to_datetime(header)
+    except (TypeError, ValueError, IndexError):
+        return False
+    if since is None:
+        return False
+    if since.tzinfo is None:
+        # "-0000" and obsolete formats give naive times, which are in UTC
+        since = since.replace(tzinfo=timezone.utc)
+    return int(mtime) <= since.timestamp()
+
+
+def _byte_range(header, size):
+    """
+    Parse the value of a Range header.  Only a single range of bytes is
+    supported; anything else is ignored (and the whole file is sent).
+
+    **Returns:** `(start, end)` (inclusive) for a range of the file, `None` if
+    the whole file should be sent, or `False` if the range cannot be satisfied
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+    first, dash, last = spec.strip().partition("-")
+    try:
+        if not dash:
+            return None
+        elif not first:
+            start, end = max(size - int(last), 0), size - 1
+            if int(last) == 0:
+                return False
+        else:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+            if end < start:
+                return None if last else False
+    except ValueError:
+        return None
+    if start >= size:
+        return False
+    return start, end
+
+
+def serve_static_file(
+    context,
+    fname,
+    environment=None,
+    stream=False,
+    streamchunk=65536,
+    version=None,
+):
     """
     Generate an HTTP response to serve up a static file, or a 404 error if the
-    file does not exist.  Makes use of the browser's cache when possible.
+    file does not exist.  Makes use of the browser's cache when possible
+    (supporting `If-None-Match` and `If-Modified-Since`), and supports
+    requests for a single range of bytes.
 
     **Parameters**:
 
@@ -239,38 +306,97 @@ def serve_static_file(context, fname, environment=None, stream=False, streamchun
         the request
     * `stream` (default `False`): whether this file should be streamed (instead
         of sent as one bytestring).  Regardless of the value of `stream`, files
-        above 1MB are always streamed.
-    * `streamchunk` (default `4096`): the size, in bytes, of the chunks in the
-        resulting stream
+        above 1MB are always streamed.  A whole file is streamed by returning
+        the open file, which `catsoop.wsgi.application` hands to the server's
+        `wsgi.file_wrapper` (if it has one).
+    * `streamchunk` (default `65536`): the size, in bytes, of the chunks in
+        which a range of a file is streamed
+    * `version` (default `None`): the fingerprint of the file named in the
+        URL of the request, if any (see `catsoop.assets`).  If this matches
+        the file's current fingerprint, the response may be cached
+        indefinitely.
+
+    Text files are sent gzipped (from a copy made by
+    `catsoop.assets.compressed`) to clients which accept that.
     """
     environment = environment or {}
     try:
+        st = os.stat(fname)
         status = ("200", "OK")
         headers = {"Content-type": mimetypes.guess_type(fname)[0] or "text/plain"}
-        mtime = os.stat(fname).st_mtime
-        headers["ETag"] = str(hash(mtime))
-        headers["Cache-Control"] = "no-cache"
-        if (
-            "HTTP_IF_NONE_MATCH" in environment
-            and headers["ETag"] == environment["HTTP_IF_NONE_MATCH"]
-        ):
+        etag = _etag(st)
+        headers["Last-Modified"] = formatdate(st.st_mtime, usegmt=True)
+        if version is not None and version == assets.fingerprint(fname):
+            headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        else:
+            headers["Cache-Control"] = "no-cache"
+        headers["Accept-Ranges"] = "bytes"
+
+        gzipped = None
+        if os.path.splitext(fname)[1].lower() in assets.COMPRESSIBLE:
+            headers["Vary"] = "Accept-Encoding"
+            if "HTTP_RANGE" not in environment and assets.accepts_gzip(environment):
+                try:
+                    gzipped = assets.compressed(fname)
+                except OSError:
+                    LOGGER.error(
+                        "[dispatch.serve_static_file] could not compress %s" % fname
+                    )
+        if gzipped is not None:
+            headers["Content-Encoding"] = "gzip"
+            etag = etag[:-1] + '-gz"'
+        headers["ETag"] = etag
+
+        if "HTTP_IF_NONE_MATCH" in environment:
+            not_modified = _etag_matches(environment["HTTP_IF_NONE_MATCH"], etag)
+        else:
+            not_modified = _not_modified_since(
+                environment.get("HTTP_IF_MODIFIED_SINCE"), st.st_mtime
+            )
+        if not_modified:
+            del headers["Content-type"]
             return ("304", "Not Modified"), headers, ""
-        headers["Content-length"] = os.path.getsize(fname)
-        f = open(fname, "rb")
-        if stream or headers["Content-length"] > 1024 * 1024:
-
-            def streamer():
-                r = f.read(streamchunk)
-                while len(r) > 0:
-                    yield r
-                    r = f.read(streamchunk)
-                f.close()
-
-            out = streamer()
+
+        size = st.st_size
+        byte_range = None
+        if "HTTP_RANGE" in environment and environment.get(
+            "HTTP_IF_RANGE", etag
+        ) in {etag, headers["Last-Modified"]}:
+            byte_range = _byte_range(environment["HTTP_RANGE"], size)
+        if byte_range is False:
+            headers["Content-Range"] = "bytes */%d" % size
+            headers["Content-length"] = "0"
+            return ("416", "Range Not Satisfiable"), headers, ""
+
+        if gzipped is not None:
+            f = open(gzipped, "rb")
+            size = os.fstat(f.fileno()).st_size
         else:
-            out = f.read()
+            f = open(fname, "rb")
+        if byte_range is not None:
+            start, end = byte_range
+            status = ("206", "Partial Content")
+            headers["Content-Range"] = "bytes %d-%d/%d" % (start, end, size)
+            size = end - start + 1
+            f.seek(start)
+        headers["Content-length"] = str(size)
+        if not (stream or size > 1024 * 1024):
+            out = f.read(size)
             f.close()
-        headers["Content-length"] = str(headers["Content-length"])
+        elif byte_range is None:
+            out = f
+        else:
+
+            def streamer(remaining):
+                with f:
+                    while remaining > 0:
+                        r = f.read(min(streamchunk, remaining))
+                        if not r:
+                            break
+                        remaining -= len(r)
+                        yield r
+
+            out = streamer(size)
     except:
         status, headers, out = errors.do_404_message(context)
     return status, headers, out
@@ -367,28 +493,27 @@ def get_real_url(context, url):
     if original.endswith("/"):
         original = original[:-1]
         end = "/"
-    new_url = "/".join(_real_url_helper(context, original)) + end
-    u = ("", "", new_url) + u[3:]
+    parts = _real_url_helper(context, original)
+    query = u[4]
+    # files shipped with CAT-SOOP and its plugins get fingerprinted URLs, so
+    # that browsers can cache them indefinitely (see catsoop.assets)
+    try:
+        if parts[1:3] == ["_static", "_base"] and original.startswith("BASE"):
+            version = assets.fingerprint(static_file_location(context, parts[2:]))
+            query = "&".join(i for i in (query, "v=%s" % version) if i)
+        elif parts[1:2] == ["_static"] and original.startswith(
+            ("_handler/", "_qtype/", "_auth/", "_plugin/")
+        ):
+            path = original.split("/")
+            fname = static_file_location(context, path)
+            parts = parts[:2] + path[:-1] + [assets.hashed_name(fname)]
+    except OSError:
+        pass
+    new_url = "/".join(parts) + end
+    u = ("", "", new_url) + u[3:4] + (query,) + u[5:]
     return urllib.parse.urlunparse(u)
 
 
-def dict_from_cgi_form(cgi_form):
-    """
-    Convert CGI FieldStorage into a dictionary
-    """
-    o = {}
-    for key in cgi_form:
-        res = cgi_form[key]
-        try:
-            if res.file:
-                o[key] = res.file.read()
-            else:
-                o[key] = res.value
-        except:
-            o[key] = res
-    return o
-
-
 def display_page(context):
     """
     Generate the HTTP response for a dynamically-generated page.
@@ -601,12 +726,19 @@ def main(environment, return_context=False, form_data=None):
     **Returns:** a 3-tuple `(response_code, headers, content)` as expected by
     `catsoop.wsgi.application`
     """
-    context = {}
+    context = {"cs_timer": timing.RequestTimer()}
+    path = [i for i in environment.get("PATH_INFO", "/").split("/") if i]
+    with profiling.profiled("request", path):
+        out = _main(context, environment, return_context, form_data)
+    if isinstance(out, tuple):
+        timing.finish(context, out)
+    return out
+
+
+def _main(context, environment, return_context, form_data):
     context["cs_env"] = environment
     context["cs_now"] = time.now()
     force_error = False
-    cslog.initialize()			# initialize here to ensure thread-safe behavior
-    csqueue.initialize()		# (each uWSGI thread makes its own dispatch.main call)
 
     try:
         # DETERMINE WHAT PAGE WE ARE LOADING
@@ -618,9 +750,12 @@ def main(environment, return_context=False, form_data=None):
 
         # RETURN STATIC FILE RESPONSE RIGHT AWAY
         if len(path_info) > 0 and path_info[0] == "_static":
-            return serve_static_file(
-                context, static_file_location(context, path_info[1:]), environment
-            )
+            qstring = urllib.parse.parse_qs(environment.get("QUERY_STRING", ""))
+            fname = static_file_location(context, path_info[1:])
+            version = qstring.get("v", [None])[0]
+            if not os.path.isfile(fname):
+                fname, version = assets.unhashed(fname)
+            return serve_static_file(context, fname, environment, version=version)
 
         # special for broadcast message
         if len(path_info) and path_info[0]=="msg":
@@ -631,17 +766,31 @@ def main(environment, return_context=False, form_data=None):
             return broadcast.return_static(path_info)
 
         # LOAD FORM DATA
-        if "wsgi.input" in environment:
-            # need to read post variables from wsgi.input
-            fields = cgi.FieldStorage(
-                fp=environment["wsgi.input"],
-                environ=environment,
-                keep_blank_values=True,
-            )
-        else:
-            fields = cgi.FieldStorage()
-        form_data = form_data or dict_from_cgi_form(fields)
+        if form_data is None:
+            try:
+                form_data = forms.parse_form(
+                    environment,
+                    base_context.cs_max_request_size,
+                    base_context.cs_max_form_memory_size,
+                )
+            except forms.RequestTooLarge:
+                m = "Request too large (the limit is %d bytes)" % (
+                    base_context.cs_max_request_size
+                )
+                return (
+                    ("413", "Payload Too Large"),
+                    {"Content-type": "text/plain", "Content-length": str(len(m))},
+                    m,
+                )
+            except forms.BadRequest as e:
+                m = "Bad request: %s" % e
+                return (
+                    ("400", "Bad Request"),
+                    {"Content-type": "text/plain", "Content-length": str(len(m))},
+                    m,
+                )
         LOGGER.info("[dispatch] form_data=%s" % str(form_data)[:400])
+        context["cs_timer"].lap("form")
 
         # INITIALIZE CONTEXT
         context["cs_additional_headers"] = {}
@@ -652,6 +801,7 @@ def main(environment, return_context=False, form_data=None):
 
         # LOAD GLOBAL DATA
         e = loader.load_global_data(context)
+        context["cs_timer"].lap("config")
         if len(path_info) > 0:
             context["cs_short_name"] = path_info[-1]
             context["cs_course"] = path_info[0]
@@ -726,6 +876,7 @@ def main(environment, return_context=False, form_data=None):
             "[dispatch.main] (%s) session_id=%s"
             % (session_data.get("ip_addr"), context["cs_sid"])
         )
+        context["cs_timer"].lap("session")
         LOGGER.info("[dispatch.main] path_info=%s" % path_info)
 
         # Handle LTI (must be done prior to authentication & other processing)
@@ -744,6 +895,7 @@ def main(environment, return_context=False, form_data=None):
             x = loader.do_preload(
                 context, context["cs_course"], path_info, context, cfile
             )
+            context["cs_timer"].lap("preload")
             if x == "missing":
                 LOGGER.info("[dispatch.main] preload returned missing")
                 return errors.do_404_message(context)
@@ -806,6 +958,8 @@ def main(environment, return_context=False, form_data=None):
                     )
                     menu.append(menu_entry)
 
+            context["cs_timer"].lap("auth")
+
             # MAKE SURE CONTENT FILE EXISTS; 404 IF NOT
             if context.get("cs_course", None):
                 result = is_resource(context, [context["cs_course"]] + path_info)
@@ -817,6 +971,7 @@ def main(environment, return_context=False, form_data=None):
             loader.load_content(
                 context, context["cs_course"], path_info, context, cfile
             )
+            context["cs_timer"].lap("content")
 
         else:
             default_course = context.get("cs_default_course", None)
@@ -847,6 +1002,7 @@ def main(environment, return_context=False, form_data=None):
                 )
                 context["csm_language"].md_pre_handle(context)
                 context["cs_handler"] = "passthrough"
+                context["cs_timer"].lap("content")
 
         # IF NOT DOING A LOG IN ACTION, STORE QUERY STRING
         if (
@@ -863,6 +1019,7 @@ def main(environment, return_context=False, form_data=None):
         )
         res = tutor.handle_page(context)
         # res = ("200", "OK"), {}, "hello world"
+        context["cs_timer"].lap("handler")
 
         if res is not None:
             # if we're here, the handler wants to give a specific HTTP response
@@ -880,9 +1037,11 @@ def main(environment, return_context=False, form_data=None):
         context["cs_breadcrumbs_html"] = _breadcrumbs_html(context)
 
         out = display_page(context)  # tweak and display HTML
+        context["cs_timer"].lap("render")
 
         session_data = context["cs_session_data"]
         session.set_session_data(context, context["cs_sid"], session_data)
+        context["cs_timer"].lap("session_save")
     except Exception as err:
         LOGGER.error("[dispatch.main] error occurred: %s" % str(err))
         LOGGER.error("[dispatch.main] traceback: %s" % traceback.format_exc())
@@ -0,0 +1,279 @@
+# This file is part of CAT-SOOP
+# Copyright (c) 2011-2019 by The CAT-SOOP Developers <catsoop-dev@mit.edu>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Parsing of form data from HTTP requests.
+
+The body of a request is read from `wsgi.input` in blocks, so that its size
+can be limited (see `cs_max_request_size`) and so that files uploaded as
+`multipart/form-data` are never held in memory all at once: each is written
+to a temporary file (in memory while small, on disk once it is larger than
+`cs_max_form_memory_size`) and given in the form as an `UploadedFile`.
+"""
+
+import io
+import tempfile
+import urllib.parse
+
+from email.parser import HeaderParser
+from email.utils import collapse_rfc2231_value
+
+BLOCK_SIZE = 65536
+MAX_HEADER_SIZE = 16384
+
+
+class RequestTooLarge(Exception):
+    """
+    Raised when the body of a request is larger than allowed
+    """
+
+
+class BadRequest(Exception):
+    """
+    Raised when the body of a request cannot be parsed
+    """
+
+
+class UploadedFile:
+    """
+    A file uploaded as part of a `multipart/form-data` request.
+
+    **Attributes:**
+
+    * `filename`: the name of the file, as given by the browser
+    * `content_type`: the MIME type of the file, as given by the browser
+    * `file`: a file-like object (positioned at its start) with the contents
+    * `size`: the size of the file, in bytes
+    """
+
+    def __init__(self, filename, content_type, file, size):
+        self.filename = filename
+        self.content_type = content_type
+        self.file = file
+        self.size = size
+
+    def read(self, n=-1):
+        return self.file.read(n)
+
+    def seek(self, offset, whence=0):
+        return self.file.seek(offset, whence)
+
+    def close(self):
+        self.file.close()
+
+    def __repr__(self):
+        return "UploadedFile(%r, %r, size=%d)" % (
+            self.filename,
+            self.content_type,
+            self.size,
+        )
+
+
+def _add(form, name, value):
+    if name in form:
+        if not isinstance(form[name], list):
+            form[name] = [form[name]]
+        form[name].append(value)
+    else:
+        form[name] = value
+
+
+def _read_limited(stream, length, max_size):
+    """
+    Yield the body of a request (of the given length, or up to the end of the
+    stream if that is `None`) in blocks, raising `RequestTooLarge` if it is
+    larger than `max_size`.
+    """
+    if length is not None and max_size is not None and length > max_size:
+        raise RequestTooLarge(length)
+    total = 0
+    while length is None or total < length:
+        want = BLOCK_SIZE if length is None else min(BLOCK_SIZE, length - total)
+        block = stream.read(want)
+        if not block:
+            break
+        total += len(block)
+        if max_size is not None and total > max_size:
+            raise RequestTooLarge(total)
+        yield block
+
+
+def _parse_urlencoded(form, data, encoding="utf-8"):
+    if isinstance(data, bytes):
+        data = data.decode(encoding, "replace")
+    for name, value in urllib.parse.parse_qsl(
+        data, keep_blank_values=True, encoding=encoding, errors="replace"
+    ):
+        _add(form, name, value)
+
+
+def _parse_part_headers(raw):
+    try:
+        text = raw.decode("utf-8")
+    except UnicodeDecodeError:
+        text = raw.decode("latin-1")
+    headers = HeaderParser().parsestr(text)
+    if headers.get_content_disposition() != "form-data":
+        raise BadRequest("multipart part is not form-data")
+    name = headers.get_param("name", header="content-disposition")
+    if name is None:
+        raise BadRequest("multipart part has no name")
+    filename = headers.get_filename()
+    ctype = headers.get("content-type")
+    charset = headers.get_content_charset() or "utf-8"
+    return collapse_rfc2231_value(name), filename, ctype, charset
+
+
+def _parse_multipart(form, blocks, boundary, max_memory_size):
+    """
+    Parse a `multipart/form-data` body (given as an iterator of blocks of
+    bytes) into `form`.
+    """
+    delimiter = b"\r\n--" + boundary
+    # the body begins with the first delimiter, minus its CRLF
+    buf = b"\r\n"
+    blocks = iter(blocks)
+    state = "preamble"
+    part = None  # (name, filename, content type, charset, file)
+
+    def more():
+        nonlocal buf
+        try:
+            buf += next(blocks)
+            return True
+        except StopIteration:
+            return False
+
+    def finish_part():
+        name, filename, ctype, charset, f = part
+        size = f.tell()
+        f.seek(0)
+        if filename is None:
+            _add(form, name, f.read().decode(charset, "replace"))
+        else:
+            _add(form, name, UploadedFile(filename, ctype, f, size))
+
+    while True:
+        if state in {"preamble", "body"}:
+            ix = buf.find(delimiter)
+            if ix == -1:
+                # keep enough of the end of the buffer to find a delimiter
+                # which is split across blocks
+                keep = len(delimiter) - 1
+                if len(buf) > keep:
+                    if part is not None:
+                        part[-1].write(buf[:-keep])
+                    buf = buf[-keep:]
+                if not more():
+                    raise BadRequest("multipart body ended unexpectedly")
+                continue
+            if part is not None:
+                part[-1].write(buf[:ix])
+                finish_part()
+                part = None
+            buf = buf[ix + len(delimiter) :]
+            state = "delimiter"
+        elif state == "delimiter":
+            while len(buf) < 2 and more():
+                pass
+            if buf.startswith(b"--"):
+                return  # the closing delimiter; ignore any epilogue
+            end = buf.find(b"\r\n")
+            if end == -1:
+                if len(buf) > MAX_HEADER_SIZE or not more():
+                    raise BadRequest("bad multipart delimiter")
+                continue
+            # (transport padding after the boundary is allowed)
+            buf = buf[end + 2 :]
+            state = "headers"
+        elif state == "headers":
+            end = buf.find(b"\r\n\r\n")
+            if end == -1:
+                if len(buf) > MAX_HEADER_SIZE or not more():
+                    raise BadRequest("bad multipart headers")
+                continue
+            name, filename, ctype, charset = _parse_part_headers(buf[:end])
+            if filename is None:
+                f = io.BytesIO()
+            else:
+                f = tempfile.SpooledTemporaryFile(max_size=max_memory_size)
+            part = (name, filename, ctype, charset, f)
+            buf = buf[end + 4 :]
+            state = "body"
+
+
+def parse_form(environment, max_size=None, max_memory_size=1024 * 1024):
+    """
+    Get the form data associated with a request: the fields from its query
+    string, and those from its body if it is `application/x-www-form-urlencoded`
+    or `multipart/form-data`.
+
+    **Parameters:**
+
+    * `environment`: the environment variables associated with the request
+
+    **Optional Parameters:**
+
+    * `max_size` (default `None`): the maximum size of a request body in
+        bytes, or `None` for no limit
+    * `max_memory_size` (default 1MB): the size in bytes above which uploaded
+        files are written to disk rather than kept in memory
+
+    **Returns:** a dictionary mapping field names to values.  Values are
+    strings, except that uploaded files are `UploadedFile` objects, and that
+    fields given more than once map to lists of their values.
+
+    Raises `RequestTooLarge` if the body is larger than `max_size`, and
+    `BadRequest` if it cannot be parsed.
+    """
+    form = {}
+    if environment.get("REQUEST_METHOD", "GET").upper() in {"GET", "HEAD"}:
+        _parse_urlencoded(form, environment.get("QUERY_STRING", ""))
+        return form
+
+    ctype = environment.get("CONTENT_TYPE", "")
+    mimetype, _, params = ctype.partition(";")
+    mimetype = mimetype.strip().lower()
+    params = dict(
+        (k.strip().lower(), v.strip().strip('"'))
+        for k, _, v in (p.partition("=") for p in params.split(";"))
+    )
+    try:
+        length = int(environment.get("CONTENT_LENGTH") or 0)
+    except ValueError:
+        raise BadRequest("bad Content-Length")
+    if environment.get("wsgi.input_terminated") and not environment.get(
+        "CONTENT_LENGTH"
+    ):
+        length = None  # read up to the end of the (chunked) request
+    stream = environment.get("wsgi.input")
+    blocks = _read_limited(stream, length, max_size) if stream is not None else iter(())
+
+    if mimetype == "multipart/form-data":
+        boundary = params.get("boundary", "")
+        if not 0 < len(boundary) <= 70:
+            raise BadRequest("bad multipart boundary")
+        _parse_multipart(form, blocks, boundary.encode("latin-1"), max_memory_size)
+    elif mimetype in {"application/x-www-form-urlencoded", ""}:
+        _parse_urlencoded(form, b"".join(blocks), params.get("charset", "utf-8"))
+    else:
+        # some other kind of body, which isn't form data (but should still be
+        # within the size limit)
+        for _ in blocks:
+            pass
+    # fields in the query string come after those in the body, as they did
+    # with cgi.FieldStorage
+    _parse_urlencoded(form, environment.get("QUERY_STRING", ""))
+    return form
@@ -8,7 +8,9 @@ import sys
 import time
 import shutil
 import signal
+import socket
 import logging
+import resource
 import tempfile
 import traceback
 import collections
@@ -24,6 +26,7 @@ from . import csqueue
 from . import language
 from . import dispatch
 from . import debug_log
+from . import profiling
 from . import base_context
 from .process import set_pdeathsig
 
@@ -43,6 +46,8 @@ REAL_TIMEOUT = base_context.cs_checker_global_timeout
 
 DEBUG = True
 
+DRAINING = False	# set (e.g. by SIGTERM) to stop taking new jobs and exit once idle
+
 # multiprocessing.set_start_method('spawn')	# safer for cloud DB connections (versus using fork)
 # multiprocessing.set_executable(sys.executable)
 
@@ -60,9 +65,10 @@ def exc_message(context):
     return ('<p><font color="red"><b>CAT-SOOP ERROR:</b><pre>%s</pre></font>') % exc
 
 
-def update_lti(lti_handler, row, problemstate, total_possible_npoints, npoints_by_name):
+def update_lti(context, lti_handler, row, problemstate, total_possible_npoints, npoints_by_name):
     '''
-    update LTI tool consumer with new aggregate score
+    queue the new aggregate score to be sent to the LTI tool consumer (see
+    lti.queue_outcome; it is sent by the lti_outbox process)
     '''
     aggregate_score = 0
     cnt = 0
@@ -89,7 +95,7 @@ def update_lti(lti_handler, row, problemstate, total_possible_npoints, npoints_b
             % (cnt, total_possible_npoints, npoints_by_name, aggregate_score, aggregate_score_fract)
         )
         log(
-            "magic=%s sending aggregate_score_fract=%s to LTI tool consumer, scores=%s"
+            "magic=%s queueing aggregate_score_fract=%s for LTI tool consumer, scores=%s"
             % (row["magic"], aggregate_score_fract, problemstate['scores'])
         )
         score_ok = True
@@ -102,17 +108,21 @@ def update_lti(lti_handler, row, problemstate, total_possible_npoints, npoints_b
 
     if score_ok:
         try:
-            lti_handler.send_outcome(aggregate_score_fract)
+            lti.queue_outcome(context, lti_handler.lti_data, aggregate_score_fract)
         except Exception as err:
             LOGGER.error(
-                "[checker] failed to send outcome to LTI consumer, problem=%s, err=%s, traceback=%s"
+                "[checker] failed to queue outcome for LTI consumer, problem=%s, err=%s, traceback=%s"
                 % (str(row)[:100], str(err), traceback.format_exc())
             )
             # LOGGER.error("[checker] traceback=%s" % traceback.format_exc())
 
-def save_grader_results(result_queue, context, name, row):
+def save_grader_results(result_queue, context, name, row, problemstate=None):
     '''
     Save results from the completion of a do_check process, for a specific question name
+
+    problemstate: for jobs graded inline (which never entered the queue), the
+    problemstate dict which the caller is about to write; it is updated in
+    place instead of the problemstate log.
     '''
     jobid = row['magic']
     if "lti_data" in row:			# don't save lti_data in results (it was just needed for pushing scores to LTI consumer)
@@ -126,9 +136,7 @@ def save_grader_results(result_queue, context, name, row):
         return
 
     log("[grader.save_grader_results] saving result for jobid=%s, name=%s, user=%s, path=%s" % (jobid, name, row.get('username'), row.get('path')))
-    # csqueue.initialize()			# http://api.mongodb.org/python/current/faq.html#is-pymongo-fork-safe
-    # cslog.initialize()
-    csqueue.save_results(context, jobid, row)
+    csqueue.save_results(context, jobid, row, remove_from_running=problemstate is None)
     try:
         os.close(_)
     except:
@@ -137,6 +145,14 @@ def save_grader_results(result_queue, context, name, row):
     logpath = (row["username"], row["path"], "problemstate")
 
     def transform_func(x):
+        if row.get("regrade_of") is not None:
+            # a bulk regrade (see "catsoop regrade") replaces the results of
+            # the submission it re-ran, unless the user has submitted again
+            # since then.
+            if x.get("last_submit_id", {}).get(name) != row["regrade_of"]:
+                return x
+            x["last_submit_id"][name] = row["magic"]
+            x.setdefault("checker_ids", {})[name] = row["magic"]
         if row["action"] == "submit":
             x.setdefault("scores", {})[name] = row["score"]
         x.setdefault("score_displays", {})[name] = row["score_box"]
@@ -144,12 +160,91 @@ def save_grader_results(result_queue, context, name, row):
         x.setdefault("extra_data", {})[name] = row["extra_data"]
         return x
 
+    if problemstate is not None:
+        transform_func(problemstate)
+        return
+
     log("[grader.save_grader_results] updating problemstate log")
     cslog.modify_most_recent(*logpath, default={},
                              transform_func=transform_func,
                              method="overwrite")
 
 
+def resource_usage():
+    '''
+    Return the CPU time (in seconds) and peak resident set size (in kilobytes)
+    used so far by this process, and by the sandbox processes it has run.
+
+    In do_check, "this process" is the child forked for a single job, so the
+    CPU times are for that job alone; its maxrss includes what it inherited
+    from the checker when it was forked.  Sandboxes run on another machine
+    (the remote sandbox) are not counted.
+    '''
+    me = resource.getrusage(resource.RUSAGE_SELF)
+    sandboxes = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {"utime": me.ru_utime,
+            "stime": me.ru_stime,
+            "maxrss": me.ru_maxrss,
+            "sandbox_utime": sandboxes.ru_utime,
+            "sandbox_stime": sandboxes.ru_stime,
+            "sandbox_maxrss": sandboxes.ru_maxrss,
+    }
+
+
+def grade_question(context, row, name, question, args):
+    '''
+    Run the check or submission in the given job row for one question, and
+    store the score, score display, response and extra data in the row.
+
+    Used by do_check, and by the default handler for questions which are
+    graded inline (see cs_inline_grading).
+    '''
+    jobid = row.get('magic')
+    if row["action"] == "submit":
+        if DEBUG:
+            log("[%s] submit name=%s, row=%s" % (jobid, name, str(row)[:50]))
+        try:
+            handler = question["handle_submission"]
+            if DEBUG > 10:
+                log("handler=%s" % handler)
+            resp = handler(row["form"], **args)
+            score = resp["score"]
+            msg = resp["msg"]
+            extra = resp.get("extra_data", None)
+        except Exception as err:
+            resp = {}
+            score = 0.0
+            log("[%s] Failed to handle submission, err=%s" % (jobid, str(err)))
+            log("Traceback=%s" % traceback.format_exc())
+            msg = exc_message(context)
+            extra = None
+
+        if DEBUG:
+            log("[%s] submit resp=%s, msg=%s" % (jobid, str(resp)[:50], str(msg)[:50]))
+
+        score_box = context["csm_tutor"].make_score_display(
+            context, args, name, score, True
+        )
+
+    elif row["action"] == "check":
+        try:
+            msg = question["handle_check"](row["form"], **args)
+        except:
+            msg = exc_message(context)
+
+        score = None
+        score_box = ""
+        extra = None
+
+        if DEBUG:
+            log("[%s] check name=%s, msg=%s" % (jobid, name, msg))
+
+    row["score"] = score
+    row["score_box"] = score_box
+    row["response"] = language.handle_custom_tags(context, msg)
+    row["extra_data"] = extra
+
+
 def do_check(row, result_queue=None):
     """
     Check submission, dispatching to appropriate question handler
@@ -158,8 +253,18 @@ def do_check(row, result_queue=None):
 
     This is run by multiprocessing, so it should be a plain function
     """
-    cslog.initialize()		# http://api.mongodb.org/python/current/faq.html#is-pymongo-fork-safe
-    csqueue.initialize()	# http://api.mongodb.org/python/current/faq.html#is-pymongo-fork-safe
+    with profiling.profiled("checker", list(row.get("path") or [])):
+        _do_check(row, result_queue)
+
+
+def _do_check(row, result_queue):
+    # this runs in a child forked by multiprocessing.  database clients are
+    # not fork-safe (http://api.mongodb.org/python/current/faq.html#is-pymongo-fork-safe),
+    # so make sure this process has its own backends (and connection pools)
+    # rather than the parent's.  this is a no-op if they were already
+    # re-created after the fork.
+    cslog.initialize()
+    csqueue.initialize()
 
     os.setpgrp()  # make this part of its own process group
     set_pdeathsig()()  # but make it die if the parent dies.  will this work?
@@ -237,51 +342,10 @@ def do_check(row, result_queue=None):
             continue
         names_done.add(name)
         question, args = namemap[name]
-        if row["action"] == "submit":
-            if DEBUG:
-                log("[%s] submit name=%s, row=%s" % (jobid, name, str(row)[:50]))
-            try:
-                handler = question["handle_submission"]
-                if DEBUG > 10:
-                    log("handler=%s" % handler)
-                resp = handler(row["form"], **args)
-                score = resp["score"]
-                msg = resp["msg"]
-                extra = resp.get("extra_data", None)
-            except Exception as err:
-                resp = {}
-                score = 0.0
-                log("[%s] Failed to handle submission, err=%s" % (jobid, str(err)))
-                log("Traceback=%s" % traceback.format_exc())
-                msg = exc_message(context)
-                extra = None
-
-            if DEBUG:
-                log("[%s] submit resp=%s, msg=%s" % (jobid, str(resp)[:50], str(msg)[:50]))
-
-            score_box = context["csm_tutor"].make_score_display(
-                context, args, name, score, True
-            )
-
-        elif row["action"] == "check":
-            try:
-                msg = question["handle_check"](row["form"], **args)
-            except:
-                msg = exc_message(context)
-
-            score = None
-            score_box = ""
-            extra = None
-
-            if DEBUG:
-                log("[%s] check name=%s, msg=%s" % (jobid, name, msg))
-
-        row["score"] = score
-        row["score_box"] = score_box
-        row["response"] = language.handle_custom_tags(context, msg)
-        row["extra_data"] = extra
+        grade_question(context, row, name, question, args)
 
         # save results and remove job from running
+        row["resources"] = resource_usage()
         log("[grader.do_check] jobid=%s: saving results for name=%s" % (jobid, name))
         save_grader_results(result_queue, context, name, row)        
 
@@ -290,28 +354,100 @@ def do_check(row, result_queue=None):
     if have_lti and lti_handler.have_data and push_scores_to_lti_consumer and row["action"] == "submit":
         logpath = (row["username"], row["path"], "problemstate")
         x = context["csm_cslog"].most_recent(*logpath)
-        update_lti(lti_handler, row, x, total_possible_npoints, npoints_by_name)
+        update_lti(context, lti_handler, row, x, total_possible_npoints, npoints_by_name)
+
+
+def request_drain(signum=None, frame=None):
+    '''
+    Ask watch_queue_and_run (in this process) to stop taking new jobs, and to
+    return once its running jobs are finished.  Can be used as a signal
+    handler.
+    '''
+    global DRAINING
+    DRAINING = True
+
+
+def kill_check(p):
+    '''
+    Kill the process running a check (and anything it started)
+    '''
+    try:
+        pgid = os.getpgid(p.pid)
+        if pgid == os.getpgrp():  # not yet in its own process group
+            os.kill(p.pid, signal.SIGKILL)
+        else:
+            os.killpg(pgid, signal.SIGKILL)
+    except:
+        pass
+
+
+def holds_job(context, jobid, finished=()):
+    '''
+    Return True if this worker may save results for the given job: it still
+    holds the job's lease, or it has already saved results for the job (for
+    one of several questions) while holding the lease.
+    '''
+    return jobid in finished or not csqueue.renew_leases(context, [jobid])
+
+
+def heartbeat(context, worker, running, nstarted, finished=()):
+    '''
+    Renew the leases on this worker's running jobs, register the worker as
+    alive, and recover jobs abandoned by dead workers.
+
+    Jobs whose lease this worker has lost (because it expired, and the job was
+    requeued for another worker) are killed, and removed from running, so that
+    their results are not saved twice.  finished: jobs whose results this
+    worker has already saved (which hold no lease any more).
+
+    Return True if this worker has been asked to drain.
+    '''
+    lost = set(csqueue.renew_leases(context, [id_ for (id_, _, _) in running if id_ not in finished]))
+    for entry in [r for r in running if r[0] in lost]:
+        LOGGER.error("[checker] lost the lease on job %s; killing it (it will be run again by another worker)" % entry[0])
+        kill_check(entry[2])
+        entry[2].join(1)
+        running.remove(entry)
+    csqueue.register_worker(context, worker, {"host": socket.gethostname(),
+                                              "pid": os.getpid(),
+                                              "running": len(running),
+                                              "started": nstarted,
+                                              "draining": DRAINING,
+    })
+    csqueue.move_running_back_to_queued(context)
+    return csqueue.drain_requested(context, worker)
 
 
 def watch_queue_and_run(max_finished=None):
     '''
     This is the main loop for the grader, which checks for queue entries and processes the
-    latest entry.  
+    entry chosen by the scheduling policy (see csqueue.Scheduler).
 
-    This procedure runs forever.
+    Several of these loops, on one or more machines, may share the queue: each
+    holds a lease on the jobs it is running (see cs_checker_lease), and jobs
+    whose lease expires are requeued.
+
+    This procedure runs until it is asked to drain (see request_drain and
+    "catsoop checkerdrain"), after which it finishes its running jobs and returns.
 
     max_finished = number of finished jobs, afer which this procedure returns ; used for unit testing
     '''
+    global DRAINING
     nstarted = 0
     nfinished = 0
     nresults = 0
     running = []
+    finished = {}  # jobs whose results have been saved, and when
     result_queue = multiprocessing.Queue()
     context = base_context.__dict__
-    # if anything is in the "running" dir when we start, that's an error.  turn
-    # those back to queued to force them to run again (put them at the front of the
-    # queue).
-    csqueue.move_running_back_to_queued(context)
+    scheduler = csqueue.Scheduler()
+    worker = csqueue.worker_id()
+    heartbeat_interval = csqueue.lease_time(context) / 4
+    # jobs left running by a checker that died are put back at the front of
+    # the queue, once their leases have expired.  (jobs held by live
+    # checkers, on this machine or others, are left alone.)
+    DRAINING = heartbeat(context, worker, running, nstarted) or DRAINING
+    last_heartbeat = time.time()
     csqueue.update_current_job_status()
     log("=====> Current number of jobs in queue waiting for execution = %s" % csqueue.current_queue_length())
 
@@ -346,16 +482,15 @@ def watch_queue_and_run(max_finished=None):
                             "processing your submission</b></font>"
                         ) % p.exitcode
                     magic = row["magic"]
+                    row["job_complete"] = time.time()
                     LOGGER.error("    Process %s died with exitcode %s, response=%s" % (p, p.exitcode, row['response']))
-                    csqueue.save_results(context, magic, row)
+                    if holds_job(context, magic, finished):
+                        csqueue.save_results(context, magic, row)
                 dead.add(i)
                 nfinished += 1
 
             elif time.time() - p._started > REAL_TIMEOUT:
-                try:
-                    os.killpg(os.getpgid(p.pid), signal.SIGKILL)
-                except:
-                    pass
+                kill_check(p)
         if dead:
             log("Removing %s" % dead)
         for i in sorted(dead, reverse=True):
@@ -369,14 +504,33 @@ def watch_queue_and_run(max_finished=None):
             result = None
         if result:
             # log("got result!  %s" % str(result))
-            save_grader_results(None, *result)
+            magic = result[2]["magic"]
+            if holds_job(context, magic, finished):
+                save_grader_results(None, *result)
+                finished[magic] = time.time()
+            else:
+                LOGGER.error("[checker] dropping results of job %s, whose lease was lost" % magic)
             nresults += 1
             if max_finished is not None and nresults >= max_finished:
+                csqueue.unregister_worker(context, worker)
                 return
 
-        if base_context.cs_checker_parallel_checks - len(running) > 0:
+        if time.time() - last_heartbeat > heartbeat_interval:
+            DRAINING = heartbeat(context, worker, running, nstarted, finished) or DRAINING
+            last_heartbeat = time.time()
+            for magic, t in list(finished.items()):
+                if last_heartbeat - t > REAL_TIMEOUT * 2:
+                    del finished[magic]
+
+        if DRAINING and not running:
+            log("Drained: no jobs running, exiting (worker=%s)" % worker)
+            csqueue.unregister_worker(context, worker)
+            DRAINING = False
+            return
+
+        if not DRAINING and base_context.cs_checker_parallel_checks - len(running) > 0:
             # otherwise, add an entry to running.
-            row = csqueue.get_oldest_from_queue(context, move_to_running=True)
+            row = csqueue.get_next_from_queue(context, scheduler, [r for (_, r, _) in running])
             if row:
                 # start a worker for it
                 log("=====> Current number of jobs in queue waiting for execution = %s" % csqueue.current_queue_length())
@@ -18,9 +18,15 @@
 LTI Tool Provider interface
 """
 
+import os
 import re
+import json
+import time
 import uuid
+import fcntl
 import urllib
+import hashlib
+import oauth2
 import pylti.common
 
 from lxml import etree
@@ -29,12 +35,14 @@ from lxml.builder import ElementMaker
 from oauthlib.oauth1 import Client
 
 from . import auth
+from . import loader
 from . import session
 from . import debug_log
+from . import base_context
 
 LOGGER = debug_log.LOGGER
 
-_nodoc = {"Client", "ElementMaker", "etree", "LOGGER"}
+_nodoc = {"Client", "ElementMaker", "etree", "LOGGER", "oauth2"}
 
 
 class lti4cs(pylti.common.LTIBase):
@@ -213,6 +221,217 @@ class lti4cs_response(object):
         return url
 
 
+# -----------------------------------------------------------------------------
+# Outcome outbox: scores are queued here by the checker, and sent to the tool
+# consumer by a separate process (scripts/lti_outbox.py), so that grading
+# never waits on the consumer.
+
+
+def outbox_location():
+    """
+    Return the directory holding the queued LTI outcomes
+    """
+    return os.path.join(base_context.cs_data_root, "_logs", "_lti_outbox")
+
+
+class _outbox_lock(object):
+    def __enter__(self):
+        os.makedirs(outbox_location(), exist_ok=True)
+        self.f = open(os.path.join(outbox_location(), ".lock"), "w")
+        fcntl.flock(self.f, fcntl.LOCK_EX)
+
+    def __exit__(self, *args):
+        self.f.close()
+
+
+def _read_entry(fname):
+    try:
+        with open(fname) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _write_entry(fname, entry):
+    with open(fname + ".tmp", "w") as f:
+        json.dump(entry, f)
+    os.replace(fname + ".tmp", fname)
+
+
+def queue_outcome(context, lti_data, score):
+    """
+    Queue the given score (in [0, 1]) to be sent to the LTI tool consumer
+    described by lti_data.  Only the most recent score for each (consumer,
+    outcome service, result) is kept, so a score which has not been sent yet
+    is replaced rather than sent twice.
+
+    Returns the name of the outbox entry.
+    """
+    key = json.dumps(
+        [
+            lti_data.get("oauth_consumer_key"),
+            lti_data.get("lis_outcome_service_url"),
+            lti_data.get("lis_result_sourcedid"),
+        ]
+    )
+    name = hashlib.sha1(key.encode()).hexdigest()
+    entry = {
+        "course": context.get("cs_course"),
+        "lti_data": lti_data,
+        "score": score,
+        "version": uuid.uuid4().hex,
+        "queued": time.time(),
+        "attempts": 0,
+        "next_try": 0,
+    }
+    with _outbox_lock():
+        _write_entry(os.path.join(outbox_location(), name + ".json"), entry)
+    return name
+
+
+def pending_outcomes():
+    """
+    Return a dict mapping the names of the queued outbox entries to the
+    entries themselves
+    """
+    loc = outbox_location()
+    if not os.path.isdir(loc):
+        return {}
+    out = {}
+    for fname in sorted(os.listdir(loc)):
+        if fname.endswith(".json"):
+            entry = _read_entry(os.path.join(loc, fname))
+            if entry is not None:
+                out[fname[:-5]] = entry
+    return out
+
+
+class _CapitalizedAuthClient(oauth2.Client):
+    """
+    oauth2.Client which sends the Authorization header capitalized, as some
+    consumers need (as in pylti.common._post_patched_request, but without
+    patching httplib2.Http for every client in the process)
+    """
+
+    def _normalize_headers(self, headers):
+        ret = oauth2.Client._normalize_headers(self, headers)
+        if "authorization" in ret:
+            ret["Authorization"] = ret.pop("authorization")
+        return ret
+
+
+def _config_stamp(course):
+    """
+    Return the modification times of the global configuration file and of the
+    given course's top-level preload.py (None for those which do not exist)
+    """
+    files = [base_context.config_loc]
+    if course:
+        files.append(os.path.join(loader.get_course_fs_location({}, course), "preload.py"))
+    out = []
+    for fname in files:
+        try:
+            out.append(os.stat(fname).st_mtime_ns)
+        except OSError:
+            out.append(None)
+    return tuple(out)
+
+
+class OutcomeSender(object):
+    """
+    Sends outcomes to LTI tool consumers, reusing one keep-alive HTTP client
+    per consumer key (pylti.common.post_message makes a new connection for
+    every message)
+    """
+
+    def __init__(self):
+        self.clients = {}
+        self.handlers = {}
+
+    def handler(self, course, lti_data):
+        """
+        Return an lti4cs_response for the given course and lti_data.  The
+        course's context is loaded once, and loaded again if the global
+        config.py or the course's preload.py has changed since.
+        """
+        stamp = _config_stamp(course)
+        cached = self.handlers.get(course)
+        if cached is None or cached[0] != stamp:
+            cached = (stamp, loader.generate_context([course] if course else []))
+            self.handlers[course] = cached
+        return lti4cs_response(cached[1], lti_data)
+
+    def client(self, consumers, consumer_key):
+        client = self.clients.get(consumer_key)
+        if client is None:
+            consumer = consumers[consumer_key]
+            client = _CapitalizedAuthClient(
+                oauth2.Consumer(key=consumer_key, secret=consumer["secret"]),
+                timeout=30,
+            )
+            if consumer.get("cert"):
+                client.add_certificate(key=consumer["cert"], cert=consumer["cert"], domain="")
+            self.clients[consumer_key] = client
+        return client
+
+    def send(self, course, lti_data, score):
+        """
+        Send the given score; returns True if the consumer accepted it
+        """
+        handler = self.handler(course, lti_data)
+        consumer_key = lti_data.get("oauth_consumer_key")
+        body = handler.generate_result_xml(lti_data.get("lis_result_sourcedid"), score)
+        client = self.client(handler.consumers, consumer_key)
+        response, content = client.request(
+            handler.response_url,
+            "POST",
+            body=body.encode("utf-8"),
+            headers={"Content-Type": "application/xml"},
+        )
+        return b"<imsx_codeMajor>success</imsx_codeMajor>" in content
+
+
+def send_outcomes(sender=None, now=None):
+    """
+    Try to send each queued outcome which is due.  Sent outcomes are removed
+    from the outbox (unless a newer score was queued in the meantime, which is
+    then sent next); failed ones are retried later, with exponential backoff
+    (see cs_lti_outbox_retry).
+
+    Returns a tuple (number sent, number failed).
+    """
+    sender = sender or OutcomeSender()
+    now = time.time() if now is None else now
+    first, longest = base_context.cs_lti_outbox_retry
+    sent = failed = 0
+    for name, entry in pending_outcomes().items():
+        if entry["next_try"] > now:
+            continue
+        try:
+            ok = sender.send(entry["course"], entry["lti_data"], entry["score"])
+        except Exception as err:
+            LOGGER.error("[lti.send_outcomes] failed to send outcome %s: %s" % (name, err))
+            ok = False
+        if ok:
+            sent += 1
+            LOGGER.info("[lti.send_outcomes] sent score=%s for %s" % (entry["score"], name))
+        else:
+            failed += 1
+        fname = os.path.join(outbox_location(), name + ".json")
+        with _outbox_lock():
+            current = _read_entry(fname)
+            if current is None or current["version"] != entry["version"]:
+                continue  # a newer score was queued while this one was sent
+            if ok:
+                os.unlink(fname)
+            else:
+                current["attempts"] += 1
+                delay = min(longest, first * 2 ** (current["attempts"] - 1))
+                current["next_try"] = now + delay
+                _write_entry(fname, current)
+    return sent, failed
+
+
 # -----------------------------------------------------------------------------
 
 
@@ -56,6 +56,15 @@ Example commands:
     logread        : show the content of a given log
     logwrite       : overwrite the content of a given log
     logedit        : edit the content of a given log in a text editor
+    logcompact     : remove superseded entries from the logs of a course
+    logarchive     : pack the logs of a course into a single archive file
+    uploadgc       : remove stored uploaded files that are no longer used
+    checkerstats   : summarize the resources used by checker jobs
+    checkerdrain   : ask checkers to finish their running jobs and exit
+    regrade        : re-run the checker on the latest submissions to a question
+    requeststats   : summarize the time taken by each phase of handling requests
+    profile        : profile requests and checker jobs on a running server
+    assets         : make compressed copies of static files ahead of time
 
 """
     cmd_help = """A variety of commands are available, each with different arguments:
@@ -66,6 +75,15 @@ configure      : generate CAT-SOOP configuration file using an interactive wizar
 logread        : show the content of a given log
 logwrite       : overwrite the content of a given log
 logedit        : edit the content of a given log in a text editor
+logcompact     : remove superseded entries from the logs of a course
+logarchive     : pack the logs of a course into a single archive file
+uploadgc       : remove stored uploaded files that are no longer used
+checkerstats   : summarize the resources used by checker jobs
+checkerdrain   : ask checkers to finish their running jobs and exit
+regrade        : re-run the checker on the latest submissions to a question
+requeststats   : summarize the time taken by each phase of handling requests
+profile        : profile requests and checker jobs on a running server
+assets         : make compressed copies of static files ahead of time
 
 """
 
@@ -140,6 +158,51 @@ logedit        : edit the content of a given log in a text editor
 
         log_scripts.log_edit(args.args)
 
+    elif args.command == "logcompact":
+        from .scripts import log_scripts
+
+        log_scripts.log_compact(args.args)
+
+    elif args.command == "logarchive":
+        from .scripts import log_scripts
+
+        log_scripts.log_archive(args.args)
+
+    elif args.command == "uploadgc":
+        from .scripts import log_scripts
+
+        log_scripts.upload_gc(args.args)
+
+    elif args.command == "checkerstats":
+        from .scripts import checker_scripts
+
+        checker_scripts.checker_stats(args.args)
+
+    elif args.command == "checkerdrain":
+        from .scripts import checker_scripts
+
+        checker_scripts.checker_drain(args.args)
+
+    elif args.command == "regrade":
+        from .scripts import checker_scripts
+
+        checker_scripts.regrade(args.args)
+
+    elif args.command == "requeststats":
+        from .scripts import timing_scripts
+
+        timing_scripts.request_stats(args.args)
+
+    elif args.command == "profile":
+        from .scripts import profile_scripts
+
+        profile_scripts.profile(args.args)
+
+    elif args.command == "assets":
+        from .scripts import asset_scripts
+
+        asset_scripts.build_assets(args.args)
+
     else:
         print("Unknown command %s" % args.command)
         sys.exit(-1)
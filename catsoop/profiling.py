@@ -0,0 +1,291 @@
+# This file is part of CAT-SOOP
+# Copyright (c) 2011-2019 by The CAT-SOOP Developers <catsoop-dev@mit.edu>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Profiling of requests and checker jobs on a live server.
+
+`catsoop profile start` writes the settings to `cs_data_root/_profile/settings`
+(which every process checks, without needing a restart): which kinds of work
+to profile (requests and/or checker jobs), optionally only those for some
+courses or under some path prefix, only one in every N of them, and for how
+long.  Each profiled request or job is run under `cProfile`, and its profile
+is written to `cs_data_root/_profile/<date>/`, along with a small JSON file
+describing it (kind, path, start time and duration).  `catsoop profile report`
+aggregates them.
+"""
+
+import os
+import json
+import time
+import random
+import cProfile
+import threading
+import contextlib
+
+from . import base_context
+
+KINDS = ("request", "checker")
+"""
+The kinds of work which can be profiled
+"""
+
+CHECK_INTERVAL = 1.0
+"""
+Each process checks whether the profiling settings have changed at most once
+every this many seconds
+"""
+
+_SETTINGS = {"checked": 0, "key": None, "value": None}
+_LOCK = threading.Lock()
+_ACTIVE = threading.local()
+
+
+def profile_dir():
+    """
+    **Returns:** the directory in which profiles (and the profiling settings)
+    are stored
+    """
+    return os.path.join(base_context.cs_data_root, "_profile")
+
+
+def settings_location():
+    return os.path.join(profile_dir(), "settings")
+
+
+def write_settings(settings):
+    """
+    Replace the profiling settings.
+
+    **Parameters:**
+
+    * `settings`: a dictionary with keys `kinds` (a list of the `KINDS` to
+        profile), `courses` (a list of course names, or `None` for all),
+        `prefix` (a path prefix such as `"6.SAMP/questions"`, or `None`),
+        `every` (profile one in every this many requests or jobs) and `until`
+        (a time after which to stop profiling, or `None`); or `None` to stop
+        profiling
+    """
+    loc = settings_location()
+    if settings is None:
+        try:
+            os.unlink(loc)
+        except FileNotFoundError:
+            pass
+        return
+    os.makedirs(os.path.dirname(loc), exist_ok=True)
+    tmp = "%s.%d.tmp" % (loc, os.getpid())
+    with open(tmp, "w") as f:
+        json.dump(settings, f)
+    os.replace(tmp, loc)
+
+
+def read_settings():
+    """
+    **Returns:** the current profiling settings (see `write_settings`), or
+    `None` if profiling is off
+    """
+    now = time.time()
+    if now - _SETTINGS["checked"] < CHECK_INTERVAL:
+        return _SETTINGS["value"]
+    with _LOCK:
+        _SETTINGS["checked"] = now
+        try:
+            st = os.stat(settings_location())
+            key = st.st_ino, st.st_mtime_ns
+        except OSError:
+            key = None
+        if key != _SETTINGS["key"]:
+            value = None
+            if key is not None:
+                try:
+                    with open(settings_location()) as f:
+                        value = json.load(f)
+                except (OSError, ValueError):
+                    pass
+            _SETTINGS["key"], _SETTINGS["value"] = key, value
+        return _SETTINGS["value"]
+
+
+def should_profile(kind, path):
+    """
+    Decide whether to profile a request or checker job.
+
+    **Parameters:**
+
+    * `kind`: one of `KINDS`
+    * `path`: the path of the page concerned, as a list of strings starting
+        with the course
+
+    **Returns:** `True` if the current settings select this request or job
+    """
+    settings = read_settings()
+    if settings is None:
+        return False
+    if settings.get("until") is not None and time.time() > settings["until"]:
+        return False
+    if kind not in settings.get("kinds", KINDS):
+        return False
+    if kind == "request" and path[:1] == ["_static"]:
+        return False  # not worth profiling
+    courses = settings.get("courses")
+    if courses and (not path or path[0] not in courses):
+        return False
+    prefix = [i for i in (settings.get("prefix") or "").split("/") if i]
+    if path[: len(prefix)] != prefix:
+        return False
+    every = settings.get("every") or 1
+    return every <= 1 or random.randrange(every) == 0
+
+
+def _save(profiler, kind, path, started, duration):
+    day = time.strftime("%Y-%m-%d", time.localtime(started))
+    dname = os.path.join(profile_dir(), day)
+    slug = "-".join(path).replace(os.sep, "_")[:100] or "_root"
+    name = "%s.%06d-%s-%d-%s" % (
+        time.strftime("%H%M%S", time.localtime(started)),
+        int(started % 1 * 1e6),
+        kind,
+        os.getpid(),
+        slug,
+    )
+    info = {"kind": kind, "path": path, "time": started, "duration": duration}
+    try:
+        os.makedirs(dname, exist_ok=True)
+        profiler.dump_stats(os.path.join(dname, name + ".prof"))
+        with open(os.path.join(dname, name + ".json"), "w") as f:
+            json.dump(info, f)
+    except OSError:
+        pass
+
+
+@contextlib.contextmanager
+def profiled(kind, path):
+    """
+    Context manager which profiles the code in its body, if `should_profile`
+    says so, and saves the profile.
+
+    **Parameters:**
+
+    * `kind`: one of `KINDS`
+    * `path`: the path of the page concerned, as a list of strings starting
+        with the course
+    """
+    profiler = None
+    # (requests handled within other requests, as for LTI, are part of the
+    # outer request's profile)
+    if not getattr(_ACTIVE, "profiling", False) and should_profile(kind, path):
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # another profiler is already running in this process
+            profiler = None
+    started = time.time()
+    try:
+        if profiler is not None:
+            _ACTIVE.profiling = True
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            _ACTIVE.profiling = False
+            _save(profiler, kind, path, started, time.time() - started)
+
+
+def find_profiles(since=None, kinds=KINDS, courses=None, prefix=None):
+    """
+    Find saved profiles.
+
+    **Optional Parameters:**
+
+    * `since` (default `None`): only find profiles started after this time
+    * `kinds` (default all): only find profiles of these kinds
+    * `courses` (default `None`): only find profiles for these courses
+    * `prefix` (default `None`): only find profiles for paths under this prefix
+
+    **Returns:** a list of `(location of profile, description)` tuples, oldest
+    first, where the description is a dictionary as described above
+    """
+    out = []
+    root = profile_dir()
+    if not os.path.isdir(root):
+        return out
+    prefix = [i for i in (prefix or "").split("/") if i]
+    first = None if since is None else time.strftime("%Y-%m-%d", time.localtime(since))
+    for day in sorted(os.listdir(root)):
+        dname = os.path.join(root, day)
+        if not os.path.isdir(dname) or (first is not None and day < first):
+            continue
+        for name in sorted(os.listdir(dname)):
+            if not name.endswith(".json"):
+                continue
+            prof = os.path.join(dname, name[:-5] + ".prof")
+            try:
+                with open(os.path.join(dname, name)) as f:
+                    info = json.load(f)
+            except (OSError, ValueError):
+                continue
+            path = info.get("path") or []
+            if (
+                not os.path.isfile(prof)
+                or info.get("kind") not in kinds
+                or (since is not None and info.get("time", 0) < since)
+                or (courses and (not path or path[0] not in courses))
+                or path[: len(prefix)] != prefix
+            ):
+                continue
+            out.append((prof, info))
+    return out
+
+
+def source_group(filename):
+    """
+    Say which part of CAT-SOOP (or of a course) some code comes from, for
+    summarizing where the time in a profile goes.
+
+    **Parameters:**
+
+    * `filename`: the name of the file containing the code, as recorded in a
+        profile
+
+    **Returns:** a short description, e.g. `"qtype pythoncode"` or
+    `"course 6.SAMP: questions/content.py"`
+    """
+    if filename.startswith("~") or filename.startswith("<"):
+        return "built-in"
+    # code from courses, question types, etc. is compiled from a copy in
+    # cs_data_root/_cached (see loader.cs_compile) which mirrors its location
+    cached = os.path.join(base_context.cs_data_root, "_cached")
+    if filename.startswith(cached + os.sep):
+        filename = filename[len(cached) :]
+    parts = filename.split(os.sep)
+    for special, label in (
+        ("__QTYPES__", "qtype"),
+        ("__HANDLERS__", "handler"),
+        ("__AUTH__", "auth"),
+        ("plugins", "plugin"),
+    ):
+        if special in parts[:-2]:
+            return "%s %s" % (label, parts[parts.index(special) + 1])
+    if "courses" in parts[:-2]:
+        ix = parts.index("courses")
+        return "course %s: %s" % (parts[ix + 1], "/".join(parts[ix + 2 :]))
+    root = base_context.cs_fs_root.rstrip(os.sep) + os.sep
+    if filename.startswith(root):
+        return "catsoop %s" % filename[len(root) :]
+    for lib in ("site-packages", "dist-packages"):
+        if lib in parts[:-1]:
+            return "library %s" % parts[parts.index(lib) + 1].split(".")[0]
+    return "python"
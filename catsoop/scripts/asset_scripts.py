@@ -0,0 +1,51 @@
+# This file is part of CAT-SOOP
+# Copyright (c) 2011-2019 by The CAT-SOOP Developers <catsoop-dev@mit.edu>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import time
+
+from .. import assets
+
+ASSETS_USAGE = """\
+Make the gzipped copies of static files which are sent to browsers that
+accept them, ahead of time (otherwise, each is made the first time the file
+is requested).
+
+    catsoop assets [DIRECTORY ...]
+
+    DIRECTORY: only look for files in these directories (default: the
+               __STATIC__ directories of CAT-SOOP, its handlers, question
+               types and authentication types, and of installed plugins)
+"""
+
+
+def build_assets(args):
+    if "-h" in args or "--help" in args:
+        print(ASSETS_USAGE, file=sys.stderr)
+        sys.exit(1)
+    for d in args:
+        if not os.path.isdir(d):
+            print("No such directory: %s" % d, file=sys.stderr)
+            sys.exit(1)
+    start = time.time()
+    nfiles, ncompressed, before, after = assets.build(
+        [os.path.abspath(d) for d in args]
+    )
+    print(
+        "Compressed %d of %d files (%.1f MB to %.1f MB) in %.1fs"
+        % (ncompressed, nfiles, before / 1e6, after / 1e6, time.time() - start)
+    )
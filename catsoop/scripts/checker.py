@@ -16,6 +16,7 @@
 
 import os
 import sys
+import signal
 
 CATSOOP_LOC = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
 if CATSOOP_LOC not in sys.path:
@@ -23,4 +24,7 @@ if CATSOOP_LOC not in sys.path:
 
 from catsoop import grader
 
+# on SIGTERM, stop taking new jobs, and exit once the running ones are done
+signal.signal(signal.SIGTERM, grader.request_drain)
+
 grader.watch_queue_and_run()
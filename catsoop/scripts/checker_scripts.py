@@ -0,0 +1,414 @@
+#!/usr/bin/env python3
+
+# This file is part of CAT-SOOP
+# Copyright (c) 2011-2019 by The CAT-SOOP Developers <catsoop-dev@mit.edu>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import csv
+import json
+import time
+import math
+import collections
+
+from .. import user
+from .. import cslog
+from .. import csqueue
+from .. import loader
+from .. import base_context
+from .. import time as cstime
+from . import log_scripts
+
+CHECKERSTATS_USAGE = """\
+Summarize the resources used by the checker's finished jobs: time spent
+waiting in the queue, wall-clock time, CPU time (including sandboxes) and
+peak memory, as percentiles per course and per question.
+
+    catsoop checkerstats [COURSE ...] [days=N]
+
+    COURSE: only report on jobs from these courses (default: all courses)
+    days=N: only report on jobs which finished in the last N days
+"""
+
+CHECKERDRAIN_USAGE = """\
+Ask checkers to stop taking new jobs, and to exit once their running jobs are
+finished (their queued jobs are left for the other checkers).  With no
+arguments, list the checkers sharing the queue.
+
+    catsoop checkerdrain [WORKER ...]
+    catsoop checkerdrain all
+
+    WORKER: the name of a checker (HOSTNAME.PID), or just HOSTNAME to drain
+            all of the checkers on that machine
+"""
+
+REGRADE_USAGE = """\
+Re-run the checker on every user's most recent submission to some questions
+(e.g. after fixing a bug in a question's tests or solution), and report the
+scores which changed.  The jobs go in the checker's low-priority "regrade"
+lane (see cs_checker_lanes), and only a few are kept waiting at a time, so
+that live traffic is not affected.  The scores of users who submit again
+while the regrade is in progress are not touched.
+
+Progress is saved as jobs are enqueued, so an interrupted regrade continues
+where it left off when the same command is run again.
+
+    catsoop regrade COURSE PATH [QUESTION ...] [OPTION=VALUE ...]
+
+    COURSE: the name of the course
+    PATH: the path of the page within the course, separated by slashes
+    QUESTION: the names (csq_name) of the questions to regrade (default: all
+              of the questions on the page which have been submitted)
+
+    options:
+    users=U1,U2,...: only regrade these users (default: everyone with logs)
+    waiting=N: keep at most N regrade jobs waiting in the queue (default: 20)
+    rate=R: enqueue at most R jobs per second (default: no limit)
+    restart=1: discard the saved progress of a previous run, and start over
+"""
+
+# (column name, function computing it from a result row, format)
+METRICS = [
+    ("wait", lambda r: r["job_started"] - r["job_enqueued"], "%.2fs"),
+    ("wall", lambda r: r["job_complete"] - r["job_started"], "%.2fs"),
+    (
+        "cpu",
+        lambda r: sum(
+            r["resources"][k] for k in ("utime", "stime", "sandbox_utime", "sandbox_stime")
+        ),
+        "%.2fs",
+    ),
+    (
+        "maxrss",
+        lambda r: max(r["resources"]["maxrss"], r["resources"]["sandbox_maxrss"]) / 1024,
+        "%.0fM",
+    ),
+]
+
+PERCENTILES = (50, 90, 99, 100)
+
+
+def percentile(values, p):
+    """
+    Return the p-th percentile (nearest rank) of the given sorted list
+    """
+    if not values:
+        return None
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def job_metrics(row):
+    """
+    Return a dictionary of the METRICS which can be computed for the given
+    result row (older results, and jobs killed by the checker, lack some of
+    the fields)
+    """
+    out = {}
+    for name, func, _ in METRICS:
+        try:
+            out[name] = func(row)
+        except (KeyError, TypeError):
+            pass
+    return out
+
+
+def summarize(rows):
+    """
+    Group the given result rows by course and by question, and return a list
+    of (label, number of jobs, {metric: sorted values}) tuples, each course
+    followed by its questions
+    """
+    groups = collections.OrderedDict()
+    for row in rows:
+        path = row.get("path") or ["?"]
+        question = "%s:%s" % ("/".join(path), ",".join(row.get("names", [])))
+        metrics = job_metrics(row)
+        for label in (path[0], "  " + question):
+            g = groups.setdefault((path[0], label != path[0], label), [0, {}])
+            g[0] += 1
+            for k, v in metrics.items():
+                g[1].setdefault(k, []).append(v)
+    out = []
+    for (_, _, label), (n, values) in sorted(groups.items()):
+        out.append((label, n, {k: sorted(v) for k, v in values.items()}))
+    return out
+
+
+def format_summary(summary):
+    cols = [
+        "%s %s" % (name, "max" if p == 100 else "p%d" % p)
+        for (name, _, _) in METRICS
+        for p in PERCENTILES
+    ]
+    width = max([len(label) for (label, _, _) in summary] + [10])
+    lines = [
+        "%-*s %7s " % (width, "", "jobs") + " ".join("%10s" % c for c in cols)
+    ]
+    for label, n, values in summary:
+        cells = []
+        for name, _, fmt in METRICS:
+            for p in PERCENTILES:
+                x = percentile(values.get(name, []), p)
+                cells.append("%10s" % ("-" if x is None else fmt % x))
+        lines.append("%-*s %7d " % (width, label, n) + " ".join(cells))
+    return "\n".join(lines)
+
+
+def checker_stats(args):
+    if "-h" in args or "--help" in args:
+        print(CHECKERSTATS_USAGE, file=sys.stderr)
+        sys.exit(1)
+    since = None
+    courses = set()
+    for arg in args:
+        if arg.startswith("days="):
+            since = time.time() - float(arg.split("=", 1)[1]) * 86400
+        else:
+            courses.add(arg)
+
+    rows = csqueue.iter_results({}, since=since)
+    if courses:
+        rows = (r for r in rows if (r.get("path") or [None])[0] in courses)
+    summary = summarize(rows)
+    if not summary:
+        print("No finished checker jobs found")
+        return
+    print(format_summary(summary))
+
+
+def checker_drain(args):
+    if "-h" in args or "--help" in args:
+        print(CHECKERDRAIN_USAGE, file=sys.stderr)
+        sys.exit(1)
+    workers = csqueue.list_workers({})
+    if not args:
+        if not workers:
+            print("No checkers are running")
+        now = time.time()
+        for name, info in sorted(workers.items()):
+            print(
+                "%-40s running=%s last seen %.0fs ago%s"
+                % (
+                    name,
+                    info.get("running", "?"),
+                    now - info.get("seen", now),
+                    " (draining)" if info.get("drain") or info.get("draining") else "",
+                )
+            )
+        return
+    for name, info in sorted(workers.items()):
+        if "all" in args or name in args or info.get("host") in args:
+            csqueue.request_drain({}, name)
+            print("Asked %s to drain" % name)
+
+
+def _regrade_dir(course, path, names):
+    name = "__".join([course] + list(path) + sorted(names)) or "all"
+    return os.path.join(base_context.cs_data_root, "_logs", "_checker", "regrade", name)
+
+
+def regrade_users(context, course):
+    """
+    Return the names of the users who may have submissions in the given
+    course: those with a __USERS__ file, and those with logs
+    """
+    users = set()
+    try:
+        users.update(user.list_all_users(context, course))
+    except FileNotFoundError:
+        pass
+    log_dir = log_scripts._course_log_dir(course)
+    if cslog.ENCRYPT_KEY is None and os.path.isdir(log_dir):
+        users.update(
+            i for i in os.listdir(log_dir) if os.path.isdir(os.path.join(log_dir, i))
+        )
+    archive = cslog.get_archive(course)
+    if archive is not None and cslog.ENCRYPT_KEY is None:
+        users.update(key.split(os.sep, 1)[0] for key in archive.index)
+    return sorted(users)
+
+
+def plan_regrade(path, names, users):
+    """
+    Return a list of the jobs needed to regrade the given questions (all
+    submitted questions, if names is empty) on the page at the given path, for
+    the given users, as dicts with the keys "username", "name", "regrade_of"
+    (the magic of the submission being re-run), "old_score" and "job" (the job
+    description to enqueue)
+    """
+    out = []
+    for username in users:
+        state = cslog.most_recent(username, path, "problemstate", {})
+        submitted = state.get("last_submit_id", {})
+        for name in sorted(names or submitted):
+            if name not in submitted:
+                continue
+            form = {
+                k: v for k, v in state.get("last_submit", {}).items() if name in k
+            }
+            try:
+                when = cstime.unix(
+                    cstime.from_detailed_timestamp(
+                        state["last_submit_times"][name]
+                    )
+                )
+            except (KeyError, ValueError):
+                when = time.time()
+            job = {
+                "path": path,
+                "username": username,
+                "names": [name],
+                "form": form,
+                "time": when,  # graded as of the original submission time
+                "action": "submit",
+                "lane": "regrade",
+                "regrade_of": submitted[name],
+            }
+            out.append(
+                {
+                    "username": username,
+                    "name": name,
+                    "regrade_of": submitted[name],
+                    "old_score": state.get("scores", {}).get(name),
+                    "job": job,
+                }
+            )
+    return out
+
+
+def _save_progress(loc, progress):
+    with open(loc + ".tmp", "w") as f:
+        json.dump(progress, f)
+    os.replace(loc + ".tmp", loc)
+
+
+def enqueue_regrade(context, plan, progress, progress_file, waiting=20, rate=None):
+    """
+    Enqueue the jobs in the given plan which are not yet in progress (a dict
+    mapping "username/name" to a dict with the keys "magic" (of the regrade
+    job), "regrade_of" and "old_score", from the plan), throttled so that at
+    most waiting regrade jobs are in the queue at once, and at most rate jobs
+    are enqueued per second.  Progress is saved to progress_file.
+    """
+    last = 0
+    for ix, item in enumerate(plan):
+        key = "%s/%s" % (item["username"], item["name"])
+        if key in progress:
+            continue
+        while True:
+            nwaiting = sum(
+                1 for i in csqueue.list_waiting(context) if i["lane"] == "regrade"
+            )
+            if nwaiting < waiting:
+                break
+            time.sleep(1)
+        if rate:
+            time.sleep(max(0, last + 1.0 / rate - time.time()))
+        last = time.time()
+        progress[key] = {
+            "magic": csqueue.enqueue(context, dict(item["job"])),
+            "regrade_of": item["regrade_of"],
+            # saved now, since the problemstate will hold the new score once
+            # the job is finished (eg when resuming)
+            "old_score": item["old_score"],
+        }
+        _save_progress(progress_file, progress)
+        print(
+            "\r[regrade] %d/%d jobs enqueued" % (len(progress), len(plan)),
+            end="",
+            file=sys.stderr,
+        )
+    print(file=sys.stderr)
+
+
+def regrade_report(path, progress):
+    """
+    Return a tuple (finished, changed), where finished is the number of jobs in
+    progress (see enqueue_regrade) which have results, and changed is a list
+    of (username, question, old score, new score) for those whose score
+    changed.  Users who have submitted again since their job was enqueued
+    (whose scores the regrade left alone) are not included in changed.
+    """
+    finished = 0
+    changed = []
+    for key, item in sorted(progress.items()):
+        username, name = key.rsplit("/", 1)
+        result = csqueue.get_results(item["magic"])
+        if result is None:
+            continue
+        finished += 1
+        if result.get("score") == item["old_score"]:
+            continue
+        state = cslog.most_recent(username, path, "problemstate", {})
+        if state.get("last_submit_id", {}).get(name) != item["magic"]:
+            continue
+        changed.append((username, name, item["old_score"], result.get("score")))
+    return finished, changed
+
+
+def regrade(args):
+    options = dict(arg.split("=", 1) for arg in args if "=" in arg)
+    args = [arg for arg in args if "=" not in arg]
+    if len(args) < 2 or "-h" in args or "--help" in args:
+        print(REGRADE_USAGE, file=sys.stderr)
+        sys.exit(1)
+    course, path, names = args[0], [args[0]] + args[1].strip("/").split("/"), args[2:]
+
+    context = loader.generate_context([course])
+    if "users" in options:
+        users = options["users"].split(",")
+    else:
+        users = regrade_users(context, course)
+    plan = plan_regrade(path, names, users)
+    print("%d submissions to regrade" % len(plan))
+
+    outdir = _regrade_dir(course, path[1:], names)
+    os.makedirs(outdir, exist_ok=True)
+    progress_file = os.path.join(outdir, "progress.json")
+    progress = {}
+    if os.path.isfile(progress_file) and not options.get("restart"):
+        with open(progress_file) as f:
+            progress = json.load(f)
+        print("Resuming: %d jobs were already enqueued" % len(progress))
+
+    rate = float(options["rate"]) if "rate" in options else None
+    enqueue_regrade(
+        context,
+        plan,
+        progress,
+        progress_file,
+        waiting=int(options.get("waiting", 20)),
+        rate=rate,
+    )
+
+    while True:
+        finished, changed = regrade_report(path, progress)
+        print(
+            "\r[regrade] %d/%d jobs finished" % (finished, len(progress)),
+            end="",
+            file=sys.stderr,
+        )
+        if finished >= len(progress):
+            break
+        time.sleep(2)
+    print(file=sys.stderr)
+
+    report = os.path.join(outdir, "changed.csv")
+    with open(report, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["username", "question", "old_score", "new_score"])
+        writer.writerows(changed)
+    print("%d of %d scores changed; see %s" % (len(changed), len(progress), report))
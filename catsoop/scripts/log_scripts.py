@@ -19,13 +19,16 @@
 import os
 import ast
 import sys
+import lzma
 import shlex
 import pprint
 import shutil
 import tempfile
 import subprocess
+import multiprocessing
 
 from .. import cslog
+from .. import csqueue
 from .. import base_context
 
 LOGREAD_USAGE = """\
@@ -94,6 +97,42 @@ or:
              problemactions)
 """
 
+LOGCOMPACT_USAGE = """\
+Remove superseded entries from the logs of a course, according to a retention
+policy.  Safe to run while the server is live (each log is locked while it is
+being rewritten).  Not available when logs are encrypted.
+
+    catsoop logcompact COURSE [LOGNAME=N ...]
+
+    COURSE: the name of the course whose logs should be compacted
+    LOGNAME=N: keep only the N most recent entries of logs called LOGNAME
+               (overrides cs_log_retention, which defaults to keeping only the
+               most recent problemstate entry)
+"""
+
+LOGARCHIVE_USAGE = """\
+Pack all of the logs of a course into a single compressed, indexed archive
+file, and remove the individual log files from hot storage.  Archived logs can
+still be read; a log is moved back to hot storage the first time it is
+written to.  Running this again merges any new logs into the existing archive.
+Safe to run while the server is live.  Not available when logs are encrypted.
+
+    catsoop logarchive COURSE [LOGNAME=N ...]
+
+    COURSE: the name of the course whose logs should be archived
+    LOGNAME=N: keep only the N most recent entries of logs called LOGNAME
+               (overrides cs_log_retention)
+"""
+
+UPLOADGC_USAGE = """\
+Remove the stored copies of uploaded files which are no longer used by any
+upload (e.g., after old upload directories have been deleted), along with
+temporary files left behind by interrupted uploads.  Safe to run while the
+server is live.
+
+    catsoop uploadgc
+"""
+
 
 def _find_log(args):
     if len(args) == 1:
@@ -202,5 +241,180 @@ def log_edit(args):
             func(username, path, logname, e)
 
 
+def _retention_policy(args):
+    policy = dict(getattr(base_context, "cs_log_retention", {}))
+    for arg in args:
+        logname, n = arg.split("=", 1)
+        policy[logname] = int(n)
+    return policy
+
+
+def _course_log_dir(course):
+    return os.path.join(base_context.cs_data_root, "_logs", "_courses", course)
+
+
+def _user_log_files(course_dir, user):
+    """
+    Yield `(fname, key, lock_path)` for each log file belonging to the given
+    user in the given course.  The lock path is built from the file's name, so
+    this is only right for unencrypted logs.
+    """
+    root = os.path.join(course_dir, user)
+    course = os.path.basename(course_dir)
+    for dirpath, dirnames, filenames in os.walk(root):
+        for fn in sorted(filenames):
+            if not fn.endswith(".log"):
+                continue
+            fname = os.path.join(dirpath, fn)
+            key = os.path.relpath(fname, course_dir)
+            fields = key[:-4].split(os.sep)
+            yield fname, key, [fields[0], course] + fields[1:]
+
+
+def _apply_retention(frames, fname, policy):
+    keep = policy.get(os.path.basename(fname)[:-4])
+    if keep is not None and len(frames) > keep:
+        return frames[len(frames) - keep :]
+    return frames
+
+
+def _compact_user(args):
+    course_dir, user, policy = args
+    removed = 0
+    for fname, key, lock_path in _user_log_files(course_dir, user):
+        with cslog.log_lock(lock_path):
+            try:
+                with open(fname, "rb") as f:
+                    frames = list(cslog.iter_log_frames(f))
+            except FileNotFoundError:
+                continue
+            kept = _apply_retention(frames, fname, policy)
+            if len(kept) == len(frames):
+                continue
+            tmpname = "%s.compact" % fname
+            with open(tmpname, "wb") as f:
+                f.write(cslog.pack_log_frames(kept))
+            os.replace(tmpname, fname)
+            removed += len(frames) - len(kept)
+    return removed
+
+
+def _archive_user(args):
+    course_dir, user, policy = args
+    out = []
+    for fname, key, lock_path in _user_log_files(course_dir, user):
+        with cslog.log_lock(lock_path):
+            try:
+                with open(fname, "rb") as f:
+                    st = os.fstat(f.fileno())
+                    frames = list(cslog.iter_log_frames(f))
+            except FileNotFoundError:
+                continue
+        frames = _apply_retention(frames, fname, policy)
+        blob = lzma.compress(cslog.pack_log_frames(frames))
+        out.append((fname, key, lock_path, (st.st_mtime, st.st_size), blob))
+    return out
+
+
+def _run_parallel(func, course_dir, policy, label):
+    users = sorted(
+        i for i in os.listdir(course_dir) if os.path.isdir(os.path.join(course_dir, i))
+    )
+    jobs = [(course_dir, user, policy) for user in users]
+    with multiprocessing.Pool() as pool:
+        for ix, result in enumerate(pool.imap_unordered(func, jobs)):
+            print(
+                "\r[%s] %d/%d users processed" % (label, ix + 1, len(jobs)),
+                end="",
+                file=sys.stderr,
+            )
+            yield result
+    print(file=sys.stderr)
+
+
+def _check_course_args(args, usage):
+    if len(args) < 1 or "-h" in args or "--help" in args:
+        print(usage, file=sys.stderr)
+        sys.exit(1)
+    if cslog.ENCRYPT_KEY is not None:
+        # the names of encrypted log files can't be turned back into the
+        # usernames, paths and log names that the server locks on (or that
+        # retention policies name), so the logs could not be rewritten safely.
+        print(
+            "ERROR: logs are encrypted (CATSOOP_PASSPHRASE is set); "
+            "they cannot be compacted or archived",
+            file=sys.stderr,
+        )
+        sys.exit(1)
+    if not os.path.isdir(_course_log_dir(args[0])):
+        print("ERROR: no logs for course %s" % args[0], file=sys.stderr)
+        sys.exit(1)
+
+
+def log_compact(args):
+    _check_course_args(args, LOGCOMPACT_USAGE)
+    course_dir = _course_log_dir(args[0])
+    policy = _retention_policy(args[1:])
+    removed = sum(_run_parallel(_compact_user, course_dir, policy, "logcompact"))
+    print("Removed %d superseded log entries" % removed)
+
+
+def log_archive(args):
+    _check_course_args(args, LOGARCHIVE_USAGE)
+    course = args[0]
+    course_dir = _course_log_dir(course)
+    policy = _retention_policy(args[1:])
+
+    archived = []
+    for result in _run_parallel(_archive_user, course_dir, policy, "logarchive"):
+        archived.extend(result)
+
+    # logs that were archived previously, and that have not since been moved
+    # back to hot storage, are carried over into the new archive unchanged.
+    new_keys = {key for (_, key, _, _, _) in archived}
+    old = cslog.get_archive(course)
+    blobs = [(key, blob) for (_, key, _, _, blob) in archived]
+    if old is not None:
+        for key, (offset, length) in old.index.items():
+            if key not in new_keys:
+                blobs.append((key, bytes(old.data[offset : offset + length])))
+    blobs.sort()
+    fname = cslog.archive_location(course)
+    cslog.write_archive(fname, blobs)
+
+    # finally, remove the individual log files, unless they have been written
+    # to since we read them.
+    removed = 0
+    for logfile, key, lock_path, stamp, blob in archived:
+        with cslog.log_lock(lock_path):
+            try:
+                st = os.stat(logfile)
+            except FileNotFoundError:
+                continue
+            if (st.st_mtime, st.st_size) != stamp:
+                continue
+            os.unlink(logfile)
+            removed += 1
+        dname = os.path.dirname(logfile)
+        while dname != course_dir:
+            try:
+                os.rmdir(dname)
+            except OSError:
+                break
+            dname = os.path.dirname(dname)
+    print(
+        "Archived %d logs to %s (%d moved out of hot storage)"
+        % (len(blobs), fname, removed)
+    )
+
+
+def upload_gc(args):
+    if args:
+        print(UPLOADGC_USAGE, file=sys.stderr)
+        sys.exit(1)
+    removed, freed = csqueue.initialize().collect_file_uploads()
+    print("Removed %d unused files (%.1f MB)" % (removed, freed / 1e6))
+
+
 if __name__ == "__main__":
     main()
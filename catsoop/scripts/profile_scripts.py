@@ -0,0 +1,176 @@
+# This file is part of CAT-SOOP
+# Copyright (c) 2011-2019 by The CAT-SOOP Developers <catsoop-dev@mit.edu>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import time
+import pstats
+import collections
+
+from .. import profiling
+
+PROFILE_USAGE = """\
+Profile requests and/or checker jobs on a running server (no restart is
+needed), and report on where the time went.
+
+    catsoop profile start [kinds=KINDS] [courses=COURSES] [prefix=PATH]
+                          [every=N] [minutes=M]
+    catsoop profile stop
+    catsoop profile status
+    catsoop profile report [COURSE ...] [kind=KIND] [prefix=PATH] [days=N]
+                           [sort=KEY] [limit=N]
+
+start: start profiling (replacing any previous settings)
+    kinds=KINDS:     comma-separated kinds of work to profile, from "request"
+                     and "checker" (default: both)
+    courses=COURSES: comma-separated courses to profile (default: all)
+    prefix=PATH:     only profile pages under this path, e.g. 6.SAMP/questions
+    every=N:         only profile one in every N requests or jobs (default: 1)
+    minutes=M:       stop profiling after M minutes (default: 60; 0 means
+                     never)
+
+stop: stop profiling (saved profiles are kept)
+
+status: show the current profiling settings
+
+report: combine saved profiles, and show the time spent in each part of
+CAT-SOOP and of courses, followed by the most expensive functions
+    COURSE:      only include profiles for pages in these courses
+    kind=KIND:   only include profiles of this kind ("request" or "checker")
+    prefix=PATH: only include profiles for pages under this path
+    days=N:      only include profiles from the last N days
+    sort=KEY:    how to sort the functions, e.g. "tottime" or "cumulative"
+                 (default: cumulative)
+    limit=N:     show this many functions (default: 40)
+"""
+
+
+def _options(args):
+    opts = {}
+    rest = []
+    for arg in args:
+        if "=" in arg:
+            k, v = arg.split("=", 1)
+            opts[k] = v
+        else:
+            rest.append(arg)
+    return opts, rest
+
+
+def _list(value):
+    return [i for i in value.split(",") if i] or None
+
+
+def start(args):
+    opts, rest = _options(args)
+    if rest:
+        raise ValueError("unexpected arguments: %s" % " ".join(rest))
+    kinds = _list(opts.get("kinds", ",".join(profiling.KINDS))) or []
+    for kind in kinds:
+        if kind not in profiling.KINDS:
+            raise ValueError("unknown kind of work: %s" % kind)
+    minutes = float(opts.get("minutes", 60))
+    settings = {
+        "kinds": kinds,
+        "courses": _list(opts.get("courses", "")),
+        "prefix": opts.get("prefix") or None,
+        "every": max(int(opts.get("every", 1)), 1),
+        "until": (time.time() + minutes * 60) if minutes > 0 else None,
+    }
+    profiling.write_settings(settings)
+    return settings
+
+
+def describe(settings):
+    if settings is None:
+        return "Not profiling"
+    until = settings.get("until")
+    if until is not None and until < time.time():
+        return "Not profiling (stopped at %s)" % time.ctime(until)
+    out = ["Profiling %s" % " and ".join(settings.get("kinds", profiling.KINDS))]
+    if settings.get("courses"):
+        out.append("  courses: %s" % ", ".join(settings["courses"]))
+    if settings.get("prefix"):
+        out.append("  under: %s" % settings["prefix"])
+    out.append("  one in every %d" % (settings.get("every") or 1))
+    out.append("  until: %s" % ("stopped" if until is None else time.ctime(until)))
+    return "\n".join(out)
+
+
+def by_source(stats):
+    """
+    Add up the time spent in each part of CAT-SOOP and of courses (see
+    `profiling.source_group`), not including time spent in functions called
+    from there.
+
+    **Returns:** a list of `(group, time in seconds)` tuples, largest first
+    """
+    totals = collections.defaultdict(float)
+    for (filename, _, _), (_, _, tt, _, _) in stats.stats.items():
+        totals[profiling.source_group(filename)] += tt
+    return sorted(totals.items(), key=lambda i: (-i[1], i[0]))
+
+
+def report(args, out=None):
+    out = out or sys.stdout
+    opts, courses = _options(args)
+    since = None
+    if "days" in opts:
+        since = time.time() - float(opts["days"]) * 86400
+    kinds = [opts["kind"]] if "kind" in opts else profiling.KINDS
+    found = profiling.find_profiles(since, kinds, courses, opts.get("prefix"))
+    if not found:
+        print("No saved profiles found", file=out)
+        return
+    stats = pstats.Stats(found[0][0], stream=out)
+    for prof, _ in found[1:]:
+        stats.add(prof)
+    total = sum(info.get("duration", 0) for _, info in found)
+    print(
+        "%d profiles, %.1fs in total (%.1fms each on average)"
+        % (len(found), total, total / len(found) * 1000),
+        file=out,
+    )
+    print("\nTime by source (not including functions called elsewhere):", file=out)
+    for group, t in by_source(stats):
+        share = t / total * 100 if total else 0
+        print("    %9.1fms  %5.1f%%  %s" % (t * 1000, share, group), file=out)
+    print(file=out)
+    stats.sort_stats(opts.get("sort", "cumulative")).print_stats(
+        int(opts.get("limit", 40))
+    )
+
+
+def profile(args):
+    if not args or "-h" in args or "--help" in args:
+        print(PROFILE_USAGE, file=sys.stderr)
+        sys.exit(1)
+    cmd, args = args[0], args[1:]
+    try:
+        if cmd == "start":
+            print(describe(start(args)))
+        elif cmd == "stop":
+            profiling.write_settings(None)
+            print("Not profiling")
+        elif cmd == "status":
+            print(describe(profiling.read_settings()))
+        elif cmd == "report":
+            report(args)
+        else:
+            print(PROFILE_USAGE, file=sys.stderr)
+            sys.exit(1)
+    except ValueError as e:
+        print("catsoop profile: %s" % e, file=sys.stderr)
+        sys.exit(1)
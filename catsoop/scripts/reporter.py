@@ -50,7 +50,6 @@ def log(msg):
 
 
 async def reporter(websocket, path):
-    csqueue.initialize()
     DEBUG = True
     if DEBUG:
         LOGGER.error("Waiting for websocket recv")
@@ -114,7 +113,6 @@ async def reporter(websocket, path):
 
 
 def updater():
-    csqueue.initialize()
     csqueue.update_current_job_status()
     loop.call_later(0.3, updater)
 
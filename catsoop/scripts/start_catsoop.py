@@ -56,12 +56,13 @@ def main():
     # Make sure the checker database is set up
     checker_db_loc = os.path.join(base_context.cs_data_root, "_logs", "_checker")
 
-    for subdir in ("queued", "running", "results", "staging"):
+    for subdir in ("queued", "running", "results", "staging", "leases", "workers"):
         os.makedirs(os.path.join(checker_db_loc, subdir), exist_ok=True)
 
     procs = [
         (scripts_dir, [sys.executable, "checker.py"], 0.1, "Checker"),
         (scripts_dir, [sys.executable, "reporter.py"], 0.1, "Reporter"),
+        (scripts_dir, [sys.executable, "lti_outbox.py"], 0.1, "LTI Outbox"),
     ]
 
     # put plugin autostart scripts into the list
@@ -95,7 +96,12 @@ def main():
             procs.append(
                 (
                     scripts_dir,
-                    [sys.executable, "wsgi_server.py", str(port)],
+                    [
+                        sys.executable,
+                        "wsgi_server.py",
+                        str(port),
+                        str(base_context.cs_wsgi_server_workers),
+                    ],
                     0.1,
                     "WSGI Server at Port %d" % port,
                 )
@@ -156,13 +162,22 @@ def main():
 
     def _kill_children():
         for ix, i in enumerate(running):
-            os.kill(i.pid, signal.SIGTERM)
+            if i.poll() is None:
+                os.kill(i.pid, signal.SIGTERM)
 
     atexit.register(_kill_children)
 
+    finished = set()
     while True:
         for idx, (procinfo, proc) in enumerate(zip(procs, running)):	# restart running process if it has died
-            if proc.poll() is not None:
+            if idx in finished:
+                continue
+            if proc.poll() == 0:
+                # a clean exit is deliberate (e.g. a checker which was asked
+                # to drain), so don't restart it
+                LOGGER.error('[start_catsoop] %s (pid=%s) exited, not restarting it' % (procinfo[3], proc.pid))
+                finished.add(idx)
+            elif proc.poll() is not None:
                 (wd, cmd, slp, name) = procinfo
                 LOGGER.error('[start_catsoop] %s (pid=%s) was killed, restarting it' % (name, proc.pid))
                 running[idx] = subprocess.Popen(cmd, cwd=wd, preexec_fn=set_pdeathsig(signal.SIGTERM))
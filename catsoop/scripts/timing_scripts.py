@@ -0,0 +1,125 @@
+# This file is part of CAT-SOOP
+# Copyright (c) 2011-2019 by The CAT-SOOP Developers <catsoop-dev@mit.edu>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import time
+import collections
+
+from .. import timing
+from .checker_scripts import percentile
+
+REQUESTSTATS_USAGE = """\
+Summarize the logged timing of requests (see cs_slow_request_threshold and
+cs_request_timing_sample): the total time taken, and the time spent in each
+phase of handling a request, as percentiles per phase and per course and
+page.
+
+    catsoop requeststats [COURSE ...] [days=N] [slow=1]
+
+    COURSE: only report on requests for pages in these courses (default: all
+            requests)
+    days=N: only report on requests made in the last N days
+    slow=1: only report on requests slower than cs_slow_request_threshold
+            (by default, the sample of all requests is included)
+"""
+
+PERCENTILES = (50, 95, 99)
+
+PHASES = [
+    "form",
+    "config",
+    "session",
+    "preload",
+    "auth",
+    "content",
+    "handler",
+    "render",
+    "session_save",
+    "other",
+]
+
+
+def summarize(entries):
+    """
+    Group the given log entries by course and by page, and return a list of
+    (label, number of requests, {phase: sorted times}) tuples, starting with
+    all requests (labelled "all"), and with each course followed by its
+    pages (indented).  The total time of each request is given as the phase "total".
+    """
+    groups = {}
+    for entry in entries:
+        path = entry.get("path") or ""
+        course = path.split("/", 1)[0] or "/"
+        page = "  " + (path or "/")
+        keys = [("", False, "all"), (course, False, course), (course, True, page)]
+        for key in keys:
+            g = groups.setdefault(key, [0, collections.defaultdict(list)])
+            g[0] += 1
+            g[1]["total"].append(entry["total"])
+            for phase, t in entry.get("phases", {}).items():
+                g[1][phase].append(t)
+    out = []
+    for (_, _, label), (n, values) in sorted(groups.items()):
+        out.append((label, n, {k: sorted(v) for k, v in values.items()}))
+    return out
+
+
+def format_summary(summary):
+    phases = {p for (_, _, values) in summary for p in values}
+    phases = ["total"] + [p for p in PHASES if p in phases] + sorted(
+        phases - set(PHASES) - {"total"}
+    )
+    lines = []
+    for label, n, values in summary:
+        lines.append("%s (%d requests)" % (label, n))
+        lines.append(
+            "    %-12s " % "" + " ".join("%9s" % ("p%d" % p) for p in PERCENTILES)
+        )
+        for phase in phases:
+            if phase not in values:
+                continue
+            cells = [
+                "%8.1fms" % (percentile(values[phase], p) * 1000) for p in PERCENTILES
+            ]
+            lines.append("    %-12s " % phase + " ".join(cells))
+    return "\n".join(lines)
+
+
+def request_stats(args):
+    if "-h" in args or "--help" in args:
+        print(REQUESTSTATS_USAGE, file=sys.stderr)
+        sys.exit(1)
+    since = None
+    slow_only = False
+    courses = set()
+    for arg in args:
+        if arg.startswith("days="):
+            since = time.time() - float(arg.split("=", 1)[1]) * 86400
+        elif arg.startswith("slow="):
+            slow_only = arg.split("=", 1)[1] not in {"0", "false", "False"}
+        else:
+            courses.add(arg)
+
+    entries = timing.read_log(since)
+    if courses:
+        entries = (e for e in entries if e.get("course") in courses)
+    if slow_only:
+        entries = (e for e in entries if e.get("slow"))
+    summary = summarize(entries)
+    if not summary:
+        print("No logged requests found")
+        return
+    print(format_summary(summary))
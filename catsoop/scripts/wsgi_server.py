@@ -14,18 +14,316 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+"""
+Serve CAT-SOOP's WSGI application with cheroot.
+
+Run as `python wsgi_server.py PORT [WORKERS]`.  With one worker (the default),
+this is a single cheroot server.  With more, this process binds PORT, imports
+the application and renders the root page and each course's main page once
+(so that the modules and files they need are loaded, and shared with the
+workers), and then forks WORKERS servers which all accept connections from
+that one listening socket, so that rendering pages is not limited to one core
+by the GIL.
+
+Each worker sends this process a heartbeat every few seconds while it is
+serving and able to take requests (ie unless all of its threads have been
+stuck on the same requests for a long time); workers which exit, or which stop
+sending heartbeats, are replaced.
+On SIGHUP, this process runs itself again (picking up new code and
+configuration) without closing the listening socket, and the old workers are
+asked to finish the requests they are handling and exit only once the new
+workers are running.
+"""
+
 import os
 import sys
+import time
+import select
+import signal
+import socket
+import threading
+import traceback
 
 from catsoop.wsgi import application
+from catsoop.process import set_pdeathsig
 from cheroot import wsgi
 
 PORT_NUMBER = int(sys.argv[1])
+WORKERS = int(sys.argv[2]) if len(sys.argv) > 2 else 1
 
 CATSOOP_LOC = os.path.abspath(os.path.join(os.path.dirname(__file__), "../.."))
 print("[wsgi_server] CATSOOP_LOC=%s" % CATSOOP_LOC)
 
-addr = "0.0.0.0", PORT_NUMBER
-# addr = "127.0.0.1", PORT_NUMBER
-server = wsgi.Server(addr, application)
-server.start()
+HEARTBEAT = 5  # seconds between heartbeats from a worker
+HEARTBEAT_TIMEOUT = 60  # replace a worker after this long without a heartbeat
+STUCK_TIMEOUT = 60  # a request running for this long has probably hung
+STOP_TIMEOUT = 30  # seconds a worker gets to finish its requests when stopping
+
+# used to hand the listening socket and the old workers across a reload
+SOCKET_VAR = "CATSOOP_WSGI_SOCKET"
+OLD_WORKERS_VAR = "CATSOOP_WSGI_OLD_WORKERS"
+
+
+def log(msg):
+    print("[wsgi_server] %s" % msg, flush=True)
+
+
+class InheritedSocketServer(wsgi.Server):
+    """
+    A cheroot server which accepts connections on an already-listening socket
+    (shared with the other workers) rather than binding its own.
+    """
+
+    def __init__(self, sock, app, **kwargs):
+        self.listener = sock
+        wsgi.Server.__init__(self, sock.getsockname()[:2], app, **kwargs)
+
+    def bind(self, family, type, proto=0):
+        self.socket = self.listener
+        return self.socket
+
+
+class RequestTracker:
+    """
+    Wraps a WSGI application, keeping track of when each request in progress
+    (including sending its response) started.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.started = {}
+
+    def __call__(self, environ, start_response):
+        key = object()
+        self.started[key] = time.time()
+        response = None
+        try:
+            response = self.app(environ, start_response)
+            yield from response
+        finally:
+            self.started.pop(key, None)
+            if hasattr(response, "close"):
+                response.close()
+
+    def stuck(self, nthreads):
+        """
+        Return True if at least nthreads requests have been in progress for
+        longer than STUCK_TIMEOUT, ie if all of the server's threads are stuck
+        (on hung requests, or in a deadlock) and no others can be served.
+        """
+        cutoff = time.time() - STUCK_TIMEOUT
+        return sum(t < cutoff for t in list(self.started.values())) >= nthreads
+
+
+def listening_socket(port):
+    if SOCKET_VAR in os.environ:
+        sock = socket.socket(fileno=int(os.environ.pop(SOCKET_VAR)))
+        sock.set_inheritable(False)
+        return sock
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("0.0.0.0", port))
+    sock.listen(socket.SOMAXCONN)
+    return sock
+
+
+def warm_up():
+    """
+    Render the root page and the main page of each course once, so that the
+    modules, templates and preloads they use are loaded before forking.
+    """
+    from catsoop import tutor
+
+    start = time.time()
+    paths = ["/"]
+    try:
+        paths.extend("/%s" % c for c in sorted(tutor.available_courses()))
+    except Exception:
+        pass
+    for path in paths:
+        environ = {"PATH_INFO": path, "REQUEST_METHOD": "GET"}
+        try:
+            for _ in application(environ, lambda status, headers: None):
+                pass
+        except Exception:
+            log("error warming up %s:\n%s" % (path, traceback.format_exc()))
+    log("warmed up %d page(s) in %.2fs" % (len(paths), time.time() - start))
+
+
+def run_worker(sock, heartbeat_fd):
+    set_pdeathsig(signal.SIGTERM)()
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    tracker = RequestTracker(application)
+    server = InheritedSocketServer(
+        sock, tracker, request_queue_size=socket.SOMAXCONN
+    )
+    server.shutdown_timeout = STOP_TIMEOUT
+
+    stopper = threading.Thread(target=server.stop)
+
+    def stop(signum, frame):
+        # stop() waits for the requests in progress, so not in this thread
+        if not stopper.is_alive() and server.ready:
+            stopper.start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    def heartbeat():
+        stuck = False
+        while True:
+            time.sleep(HEARTBEAT)
+            if not server.ready:
+                continue
+            if tracker.stuck(server.numthreads):
+                # no heartbeat, so that this worker is replaced
+                if not stuck:
+                    log("worker pid=%s: all threads stuck on requests" % os.getpid())
+                stuck = True
+                continue
+            stuck = False
+            try:
+                os.write(heartbeat_fd, b".")
+            except BlockingIOError:
+                pass
+            except OSError:
+                return  # the parent has gone away (or been reloaded)
+
+    threading.Thread(target=heartbeat, daemon=True).start()
+    status = 0
+    try:
+        server.start()
+    except BaseException:
+        traceback.print_exc()
+        status = 1
+    finally:
+        if stopper.is_alive():
+            stopper.join()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(status)
+
+
+def serve_forked(port, nworkers):
+    sock = listening_socket(port)
+    warm_up()
+
+    workers = {}  # pid -> [heartbeat pipe, time of last heartbeat, start time]
+    stopping = {}  # pid -> time at which to kill it
+    flags = set()
+
+    def spawn():
+        r, w = os.pipe()
+        os.set_blocking(w, False)
+        pid = os.fork()
+        if pid == 0:
+            os.close(r)
+            for info in workers.values():
+                os.close(info[0])
+            run_worker(sock, w)
+        os.close(w)
+        now = time.time()
+        workers[pid] = [r, now, now]
+        log("started worker pid=%s" % pid)
+
+    def retire(pid, sig=signal.SIGTERM):
+        info = workers.pop(pid, None)
+        if info is not None:
+            os.close(info[0])
+        stopping.setdefault(pid, time.time() + STOP_TIMEOUT)
+        try:
+            os.kill(pid, sig)
+        except ProcessLookupError:
+            pass
+
+    for sig in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, lambda signum, frame: flags.add(signum))
+
+    for _ in range(nworkers):
+        spawn()
+    # workers left over from before a reload can stop now
+    for pid in os.environ.pop(OLD_WORKERS_VAR, "").split():
+        retire(int(pid))
+
+    respawn_after = 0
+    while True:
+        if signal.SIGHUP in flags:
+            log("reloading")
+            os.environ[SOCKET_VAR] = str(sock.fileno())
+            os.environ[OLD_WORKERS_VAR] = " ".join(
+                str(i) for i in list(workers) + list(stopping)
+            )
+            sock.set_inheritable(True)
+            os.execv(
+                sys.executable,
+                [sys.executable, os.path.abspath(__file__)] + sys.argv[1:],
+            )
+        if flags & {signal.SIGTERM, signal.SIGINT}:
+            break
+
+        fds = {info[0]: pid for pid, info in workers.items()}
+        ready, _, _ = select.select(list(fds), [], [], 1)
+        now = time.time()
+        for fd in ready:
+            if os.read(fd, 4096):
+                workers[fds[fd]][1] = now
+
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            stopping.pop(pid, None)
+            if pid in workers:
+                log("worker pid=%s exited (status %s)" % (pid, status))
+                if now - workers[pid][2] < HEARTBEAT:
+                    # don't spin if workers die as soon as they start
+                    respawn_after = now + 1
+                os.close(workers.pop(pid)[0])
+
+        for pid, info in list(workers.items()):
+            if now - info[1] > HEARTBEAT_TIMEOUT:
+                log("worker pid=%s stopped responding, killing it" % pid)
+                retire(pid, signal.SIGKILL)
+        for pid, deadline in stopping.items():
+            if now > deadline:
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+
+        while len(workers) < nworkers and now >= respawn_after:
+            spawn()
+
+    log("stopping")
+    for pid in list(workers):
+        retire(pid)
+    sock.close()
+    while stopping:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            break
+        if pid:
+            stopping.pop(pid, None)
+            continue
+        for pid, deadline in stopping.items():
+            if time.time() > deadline:
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+        time.sleep(0.1)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    os.kill(os.getpid(), signal.SIGTERM)
+
+
+if WORKERS > 1:
+    serve_forked(PORT_NUMBER, WORKERS)
+else:
+    addr = "0.0.0.0", PORT_NUMBER
+    # addr = "127.0.0.1", PORT_NUMBER
+    server = wsgi.Server(addr, application)
+    server.start()
@@ -21,8 +21,11 @@ import os
 import re
 import time
 import uuid
+import pickle
+import threading
 import traceback
 import importlib
+import collections
 
 from http.cookies import SimpleCookie
 
@@ -52,6 +55,23 @@ SESSION_DIR = os.path.join(base_context.cs_data_root, "_sessions")
 The directory where sessions will be stored.
 """
 
+CACHE_SIZE = 1024
+"""
+Number of sessions whose data each process keeps in memory, to avoid reading
+and decrypting them again while they are unchanged on disk.
+"""
+
+TOUCH_INTERVAL = 60
+"""
+Sessions whose data has not changed are not written back to disk, but the
+modification times of their files (which determine when they expire) are
+updated at most once every this many seconds.
+"""
+
+_CACHE = collections.OrderedDict()  # sid -> (file key, pickled data)
+_CACHE_LOCK = threading.Lock()
+
+
 def new_session_id():
     """
     Returns a new session ID
@@ -105,6 +125,46 @@ def get_session_id(environ):
         return new_session_id(), True
 
 
+def _file_key(fname):
+    # sessions are rewritten by replacing their files (see
+    # cslog.write_log_file), so a file with the same inode, size and
+    # modification time has the same contents
+    try:
+        st = os.stat(fname)
+    except OSError:
+        return None
+    return st.st_ino, st.st_size, st.st_mtime_ns
+
+
+def _on_disk():
+    # sessions stored in a database have no files to check, so they are
+    # neither cached nor left unwritten
+    return isinstance(cslog.initialize(), cslog.CatsoopLogsWithFilesystem)
+
+
+def _cache_put(sid, key, raw):
+    with _CACHE_LOCK:
+        _CACHE[sid] = key, raw
+        _CACHE.move_to_end(sid)
+        while len(_CACHE) > CACHE_SIZE:
+            _CACHE.popitem(last=False)
+
+
+def _touch(sid, fname, key):
+    if time.time() - key[2] / 1e9 < TOUCH_INTERVAL:
+        return
+    try:
+        os.utime(fname)
+    except OSError:
+        return
+    new_key = _file_key(fname)
+    with _CACHE_LOCK:
+        cached = _CACHE.get(sid)
+        if cached is not None and cached[0] == key and new_key is not None:
+            if new_key[:2] == key[:2]:  # the file was not replaced meanwhile
+                _CACHE[sid] = new_key, cached[1]
+
+
 def get_session_data(context, sid):
     """
     Returns the session data associated with a given session ID
@@ -117,13 +177,34 @@ def get_session_data(context, sid):
     **Returns:** a dictionary mapping session variables to their values
     """
     fname = os.path.join(SESSION_DIR, sid)
-    return cslog.read_log_file(fname)
+    key = _file_key(fname) if _on_disk() else None
+    raw = None
+    if key is not None:
+        with _CACHE_LOCK:
+            cached = _CACHE.get(sid)
+            if cached is not None and cached[0] == key:
+                _CACHE.move_to_end(sid)
+                raw = cached[1]
+    if raw is None:
+        data = cslog.read_log_file(fname)
+        raw = pickle.dumps(data, -1)
+        if key is not None and _file_key(fname) == key:
+            _cache_put(sid, key, raw)
+    else:
+        data = pickle.loads(raw)
+    # remembered so that set_session_data can tell whether the data changed
+    context["_cs_session_snapshot"] = sid, raw
+    return data
 
 
 def set_session_data(context, sid, data):
     """
     Replaces a given session's data with the dictionary provided
 
+    If the data are the same as they were when `get_session_data` read them
+    (for the same request), the session is not written again; only the
+    modification time of its file is updated, so that it does not expire.
+
     **Parameters:**
 
     * `context`: the context associated with this request
@@ -133,4 +214,13 @@ def set_session_data(context, sid, data):
     **Returns:** `None`
     """
     fname = os.path.join(SESSION_DIR, sid)
+    raw = pickle.dumps(data, -1)
+    if context.get("_cs_session_snapshot") == (sid, raw) and _on_disk():
+        key = _file_key(fname)
+        if key is not None:
+            _touch(sid, fname, key)
+            return
     cslog.write_log_file(fname, data)
+    context["_cs_session_snapshot"] = sid, raw
+    with _CACHE_LOCK:
+        _CACHE.pop(sid, None)
@@ -19,12 +19,25 @@ Unit tests for CAT-SOOP
 Requires config to be setup, including cs_unit_test_course
 """
 
+import os
+import io
+import gzip
+import time
+import zlib
+import shutil
 import unittest
 
 from catsoop import cslog
+from catsoop import assets
 from catsoop import loader
 from catsoop import session
+from catsoop import wsgi
+from catsoop import timing
 from catsoop import dispatch
+from catsoop import profiling
+from catsoop import base_context
+from catsoop.scripts import timing_scripts
+from catsoop.scripts import profile_scripts
 
 from ..test import CATSOOPTest
 
@@ -58,6 +71,309 @@ class Test_Basic(CATSOOPTest):
         print("cs_user_info=%s" % context['cs_user_info'])
         assert cui["role"] == "Guest"
 
+    def test_static_caching(self):
+        env = {"PATH_INFO": "/_static/_base/scripts/cs_math.js"}
+        status, headers, body = dispatch.main(env)
+        self.assertEqual(status[0], "200")
+        self.assertEqual(headers["Cache-Control"], "no-cache")
+        self.assertEqual(int(headers["Content-length"]), len(body))
+
+        # the same ETag in every process, and both kinds of conditional request
+        self.assertEqual(dispatch.main(dict(env))[1]["ETag"], headers["ETag"])
+        for cond in (
+            {"HTTP_IF_NONE_MATCH": 'W/"x", %s' % headers["ETag"]},
+            {"HTTP_IF_MODIFIED_SINCE": headers["Last-Modified"]},
+        ):
+            self.assertEqual(dispatch.main(dict(env, **cond))[0][0], "304")
+        status = dispatch.main(dict(env, HTTP_IF_NONE_MATCH='"x"'))[0]
+        self.assertEqual(status[0], "200")
+
+        # versioned URLs for files shipped with CAT-SOOP can be cached forever
+        context = {}
+        loader.load_global_data(context)
+        url = dispatch.get_real_url(context, "BASE/scripts/cs_math.js")
+        self.assertIn("/_static/_base/scripts/cs_math.js?v=", url)
+        qstring = url.split("?", 1)[1]
+        status, headers, _ = dispatch.main(dict(env, QUERY_STRING=qstring))
+        self.assertIn("immutable", headers["Cache-Control"])
+        status, headers, _ = dispatch.main(dict(env, QUERY_STRING="v=old"))
+        self.assertEqual(headers["Cache-Control"], "no-cache")
+
+    def test_not_modified_since_timezones(self):
+        mtime = 1700000000
+        old_tz = os.environ.get("TZ")
+        os.environ["TZ"] = "Etc/GMT-12"  # far from UTC
+        time.tzset()
+        try:
+            for header in (
+                "Tue, 14 Nov 2023 22:13:20 GMT",
+                "Tue, 14 Nov 2023 22:13:20 -0000",
+                "Tuesday, 14-Nov-23 22:13:20 GMT",
+                "Wed, 15 Nov 2023 10:13:20 +1200",
+            ):
+                self.assertTrue(dispatch._not_modified_since(header, mtime), header)
+            for header in (
+                "Tue, 14 Nov 2023 22:13:19 -0000",
+                "Tue, 14 Nov 2023 22:13:19 GMT",
+            ):
+                self.assertFalse(dispatch._not_modified_since(header, mtime), header)
+        finally:
+            if old_tz is None:
+                del os.environ["TZ"]
+            else:
+                os.environ["TZ"] = old_tz
+            time.tzset()
+
+    def test_static_range(self):
+        env = {"PATH_INFO": "/_static/_base/scripts/cs_math.js"}
+        full = dispatch.main(env)[2]
+        for spec, part in (
+            ("bytes=10-19", full[10:20]),
+            ("bytes=-5", full[-5:]),
+            ("bytes=%d-" % (len(full) - 3), full[-3:]),
+        ):
+            status, headers, body = dispatch.main(dict(env, HTTP_RANGE=spec))
+            self.assertEqual(status[0], "206")
+            self.assertEqual(body, part)
+            self.assertEqual(headers["Content-length"], str(len(part)))
+
+        status, headers, _ = dispatch.main(
+            dict(env, HTTP_RANGE="bytes=%d-" % len(full))
+        )
+        self.assertEqual(status[0], "416")
+        self.assertEqual(headers["Content-Range"], "bytes */%d" % len(full))
+        for ignored in (
+            {"HTTP_RANGE": "bytes=0-1,5-6"},
+            {"HTTP_RANGE": "bytes=0-1", "HTTP_IF_RANGE": '"x"'},
+        ):
+            self.assertEqual(dispatch.main(dict(env, **ignored))[2], full)
+
+        # large files are handed to the server as open files, and ranges of
+        # them are streamed
+        fname = dispatch.static_file_location({}, ["_base", "scripts", "cs_math.js"])
+        _, _, f = dispatch.serve_static_file({}, fname, stream=True)
+        with f:
+            self.assertEqual(f.read(), full)
+        _, _, out = dispatch.serve_static_file(
+            {}, fname, {"HTTP_RANGE": "bytes=1-"}, stream=True, streamchunk=7
+        )
+        self.assertEqual(b"".join(out), full[1:])
+
+    def test_fingerprinted_assets(self):
+        context = {}
+        loader.load_global_data(context)
+        fname = dispatch.static_file_location(
+            context, ["_handler", "default", "cs_ajax.js"]
+        )
+        url = dispatch.get_real_url(context, "_handler/default/cs_ajax.js")
+        hashed = assets.hashed_name(fname)
+        self.assertTrue(url.endswith("/_static/_handler/default/%s" % hashed))
+
+        env = {"PATH_INFO": "/_static/_handler/default/%s" % hashed}
+        status, headers, body = dispatch.main(env)
+        self.assertEqual(status[0], "200")
+        self.assertIn("immutable", headers["Cache-Control"])
+        with open(fname, "rb") as f:
+            self.assertEqual(body, f.read())
+
+        # a page rendered before the file changed still gets the file
+        env = {"PATH_INFO": "/_static/_handler/default/cs_ajax.0123456789ab.js"}
+        status, headers, stale = dispatch.main(env)
+        self.assertEqual((status[0], headers["Cache-Control"]), ("200", "no-cache"))
+        self.assertEqual(stale, body)
+        env["PATH_INFO"] = "/_static/_handler/default/nothere.0123456789ab.js"
+        self.assertEqual(dispatch.main(env)[0][0], "404")
+
+    def test_gzipped_assets(self):
+        env = {"PATH_INFO": "/_static/_handler/default/cs_ajax.js"}
+        _, plain_headers, plain = dispatch.main(env)
+        self.assertEqual(plain_headers["Vary"], "Accept-Encoding")
+        self.assertNotIn("Content-Encoding", plain_headers)
+
+        for accept in ("gzip, deflate, br", "identity;q=1, gzip;q=0.5"):
+            env2 = dict(env, HTTP_ACCEPT_ENCODING=accept)
+            status, headers, body = dispatch.main(env2)
+            self.assertEqual(headers["Content-Encoding"], "gzip")
+            self.assertEqual(gzip.decompress(body), plain)
+            self.assertEqual(headers["Content-length"], str(len(body)))
+            self.assertNotEqual(headers["ETag"], plain_headers["ETag"])
+        cond = dict(env2, HTTP_IF_NONE_MATCH=headers["ETag"])
+        self.assertEqual(dispatch.main(cond)[0][0], "304")
+
+        images = os.path.join(base_context.cs_fs_root, "__STATIC__", "images")
+        for env2 in (
+            dict(env, HTTP_ACCEPT_ENCODING="gzip;q=0"),
+            dict(env, HTTP_ACCEPT_ENCODING="gzip", HTTP_RANGE="bytes=0-9"),
+            {
+                "PATH_INFO": "/_static/_base/images/%s" % os.listdir(images)[0],
+                "HTTP_ACCEPT_ENCODING": "gzip",
+            },
+        ):
+            self.assertNotIn("Content-Encoding", dispatch.main(env2)[1])
+
+        nfiles, ncompressed, before, after = assets.build()
+        self.assertGreater(nfiles, ncompressed)
+        self.assertGreater(ncompressed, 0)
+        self.assertLess(after, before)
+
+    def test_response_compression(self):
+        def get(env):
+            started = []
+            body = wsgi.application(env, lambda *a: started.append(a))
+            return dict(started[0][1]), b"".join(body)
+
+        env = {"PATH_INFO": "/%s/structure" % self.cname}
+        headers, plain = get(env)
+        self.assertNotIn("Content-Encoding", headers)
+        self.assertEqual(headers["Vary"], "Accept-Encoding")
+        headers, body = get(dict(env, HTTP_ACCEPT_ENCODING="gzip"))
+        self.assertEqual(headers["Content-Encoding"], "gzip")
+        self.assertEqual(headers["Content-length"], str(len(body)))
+        self.assertIn(b"6.SAMP", gzip.decompress(body))
+        self.assertLess(len(body), len(plain) / 2)
+
+        # streamed bodies are compressed as they are produced
+        gz = {"HTTP_ACCEPT_ENCODING": "gzip"}
+        pieces = ["x" * 2000, b"y" * 2000]
+        headers = {"Content-type": "application/json", "Content-length": "4000"}
+        out = list(wsgi.compress_response(gz, ("200", "OK"), headers, iter(pieces)))
+        self.assertNotIn("Content-length", headers)
+        self.assertEqual(zlib.decompressobj(31).decompress(out[0]), b"x" * 2000)
+        self.assertEqual(gzip.decompress(b"".join(out)), b"x" * 2000 + b"y" * 2000)
+
+        # small, already-encoded, binary and partial responses are left alone
+        html = {"Content-type": "text/html"}
+        for status, headers, content in (
+            (("200", "OK"), html, b"short"),
+            (("200", "OK"), dict(html, **{"Content-Encoding": "br"}), b"x" * 2000),
+            (("200", "OK"), {"Content-type": "image/png"}, b"x" * 2000),
+            (("304", "Not Modified"), html, b"x" * 2000),
+        ):
+            out = wsgi.compress_response(gz, status, dict(headers), content)
+            self.assertEqual(out, content)
+
+    def test_session_writes(self):
+        sid = "0123456789abcdef0123456789abcdef"
+        fname = os.path.join(session.SESSION_DIR, sid)
+        env = {
+            "PATH_INFO": "/%s/structure" % self.cname,
+            "HTTP_COOKIE": "sid=%s" % sid,
+        }
+        dispatch.main(env)
+        self.assertEqual(session.get_session_data({}, sid)["ip_addr"], None)
+        first = os.stat(fname)
+
+        # unchanged sessions are not written again...
+        dispatch.main(env)
+        self.assertEqual(os.stat(fname), first)
+
+        # ...but are kept from expiring
+        old = time.time() - session.TOUCH_INTERVAL - 10
+        os.utime(fname, (old, old))
+        dispatch.main(env)
+        st = os.stat(fname)
+        self.assertEqual(st.st_ino, first.st_ino)
+        self.assertGreater(st.st_mtime, old + 5)
+
+        # changed sessions are written, and the cache notices
+        context = {}
+        data = session.get_session_data(context, sid)
+        data["course"] = self.cname
+        session.set_session_data(context, sid, data)
+        self.assertNotEqual(os.stat(fname).st_ino, first.st_ino)
+        self.assertEqual(session.get_session_data({}, sid)["course"], self.cname)
+        context = dispatch.main(env, return_context=True)
+        self.assertEqual(context["cs_session_data"]["course"], self.cname)
+
+        # expired sessions are still removed
+        old = time.time() - session.EXPIRE - 10
+        os.utime(fname, (old, old))
+        context = dispatch.main(env, return_context=True)
+        self.assertNotIn("course", context["cs_session_data"])
+
+    def test_request_timing(self):
+        env = {"PATH_INFO": "/%s/structure" % self.cname}
+        log = timing.log_location()
+        if os.path.exists(log):
+            os.unlink(log)
+        old_gliu = dispatch.auth.get_logged_in_user
+        lgd = loader.load_global_data
+        try:
+            # only staff are sent the timing of each phase
+            status, headers, body = dispatch.main(env)
+            self.assertNotIn("Server-Timing", headers)
+            ta = {"username": "ta", "role": "TA"}
+            dispatch.auth.get_logged_in_user = lambda context: dict(ta)
+            status, headers, body = dispatch.main(env)
+            phases = [i.split(";")[0] for i in headers["Server-Timing"].split(", ")]
+            expected = ["config", "session", "preload", "auth", "content", "render"]
+            self.assertEqual([i for i in phases if i in expected], expected)
+            self.assertEqual(phases[-1], "total")
+
+            # slow requests are logged, with their phases
+            def mock_load_global_data(into, check_values=True):
+                ret = lgd(into, check_values)
+                into["cs_slow_request_threshold"] = 0
+                return ret
+
+            loader.load_global_data = mock_load_global_data
+            dispatch.main(env)
+        finally:
+            dispatch.auth.get_logged_in_user = old_gliu
+            loader.load_global_data = lgd
+        entries = [e for e in timing.read_log(time.time() - 60) if e["slow"]]
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(entries[0]["path"], "%s/structure" % self.cname)
+        self.assertEqual(entries[0]["status"], "200")
+        self.assertAlmostEqual(
+            sum(entries[0]["phases"].values()), entries[0]["total"], places=4
+        )
+        summary = timing_scripts.summarize(entries)
+        self.assertEqual(
+            [label for (label, _, _) in summary],
+            ["all", self.cname, "  %s/structure" % self.cname],
+        )
+
+    def test_profiling(self):
+        shutil.rmtree(profiling.profile_dir(), ignore_errors=True)
+        env = {"PATH_INFO": "/%s/structure" % self.cname}
+        try:
+            profile_scripts.start(["kinds=request", "courses=%s" % self.cname])
+            profiling._SETTINGS["checked"] = 0
+            dispatch.main(env)
+            dispatch.main({"PATH_INFO": "/_static/_base/scripts/cs_math.js"})
+            with profiling.profiled("checker", [self.cname, "structure"]):
+                pass  # checker jobs are not being profiled
+        finally:
+            profiling.write_settings(None)
+            profiling._SETTINGS["checked"] = 0
+        self.assertFalse(profiling.should_profile("request", [self.cname]))
+
+        found = profiling.find_profiles(time.time() - 60)
+        self.assertEqual(len(found), 1)
+        prof, info = found[0]
+        self.assertEqual(info["kind"], "request")
+        self.assertEqual(info["path"], [self.cname, "structure"])
+        self.assertTrue(os.path.isfile(prof))
+        self.assertEqual(profiling.find_profiles(courses=["nonexistent"]), [])
+
+        out = io.StringIO()
+        profile_scripts.report([self.cname], out)
+        out = out.getvalue()
+        self.assertIn("1 profiles", out)
+        self.assertIn("catsoop dispatch.py", out)
+        self.assertIn("handler default", out)
+
+        cached = os.path.join(base_context.cs_data_root, "_cached")
+        course = os.path.join(
+            base_context.cs_data_root, "courses", self.cname, "content.catsoop"
+        )
+        self.assertEqual(
+            profiling.source_group(cached + course),
+            "course %s: content.catsoop" % self.cname,
+        )
+        self.assertEqual(profiling.source_group("~"), "built-in")
+
 
 if __name__ == "__main__":
     unittest.main()
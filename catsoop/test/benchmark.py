@@ -0,0 +1,498 @@
+# This file is part of CAT-SOOP
+# Copyright (c) 2011-2019 by The CAT-SOOP Developers <catsoop-dev@mit.edu>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Benchmarks of CAT-SOOP, run against the test course with synthetic users.
+
+The unit test below only checks that each benchmark runs.  To run the
+benchmarks themselves:
+
+python -m catsoop.test.benchmark [NAME ...] [n=N] [users=U] [http=1]
+                                 [workers=W] [clients=C] [duration=S]
+                                 [out=FILE] [compare=OLD_FILE]
+
+    NAME:        the benchmarks to run (default: all but "http"), from
+                 "pages" (page views through wsgi.application), "ajax" (AJAX
+                 submissions and checks), "logs" (cslog operations, for each
+                 available backend), "queue" (enqueueing and dequeueing jobs,
+                 for each available backend), "grading" (the time from
+                 submitting to an asynchronously-checked question until its
+                 result is saved) and "http" (page views over HTTP, from
+                 several client processes, against wsgi_server.py)
+    n=N:         repeat each operation N times (default: 200)
+    users=U:     spread requests over U synthetic users (default: 20)
+    http=1:      also run the "http" benchmark
+    workers=W:   number of wsgi_server.py workers for "http" (default: 1)
+    clients=C:   number of client processes for "http" (default: 4)
+    duration=S:  run "http" for S seconds (default: 10)
+    out=FILE:    write the results to FILE, as JSON (default: standard output)
+    compare=OLD: also show how the results compare to those saved in OLD
+
+The mongodb backends are included when mongomock is installed, and/or when the
+MONGODB environment variable gives the location of a mongodb server.
+"""
+
+import io
+import os
+import sys
+import gzip
+import json
+import time
+import logging
+import platform
+import itertools
+import contextlib
+import subprocess
+import urllib.parse
+import http.client
+import multiprocessing
+
+from catsoop import cslog
+from catsoop import wsgi
+from catsoop import grader
+from catsoop import loader
+from catsoop import csqueue
+from catsoop import dispatch
+from catsoop.scripts.checker_scripts import percentile
+
+from ..test import CATSOOPTest
+from . import wsgi_server_test
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+# -----------------------------------------------------------------------------
+
+COURSE = "test_course"
+PAGES = ["", "structure", "markdown", "questions"]
+PERCENTILES = (50, 95, 99)
+
+INLINE_QUESTION = ("q000000", "cat")  # smallbox, checked as it is submitted
+CHECK_QUESTION = ("q000007", "1")  # expression, which supports "check"
+ASYNC_QUESTION = ("q000005", "[1,2,3,4]")  # checked by the checker
+
+
+def summarize(times, elapsed=None):
+    """
+    Summarize the given times (in seconds) taken by some operation: the number
+    of operations, the total time, the throughput, and percentiles of the
+    latency (in milliseconds)
+    """
+    times = sorted(times)
+    elapsed = sum(times) if elapsed is None else elapsed
+    return {
+        "n": len(times),
+        "seconds": round(elapsed, 6),
+        "per_second": round(len(times) / elapsed, 3) if elapsed else None,
+        "latency_ms": {
+            "p%d" % p: round(percentile(times, p) * 1000, 4) for p in PERCENTILES
+        },
+    }
+
+
+def measure(operation, n):
+    """
+    Call operation(i) for i in range(n), and summarize the time taken
+    """
+    times = []
+    start = time.perf_counter()
+    for i in range(n):
+        t = time.perf_counter()
+        operation(i)
+        times.append(time.perf_counter() - t)
+    return summarize(times, time.perf_counter() - start)
+
+
+@contextlib.contextmanager
+def synthetic_users(n):
+    """
+    While active, each request is made by the next of n synthetic students
+    """
+    users = itertools.cycle(
+        [{"username": "bench_user_%03d" % i, "role": "Student"} for i in range(n)]
+    )
+    old_gliu = dispatch.auth.get_logged_in_user
+    logger = logging.getLogger("cs")
+    old_disabled = logger.disabled
+    dispatch.auth.get_logged_in_user = lambda context: dict(next(users))
+    logger.disabled = True  # so that logging doesn't dominate the times
+    try:
+        yield
+    finally:
+        dispatch.auth.get_logged_in_user = old_gliu
+        logger.disabled = old_disabled
+
+
+def request(path, form=None):
+    """
+    Make a request through wsgi.application, as a browser would (a GET, or a
+    POST of the given form, accepting compressed responses)
+
+    **Returns:** the (decompressed) body of the response
+    """
+    body = urllib.parse.urlencode(form).encode() if form is not None else b""
+    environ = {
+        "REQUEST_METHOD": "GET" if form is None else "POST",
+        "PATH_INFO": path,
+        "QUERY_STRING": "",
+        "REMOTE_ADDR": "127.0.0.1",
+        "CONTENT_TYPE": "application/x-www-form-urlencoded",
+        "CONTENT_LENGTH": str(len(body)),
+        "HTTP_ACCEPT_ENCODING": "gzip",
+        "wsgi.input": io.BytesIO(body),
+    }
+    response = []
+    content = b"".join(
+        wsgi.application(environ, lambda *args: response.extend(args))
+    )
+    status, headers = response[0], dict(response[1])
+    if not status.startswith("200"):
+        raise RuntimeError("%s returned %s" % (path, status))
+    if headers.get("Content-Encoding") == "gzip":
+        content = gzip.decompress(content)
+    return content
+
+
+def _ajax(action, question, value):
+    return {
+        "action": action,
+        "names": json.dumps([question]),
+        "api_token": "bench",
+        "data": json.dumps({question: value}),
+    }
+
+
+def log_backends():
+    """
+    **Returns:** a list of `(name, backend)` tuples, one per available cslog
+    backend
+    """
+    out = [("filesystem", cslog.CatsoopLogsWithFilesystem())]
+    if mongomock is not None:
+        out.append(("mongomock", cslog.CatsoopLogsWithMongoDB(mongomock)))
+    if os.environ.get("MONGODB"):
+        import pymongo
+
+        out.append(("mongodb", cslog.CatsoopLogsWithMongoDB(pymongo)))
+    return out
+
+
+def queue_backends():
+    """
+    **Returns:** a list of `(name, backend)` tuples, one per available csqueue
+    backend
+    """
+    out = [("filesystem", csqueue.CatsoopQueueWithFilesystem())]
+    if mongomock is not None:
+        out.append(("mongomock", csqueue.CatsoopQueueWithMongoDB(mongomock)))
+    if os.environ.get("MONGODB"):
+        import pymongo
+
+        out.append(("mongodb", csqueue.CatsoopQueueWithMongoDB(pymongo)))
+    return out
+
+
+# -----------------------------------------------------------------------------
+# the benchmarks; each returns a dictionary mapping names to summaries
+
+
+def bench_pages(opts):
+    out = {}
+    with synthetic_users(opts["users"]):
+        for page in PAGES:
+            path = "/%s/%s" % (COURSE, page) if page else "/%s" % COURSE
+            request(path)  # so that the first (uncached) load is not counted
+            out["page_view %s" % path] = measure(lambda i: request(path), opts["n"])
+    return out
+
+
+def bench_ajax(opts):
+    out = {}
+    path = "/%s/questions" % COURSE
+    with synthetic_users(opts["users"]):
+        for action, (question, value) in (
+            ("submit", INLINE_QUESTION),
+            ("check", CHECK_QUESTION),
+        ):
+            form = _ajax(action, question, value)
+            json.loads(request(path, form))
+            out["ajax_%s %s" % (action, question)] = measure(
+                lambda i: request(path, form), opts["n"]
+            )
+    return out
+
+
+def bench_logs(opts):
+    out = {}
+    n = opts["n"]
+    path = ["bench_course", "lab1"]
+    entry = {"score": 1.0, "response": "x" * 200}
+    for name, logs in log_backends():
+        fname = cslog.get_log_filename("bench_user", path, "problemactions")
+        logs._modify_log(fname, entry, "wb")  # start from a single entry
+        prefix = "log %s " % name
+        out[prefix + "append"] = measure(
+            lambda i: logs._modify_log(fname, entry, "ab"), n
+        )
+        out[prefix + "most_recent"] = measure(
+            lambda i: logs.most_recent("bench_user", path, "problemactions"), n
+        )
+        # (with the n + 1 entries written so far)
+        out[prefix + "read_log"] = measure(
+            lambda i: list(logs._read_log("bench_user", path, "problemactions")),
+            max(n // 10, 1),
+        )
+        out[prefix + "overwrite"] = measure(
+            lambda i: logs._modify_log(fname, entry, "wb"), n
+        )
+    return out
+
+
+def bench_queue(opts):
+    out = {}
+    n = opts["n"]
+    context = {"csm_cslog": cslog}
+    for name, queue in queue_backends():
+        queue.clear_all_queues(context)
+        try:
+            out["queue %s enqueue" % name] = measure(
+                lambda i: queue.enqueue(
+                    context, {"path": [COURSE, "bench"], "n": i, "action": "submit"}
+                ),
+                n,
+            )
+            out["queue %s dequeue" % name] = measure(
+                lambda i: queue.get_oldest_from_queue(context), n
+            )
+        finally:
+            queue.clear_all_queues(context)
+    return out
+
+
+def bench_grading(opts):
+    """
+    Time submissions to a question checked by the checker, from the start of
+    the request until the result is saved (not including the time a job waits
+    for the checker to poll the queue, which depends on its configuration)
+    """
+    context = {}
+    loader.load_global_data(context)
+    path = "/%s/questions" % COURSE
+    question, value = ASYNC_QUESTION
+    form = _ajax("submit", question, value)
+    n = max(opts["n"] // 20, 1)  # each job runs a sandboxed interpreter
+
+    def submit_and_check(i):
+        magic = json.loads(request(path, form))[question]["magic"]
+        job = csqueue.get_oldest_from_queue(context)
+        assert job["magic"] == magic
+        grader.do_check(job)
+        assert csqueue.get_results(magic) is not None
+
+    csqueue.clear_all_queues(context)
+    with synthetic_users(opts["users"]):
+        return {"grading %s" % question: measure(submit_and_check, n)}
+
+
+def _http_client(port, duration, results):
+    # each client has its own connection (with keep-alive), and so its own
+    # session, as a separate user would
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    times = []
+    pages = itertools.cycle(PAGES)
+    end = time.time() + duration
+    while time.time() < end:
+        start = time.perf_counter()
+        conn.request("GET", "/%s/%s" % (COURSE, next(pages)))
+        conn.getresponse().read()
+        times.append(time.perf_counter() - start)
+    conn.close()
+    results.put(times)
+
+
+def bench_http(opts):
+    port = wsgi_server_test.free_port()
+    proc = wsgi_server_test.start_server(port, opts["workers"])
+    try:
+        results = multiprocessing.Queue()
+        procs = [
+            multiprocessing.Process(
+                target=_http_client, args=(port, opts["duration"], results)
+            )
+            for _ in range(opts["clients"])
+        ]
+        start = time.perf_counter()
+        for p in procs:
+            p.start()
+        times = [t for _ in procs for t in results.get()]
+        elapsed = time.perf_counter() - start
+        for p in procs:
+            p.join()
+    finally:
+        proc.terminate()
+        proc.wait()
+    name = "http page_view (%d workers, %d clients)" % (
+        opts["workers"],
+        opts["clients"],
+    )
+    return {name: summarize(times, elapsed)}
+
+
+BENCHMARKS = {
+    "pages": bench_pages,
+    "ajax": bench_ajax,
+    "logs": bench_logs,
+    "queue": bench_queue,
+    "grading": bench_grading,
+    "http": bench_http,
+}
+
+DEFAULTS = {"n": 200, "users": 20, "workers": 1, "clients": 4, "duration": 10}
+
+
+def _commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(__file__),
+            stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(names=None, **options):
+    """
+    Run the named benchmarks (by default, all but "http").
+
+    **Returns:** a dictionary describing the run (the commit, Python version,
+    platform and options) and giving the results, suitable for saving as JSON
+    """
+    opts = dict(DEFAULTS)
+    opts.update(options)
+    names = names or [i for i in BENCHMARKS if i != "http"]
+    results = {}
+    for name in names:
+        results.update(BENCHMARKS[name](opts))
+    return {
+        "commit": _commit(),
+        "time": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "options": opts,
+        "results": results,
+    }
+
+
+def compare(old, new):
+    """
+    **Returns:** a table (as a string) comparing the median latency and
+    throughput of each operation in two runs (as returned by `run`)
+    """
+    lines = [
+        "%-45s %10s %10s %8s" % ("", "old p50", "new p50", "change"),
+    ]
+    for name, result in new["results"].items():
+        before = old["results"].get(name)
+        p50 = result["latency_ms"]["p50"]
+        if before is None:
+            lines.append("%-45s %10s %8.3fms %8s" % (name, "-", p50, "new"))
+            continue
+        old_p50 = before["latency_ms"]["p50"]
+        change = (p50 - old_p50) / old_p50 * 100 if old_p50 else 0
+        lines.append(
+            "%-45s %8.3fms %8.3fms %+7.1f%%" % (name, old_p50, p50, change)
+        )
+    return "\n".join(lines)
+
+
+def format_results(run):
+    lines = [
+        "%-45s %10s " % ("", "per second")
+        + " ".join("%10s" % ("p%d" % p) for p in PERCENTILES)
+    ]
+    for name, result in run["results"].items():
+        lines.append(
+            "%-45s %10.1f " % (name, result["per_second"] or 0)
+            + " ".join(
+                "%8.3fms" % result["latency_ms"]["p%d" % p] for p in PERCENTILES
+            )
+        )
+    return "\n".join(lines)
+
+
+class Test_Benchmark(CATSOOPTest):
+    def test_benchmarks_run(self):
+        result = run(n=2, users=2)
+        result = json.loads(json.dumps(result))
+        names = list(result["results"])
+        for prefix in ("page_view", "ajax_submit", "ajax_check", "grading"):
+            self.assertTrue(any(i.startswith(prefix) for i in names), prefix)
+        for op in ("append", "most_recent", "read_log", "overwrite"):
+            self.assertIn("log filesystem %s" % op, " ".join(names))
+        self.assertIn("queue filesystem enqueue", names)
+        self.assertIn("queue filesystem dequeue", names)
+        for summary in result["results"].values():
+            self.assertGreater(summary["n"], 0)
+            self.assertEqual(set(summary["latency_ms"]), {"p50", "p95", "p99"})
+        self.assertIn("queue filesystem dequeue", compare(result, result))
+        self.assertIn("+0.0%", compare(result, result))
+
+
+def main(args):
+    names = []
+    opts = {}
+    out = compare_to = None
+    for arg in args:
+        if "=" not in arg:
+            if arg not in BENCHMARKS:
+                print(__doc__, file=sys.stderr)
+                sys.exit(1)
+            names.append(arg)
+            continue
+        k, v = arg.split("=", 1)
+        if k == "out":
+            out = v
+        elif k == "compare":
+            compare_to = v
+        elif k == "http":
+            if v not in {"0", "false", "False"}:
+                names = names or [i for i in BENCHMARKS if i != "http"]
+                names.append("http")
+        elif k in DEFAULTS:
+            opts[k] = float(v) if k == "duration" else int(v)
+        else:
+            print(__doc__, file=sys.stderr)
+            sys.exit(1)
+    result = run(names, **opts)
+    print(format_results(result), file=sys.stderr)
+    if compare_to is not None:
+        with open(compare_to) as f:
+            print("\n" + compare(json.load(f), result), file=sys.stderr)
+    if out is None:
+        print(json.dumps(result, indent=2))
+    else:
+        with open(out, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["-h"] or sys.argv[1:2] == ["--help"]:
+        print(__doc__, file=sys.stderr)
+    else:
+        main(sys.argv[1:])
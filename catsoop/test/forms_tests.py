@@ -0,0 +1,189 @@
+# This file is part of CAT-SOOP
+# Copyright (c) 2011-2019 by The CAT-SOOP Developers <catsoop-dev@mit.edu>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for CAT-SOOP's parsing of form data
+"""
+
+import io
+import os
+import unittest
+
+from catsoop import forms
+from catsoop import loader
+from catsoop import dispatch
+from catsoop import base_context
+
+from ..test import CATSOOPTest
+
+# -----------------------------------------------------------------------------
+
+
+class _Trickle(io.RawIOBase):
+    """
+    A stream which returns at most n bytes from each read, as a slow client's
+    request body would
+    """
+
+    def __init__(self, data, n):
+        self.data = data
+        self.n = n
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        size = self.n if size < 0 else min(size, self.n)
+        out, self.data = self.data[:size], self.data[size:]
+        return out
+
+
+def _multipart(boundary, parts):
+    out = b""
+    for name, filename, data in parts:
+        disposition = 'form-data; name="%s"' % name
+        if filename is not None:
+            disposition += '; filename="%s"' % filename
+        out += b"--%s\r\n" % boundary
+        out += b"Content-Disposition: %s\r\n" % disposition.encode()
+        if filename is not None:
+            out += b"Content-Type: application/octet-stream\r\n"
+        out += b"\r\n" + data + b"\r\n"
+    return out + b"--%s--\r\n" % boundary
+
+
+def _environment(body, ctype, n=65536, **kwargs):
+    env = {
+        "REQUEST_METHOD": "POST",
+        "CONTENT_TYPE": ctype,
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.input": _Trickle(body, n),
+    }
+    env.update(kwargs)
+    return env
+
+
+class Test_Forms(CATSOOPTest):
+    """
+    Tests for catsoop.forms
+    """
+
+    def setUp(self):
+        CATSOOPTest.setUp(self)
+        context = {}
+        loader.load_global_data(context)
+        self.cname = context["cs_unit_test_course"]
+
+    def test_urlencoded(self):
+        env = _environment(
+            b"action=submit&names=a&names=b&empty=&text=%E2%9C%93+ok",
+            "application/x-www-form-urlencoded",
+            QUERY_STRING="loginaction=login",
+        )
+        form = forms.parse_form(env)
+        assert form == {
+            "action": "submit",
+            "names": ["a", "b"],
+            "empty": "",
+            "text": "✓ ok",
+            "loginaction": "login",
+        }
+
+        # GET requests only have the query string
+        form = forms.parse_form({"REQUEST_METHOD": "GET", "QUERY_STRING": "a=1&b"})
+        assert form == {"a": "1", "b": ""}
+
+    def test_multipart(self):
+        boundary = b"----catsoopboundary"
+        upload = os.urandom(50000) + b"\r\n--" + boundary[:-3] + os.urandom(100)
+        body = _multipart(
+            boundary,
+            [
+                ("action", None, b"submit"),
+                ("data", None, '{"q000000": "é"}'.encode()),
+                ("cs_upload_q000000", "test.bin", upload),
+                ("empty", "", b""),
+            ],
+        )
+        ctype = 'multipart/form-data; boundary="%s"' % boundary.decode()
+        # with delimiters split across reads in every possible place
+        for n in (1, 7, 64, 65536):
+            form = forms.parse_form(
+                _environment(body, ctype, n, QUERY_STRING="x=1"), None, 10000
+            )
+            assert form["action"] == "submit"
+            assert form["data"] == '{"q000000": "é"}'
+            assert form["x"] == "1"
+            f = form["cs_upload_q000000"]
+            assert f.filename == "test.bin"
+            assert f.content_type == "application/octet-stream"
+            assert f.size == len(upload)
+            assert f.file._rolled  # larger than max_memory_size, so on disk
+            assert f.read() == upload
+            assert form["empty"].filename == ""
+            assert form["empty"].size == 0
+            f.close()
+            form["empty"].close()
+
+    def test_bad_request(self):
+        boundary = b"xyz"
+        body = _multipart(boundary, [("a", None, b"1"), ("b", "b.txt", b"2")])
+        ctype = "multipart/form-data; boundary=xyz"
+        for bad in (body[:-20], body.replace(b"form-data;", b"attachment;")):
+            with self.assertRaises(forms.BadRequest):
+                forms.parse_form(_environment(bad, ctype))
+        with self.assertRaises(forms.BadRequest):
+            forms.parse_form(_environment(body, "multipart/form-data"))
+
+        env = _environment(body[:-20], ctype, PATH_INFO="/%s" % self.cname)
+        status, headers, msg = dispatch.main(env)
+        assert status[0] == "400"
+
+    def test_request_too_large(self):
+        body = b"data=" + b"x" * 1000
+        env = _environment(body, "application/x-www-form-urlencoded")
+        with self.assertRaises(forms.RequestTooLarge):
+            forms.parse_form(env, 1000)
+
+        # bodies without a Content-Length are cut off once they are too large
+        env = _environment(body, "application/x-www-form-urlencoded", 100)
+        env["CONTENT_LENGTH"] = ""
+        env["wsgi.input_terminated"] = True
+        with self.assertRaises(forms.RequestTooLarge):
+            forms.parse_form(env, 1000)
+
+        old = base_context.cs_max_request_size
+        base_context.cs_max_request_size = 1000
+        try:
+            env = _environment(
+                body,
+                "application/x-www-form-urlencoded",
+                PATH_INFO="/%s" % self.cname,
+            )
+            status, headers, msg = dispatch.main(env)
+            assert status[0] == "413"
+        finally:
+            base_context.cs_max_request_size = old
+
+    def test_form_in_context(self):
+        env = _environment(
+            b"a=1&a=2", "application/x-www-form-urlencoded", PATH_INFO="/%s" % self.cname
+        )
+        context = dispatch.main(env, return_context=True)
+        assert context["cs_form"] == {"a": ["1", "2"]}
+
+
+if __name__ == "__main__":
+    unittest.main()
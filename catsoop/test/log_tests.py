@@ -0,0 +1,134 @@
+# This file is part of CAT-SOOP
+# Copyright (c) 2011-2019 by The CAT-SOOP Developers <catsoop-dev@mit.edu>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for CAT-SOOP's log backends, compaction and archival
+"""
+
+import os
+import shutil
+import unittest
+import multiprocessing
+
+from catsoop import cslog
+from catsoop.scripts import log_scripts
+
+from ..test import CATSOOPTest
+
+# -----------------------------------------------------------------------------
+
+
+class Test_LogArchive(CATSOOPTest):
+    course = "archive_test_course"
+
+    def setUp(self):
+        CATSOOPTest.setUp(self)
+        self.course_dir = log_scripts._course_log_dir(self.course)
+        self.archive = cslog.archive_location(self.course)
+        for loc in (self.course_dir, self.archive):
+            if os.path.isdir(loc):
+                shutil.rmtree(loc)
+            elif os.path.isfile(loc):
+                os.unlink(loc)
+        for user in ("alice", "bob"):
+            for i in range(3):
+                cslog.update_log(user, [self.course, "lab1"], "problemstate", {"n": i})
+                cslog.update_log(
+                    user, [self.course, "lab1"], "problemactions", {"action": i}
+                )
+
+    def test_compact(self):
+        log_scripts.log_compact([self.course])
+        for user in ("alice", "bob"):
+            path = [self.course, "lab1"]
+            self.assertEqual(
+                cslog.read_log(user, path, "problemstate"), [{"n": 2}]
+            )
+            self.assertEqual(len(cslog.read_log(user, path, "problemactions")), 3)
+
+    def test_archive_read_and_rehydrate(self):
+        path = [self.course, "lab1"]
+        log_scripts.log_archive([self.course, "problemactions=2"])
+        self.assertTrue(os.path.isfile(self.archive))
+        fname = cslog.get_log_filename("alice", path, "problemstate")
+        self.assertFalse(os.path.exists(fname))
+
+        self.assertEqual(cslog.most_recent("alice", path, "problemstate"), {"n": 2})
+        self.assertEqual(
+            cslog.read_log("bob", path, "problemactions"),
+            [{"action": 1}, {"action": 2}],
+        )
+        self.assertEqual(cslog.most_recent("carol", path, "problemstate", {}), {})
+
+        # writing to an archived log brings it back to hot storage
+        cslog.update_log("bob", path, "problemactions", {"action": 3})
+        self.assertEqual(
+            cslog.read_log("bob", path, "problemactions"),
+            [{"action": 1}, {"action": 2}, {"action": 3}],
+        )
+
+        # and archiving again merges the new entries into the archive
+        log_scripts.log_archive([self.course])
+        self.assertEqual(len(cslog.read_log("bob", path, "problemactions")), 3)
+        self.assertEqual(cslog.most_recent("alice", path, "problemstate"), {"n": 2})
+
+    def test_refused_for_encrypted_logs(self):
+        names = ("ENCRYPT_KEY", "SALT", "XTS_KEY", "FERNET")
+        old = {i: getattr(cslog, i, None) for i in names}
+        cslog.ENCRYPT_KEY = b"k" * 32
+        cslog.SALT = b"salt"
+        cslog.XTS_KEY = bytes(range(64))
+        cslog.FERNET = cslog.RawFernet(cslog.ENCRYPT_KEY)
+        try:
+            path = [self.course, "lab1"]
+            for i in range(3):
+                cslog.update_log("alice", path, "problemstate", {"n": i})
+            fname = cslog.get_log_filename("alice", path, "problemstate")
+            with open(fname, "rb") as f:
+                before = f.read()
+            for func in (log_scripts.log_compact, log_scripts.log_archive):
+                with self.assertRaises(SystemExit):
+                    func([self.course])
+            with open(fname, "rb") as f:
+                self.assertEqual(f.read(), before)
+            self.assertEqual(len(cslog.read_log("alice", path, "problemstate")), 3)
+            self.assertFalse(os.path.exists(self.archive))
+            shutil.rmtree(log_scripts._course_log_dir(cslog.split_log_filename(fname)[0]))
+        finally:
+            for i in names:
+                setattr(cslog, i, old[i])
+
+
+def _is_new_backend(q, parent_backend):
+    q.put(cslog.initialize() is not parent_backend)
+
+
+class Test_LogBackend(CATSOOPTest):
+    def test_one_backend_per_process(self):
+        backend = cslog.initialize()
+        self.assertIs(cslog.initialize(), backend)
+        self.assertIs(cslog.LOGS, backend)
+
+        # forked children create their own backend
+        ctx = multiprocessing.get_context("fork")
+        q = ctx.Queue()
+        p = ctx.Process(target=_is_new_backend, args=(q, backend))
+        p.start()
+        self.assertTrue(q.get(timeout=10))
+        p.join()
+        self.assertIs(cslog.initialize(), backend)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -19,12 +19,17 @@ Unit tests for CAT-SOOP
 Requires config to be setup, including cs_unit_test_course
 """
 
-import cgi
+import os
+import shutil
+import httplib2
 import logging
 import unittest
+import threading
+import http.server
 
 from catsoop import loader
 from catsoop import dispatch
+from catsoop import forms
 from catsoop import lti
 
 from ..test import CATSOOPTest
@@ -60,6 +65,10 @@ class Test_LTI(CATSOOPTest):
         loader.load_global_data = mock_load_global_data
 
         logging.getLogger("pylti.common").setLevel(1)
+        self.parse_form = forms.parse_form
+
+    def tearDown(self):
+        forms.parse_form = self.parse_form
 
     def skip_test_lti_auth0(self):
         path = "/_lti/%s/structure" % self.cname
@@ -92,10 +101,10 @@ class Test_LTI(CATSOOPTest):
             username="anltiuser",
         )
 
-        def retform():
+        def retform(environment, *args):
             return ltic.lti_context
 
-        cgi.FieldStorage = retform  # monkey patch
+        forms.parse_form = retform  # monkey patch
         env = {
             "PATH_INFO": path,
             "wsgi.url_scheme": "http",
@@ -126,10 +135,10 @@ class Test_LTI(CATSOOPTest):
         url = "http://%s%s" % (host, path)
         ltic = lti.LTI_Consumer(lti_url=url, consumer_key=self.ckey, secret=self.secret)
 
-        def retform():
+        def retform(environment, *args):
             return ltic.lti_context
 
-        cgi.FieldStorage = retform  # monkey patch
+        forms.parse_form = retform  # monkey patch
         env = {
             "PATH_INFO": path,
             "wsgi.url_scheme": "http",
@@ -142,6 +151,128 @@ class Test_LTI(CATSOOPTest):
         assert "Page Specification and Loading" in msg.decode("utf8")
 
 
+# -----------------------------------------------------------------------------
+
+
+class _StandInConsumer(http.server.BaseHTTPRequestHandler):
+    """
+    Stand-in LTI tool consumer outcome service, recording the scores it is
+    sent; it fails the first server.failures requests
+    """
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.requests.append((self.headers.get("Authorization"), body))
+        if self.server.failures > 0:
+            self.server.failures -= 1
+            code = "failure"
+        else:
+            code = "success"
+        reply = ("<imsx_codeMajor>%s</imsx_codeMajor>" % code).encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(reply)))
+        self.end_headers()
+        self.wfile.write(reply)
+
+    def log_message(self, *args):
+        pass
+
+
+class Test_LTIOutbox(CATSOOPTest):
+    """
+    Scores queued for LTI tool consumers, and sent by the outbox process
+    """
+
+    def setUp(self):
+        CATSOOPTest.setUp(self)
+        context = {}
+        loader.load_global_data(context)
+        self.cname = context["cs_unit_test_course"]
+        self.cs_lti_config = {
+            "session_key": "aslkdj12",
+            "consumers": {"__test_consumer__": {"secret": "__test_secret__"}},
+        }
+        self.lgd = lgd = loader.load_global_data
+
+        def mock_load_global_data(into, check_values=True):
+            ret = lgd(into, check_values)
+            into["cs_lti_config"] = self.cs_lti_config
+            return ret
+
+        loader.load_global_data = mock_load_global_data
+        shutil.rmtree(lti.outbox_location(), True)
+
+        self.server = http.server.HTTPServer(("localhost", 0), _StandInConsumer)
+        self.server.requests = []
+        self.server.failures = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.normalize = httplib2.Http._normalize_headers
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        loader.load_global_data = self.lgd
+
+    def lti_data(self, user):
+        return {
+            "oauth_consumer_key": "__test_consumer__",
+            "lis_outcome_service_url": "http://localhost:%d/outcome" % self.server.server_port,
+            "lis_result_sourcedid": "result_%s" % user,
+        }
+
+    def test_outbox(self):
+        context = {"cs_course": self.cname}
+        lti.queue_outcome(context, self.lti_data("alice"), 0.25)
+        lti.queue_outcome(context, self.lti_data("alice"), 0.5)  # replaces 0.25
+        lti.queue_outcome(context, self.lti_data("bob"), 1.0)
+        self.assertEqual(
+            sorted(i["score"] for i in lti.pending_outcomes().values()), [0.5, 1.0]
+        )
+
+        # the consumer is down: nothing is sent, and both are retried later
+        self.server.failures = 2
+        sender = lti.OutcomeSender()
+        self.assertEqual(lti.send_outcomes(sender, now=1000), (0, 2))
+        pending = lti.pending_outcomes()
+        self.assertEqual(len(pending), 2)
+        for entry in pending.values():
+            self.assertEqual(entry["attempts"], 1)
+            self.assertGreater(entry["next_try"], 1000)
+        self.assertEqual(lti.send_outcomes(sender, now=1001), (0, 0))
+
+        # and sent once it is back
+        self.assertEqual(lti.send_outcomes(sender), (2, 0))
+        self.assertEqual(lti.pending_outcomes(), {})
+        for auth, body in self.server.requests[-2:]:
+            self.assertTrue(auth.startswith("OAuth "))
+            self.assertIn("oauth_body_hash", auth)
+            if b"result_alice" in body:
+                self.assertIn(b"<textString>0.5</textString>", body)
+        self.assertEqual(len(sender.clients), 1)
+
+        # the capitalized Authorization header is only used by the sender's
+        # own clients
+        client = sender.clients["__test_consumer__"]
+        self.assertIn("Authorization", client._normalize_headers({"authorization": "x"}))
+        self.assertIs(httplib2.Http._normalize_headers, self.normalize)
+
+    def test_handler_reloaded_on_config_change(self):
+        sender = lti.OutcomeSender()
+        sender.handler(self.cname, self.lti_data("alice"))
+        first = sender.handlers[self.cname][1]
+        sender.handler(self.cname, self.lti_data("bob"))
+        self.assertIs(sender.handlers[self.cname][1], first)
+
+        preload = os.path.join(loader.get_course_fs_location({}, self.cname), "preload.py")
+        st = os.stat(preload)
+        try:
+            os.utime(preload, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+            sender.handler(self.cname, self.lti_data("alice"))
+            self.assertIsNot(sender.handlers[self.cname][1], first)
+        finally:
+            os.utime(preload, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+
 # -----------------------------------------------------------------------------
 
 if __name__ == "__main__":
@@ -0,0 +1,147 @@
+# This file is part of CAT-SOOP
+# Copyright (c) 2011-2019 by The CAT-SOOP Developers <catsoop-dev@mit.edu>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for the mongodb log and queue backends, using mongomock.
+
+To run the (small) benchmark against a real mongodb server instead:
+
+MONGODB=mongodb://localhost python -m catsoop.test.mongo_tests bench
+"""
+
+import sys
+import time
+import unittest
+
+from catsoop import cslog
+from catsoop import csqueue
+
+from ..test import CATSOOPTest
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+# -----------------------------------------------------------------------------
+
+
+@unittest.skipIf(mongomock is None, "mongomock is not installed")
+class Test_MongoDB(CATSOOPTest):
+    def setUp(self):
+        CATSOOPTest.setUp(self)
+        self.logs = cslog.CatsoopLogsWithMongoDB(mongomock)
+        self.queue = csqueue.CatsoopQueueWithMongoDB(mongomock)
+
+    def test_log_order_and_indexes(self):
+        path = ["test_course", "lab1"]
+        fname = cslog.get_log_filename("alice", path, "problemactions")
+        for i in range(5):
+            self.logs._modify_log(fname, {"n": i}, "ab")
+        self.assertEqual(
+            self.logs._read_log("alice", path, "problemactions"),
+            [{"n": i} for i in range(5)],
+        )
+        self.assertEqual(
+            self.logs.most_recent("alice", path, "problemactions"), {"n": 4}
+        )
+
+        self.logs._modify_log(fname, {"n": "new"}, "wb")
+        self.assertEqual(
+            self.logs.most_recent("alice", path, "problemactions"), {"n": "new"}
+        )
+
+        dname = self.logs.fname_to_doc(fname)[0]
+        keys = [i["key"] for i in self.logs.db[dname].index_information().values()]
+        self.assertIn([("fn", 1), ("seq", 1)], keys)
+
+    def test_queue_order_and_indexes(self):
+        context = {"csm_cslog": cslog}
+        self.queue.clear_all_queues(context)
+        ids = [self.queue.enqueue(context, {"n": i}) for i in range(3)]
+        self.queue.update_current_job_status()
+        self.assertEqual(self.queue.CURRENT["queued"], ids)
+        self.assertEqual(self.queue.get_current_job_status(ids[1]), 2)
+
+        row = self.queue.get_oldest_from_queue(context)
+        self.assertEqual(row["magic"], ids[0])
+
+        col = self.queue.db[self.queue.COLLECTION]
+        keys = [i["key"] for i in col.index_information().values()]
+        self.assertIn([("status", 1), ("time", 1)], keys)
+
+    def test_queue_coalesce(self):
+        context = {"csm_cslog": cslog}
+        self.queue.clear_all_queues(context)
+        job = lambda form: {"path": ["c1"], "username": "alice", "names": ["q1"],
+                            "form": {"q1": form}, "action": "check"}
+        first = self.queue.enqueue(context, job("x = 1"))
+        self.assertEqual(self.queue.enqueue(context, job("x = 1")), first)
+        self.assertEqual(self.queue.enqueue(context, job("x = 2")), first)
+        row = self.queue.claim_from_queue(context, first)
+        self.assertEqual(row["form"], {"q1": "x = 2"})
+        self.assertNotEqual(self.queue.enqueue(context, job("x = 2")), first)
+
+    def test_queue_leases(self):
+        context = {"csm_cslog": cslog}
+        self.queue.clear_all_queues(context)
+        ids = [self.queue.enqueue(context, {"n": i}) for i in range(2)]
+        for id_ in ids:
+            self.assertIsNotNone(self.queue.claim_from_queue(context, id_))
+        col = self.queue.db[self.queue.COLLECTION]
+        self.assertEqual(col.find_one({"_id": ids[0]})["worker"], csqueue.worker_id())
+        col.update_one({"_id": ids[0]}, {"$set": {"lease": time.time() - 1}})
+
+        self.queue.move_running_back_to_queued(context)
+        self.assertEqual([i["magic"] for i in self.queue.list_waiting(context)], [ids[0]])
+        self.assertEqual(self.queue.renew_leases(context, ids), [ids[0]])
+
+def bench(pymongo, nentries=2000, nreads=200):
+    """
+    Time most_recent / _read_log / queue polling against the given pymongo-like
+    module, with one large log and many queued jobs.
+    """
+    logs = cslog.CatsoopLogsWithMongoDB(pymongo)
+    queue = csqueue.CatsoopQueueWithMongoDB(pymongo)
+    path = ["bench_course", "lab1"]
+    fname = cslog.get_log_filename("bench_user", path, "problemactions")
+    for i in range(nentries):
+        logs._modify_log(fname, {"n": i, "pad": "x" * 200}, "ab")
+        queue.enqueue({}, {"n": i})
+
+    results = {}
+    start = time.time()
+    for i in range(nreads):
+        logs.most_recent("bench_user", path, "problemactions")
+    results["most_recent"] = (time.time() - start) / nreads
+    start = time.time()
+    logs._read_log("bench_user", path, "problemactions")
+    results["read_log"] = time.time() - start
+    start = time.time()
+    for i in range(nreads // 10):
+        queue.update_current_job_status()
+    results["update_current_job_status"] = (time.time() - start) / (nreads // 10)
+    queue.clear_all_queues({})
+    return results
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["bench"]:
+        import pymongo
+
+        for k, v in bench(pymongo).items():
+            print("%-30s %.6fs" % (k, v))
+    else:
+        unittest.main()
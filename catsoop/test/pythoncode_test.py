@@ -1,5 +1,9 @@
+import os
+import re
 import sys
+import time
 import logging
+import unittest
 import catsoop
 import catsoop.loader as loader
 import catsoop.base_context as base_context
@@ -69,6 +73,23 @@ qkw = dict(
     ],
 )
 
+sandbox_programs = [
+    sgd_function,
+    "def sgd(x):\n    print('checking', x)\n    return 1 / 0\n",
+    "import sys\ndef sgd(x):\n    sys.exit('giving up')\n",
+    "import random\ndef sgd(x):\n    return 0 <= random.random() < 1\n",
+    "def sgd(x):\n    while True:\n        pass\n",
+]
+
+sandbox_test = {
+    "code": "ans = sgd(10)",
+    "code_pre": "",
+    "variable": "ans",
+    "count_opcodes": False,
+    "opcode_limit": None,
+    "result_as_string": False,
+}
+
 # -----------------------------------------------------------------------------
 
 
@@ -143,3 +164,135 @@ class Test_Pythoncode(CATSOOPTest):
 
         assert "Our solution did not produce a value for" not in str(ret)
         assert "comparison threshold set too" not in str(ret)
+
+    def test_warm_sandbox(self):
+        # tests forked from a warm interpreter behave like those run in a new one
+        info = self.info
+        info["csq_code_post"] = ""
+        info["csq_sandbox_dir"] = "/tmp/catsoop_test/sandbox"
+        self.csq["get_sandbox"](info)
+
+        def run(code, warm):
+            info["csq_sandbox_options"] = {"WARM": warm}
+            out, err, log = info["sandbox_run_test"](info, code, sandbox_test)
+            log.pop("duration", None)
+            return out, re.sub(r"_[0-9a-f]{32}", "_TEST", err), log
+
+        for code in sandbox_programs:
+            self.assertEqual(run(code, True), run(code, False))
+        socks = [i for i in os.listdir(info["csq_sandbox_dir"]) if i.endswith(".sock")]
+        self.assertEqual(len(socks), 1)
+
+    def test_workspace_files(self):
+        # extra files can be shared from a template, rebuilt when they change;
+        # tests writing to their copies must not change the template
+        info = self.info
+        info["csq_code_post"] = ""
+        info["csq_sandbox_dir"] = "/tmp/catsoop_test/sandbox"
+        self.csq["get_sandbox"](info)
+        os.makedirs(info["csq_sandbox_dir"], exist_ok=True)
+        data = os.path.join(info["csq_sandbox_dir"], "data.txt")
+        with open(data, "w") as f:
+            f.write("old")
+        files = [("copy", data, "data.txt"), ("string", "extra.txt", "!")]
+        code = (
+            "import os\n"
+            "def sgd(x):\n"
+            "    out = open('data.txt').read() + open('extra.txt').read()\n"
+            "    os.chmod('data.txt', 0o666)\n"
+            "    with open('data.txt', 'w') as f:\n"
+            "        f.write('changed')\n"
+            "    return (out, os.stat('data.txt').st_nlink)\n"
+        )
+
+        def run(**options):
+            info["csq_sandbox_options"] = dict(options, FILES=files, FILESIZE=1000)
+            return info["sandbox_run_test"](info, code, sandbox_test)[2]["result"]
+
+        self.assertEqual(run(), ("old!", 1))
+        self.assertEqual(run(LINK_FILES=True), ("old!", 1))
+        self.assertEqual(run(LINK_FILES=True), ("old!", 1))
+        template = info["sandbox_workspace_template"](info, files)
+        with open(os.path.join(template, "data.txt")) as f:
+            self.assertEqual(f.read(), "old")
+        with open(data, "w") as f:
+            f.write("new")
+        os.utime(data, ns=(0, 0))
+        self.assertEqual(run(LINK_FILES=True), ("new!", 1))
+
+    def test_sandbox_backend_cache(self):
+        # sandbox implementations are loaded once, and again when they change
+        info = self.info
+        self.csq["get_sandbox"](info)
+        run_code = info["sandbox_backend"](info, "python")
+        self.assertIs(info["sandbox_backend"](info, "python"), run_code)
+        self.assertIsNot(info["sandbox_backend"](info, "remote"), run_code)
+        fname = run_code.__code__.co_filename
+        st = os.stat(fname)
+        try:
+            os.utime(fname, ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+            self.assertIsNot(info["sandbox_backend"](info, "python"), run_code)
+        finally:
+            os.utime(fname, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+    def test_batch_tests(self):
+        # batched tests give the same results as tests run one at a time
+        info = self.info
+        info["csq_code_post"] = ""
+        info["csq_sandbox_dir"] = "/tmp/catsoop_test/sandbox"
+        self.csq["get_sandbox"](info)
+        code = "import os\n" + sgd_function
+        tests = [
+            dict(sandbox_test, code="ans = sgd(10)"),
+            dict(sandbox_test, code="ans = sgd(1) + 1 / 0"),
+            dict(sandbox_test, code="ans = input()", sandbox_options={"STDIN": "hi\n"}),
+            dict(sandbox_test, code="open('f.txt', 'w').close(); ans = 1"),
+            dict(sandbox_test, code="ans = os.path.exists('f.txt')"),
+            dict(sandbox_test, code="while True: pass"),
+            dict(sandbox_test, code="ans = 2"),
+        ]
+
+        def run(batch, **options):
+            info["csq_batch_tests"] = batch
+            info["csq_sandbox_options"] = options
+            results = info["sandbox_run_tests"](info, code, tests)
+            for out, err, log in results:
+                log.pop("duration", None)
+            return [(o, re.sub(r"_[0-9a-f]{32}", "_TEST", e), l) for o, e, l in results]
+
+        expected = run(False)
+        self.assertEqual(expected[4][2], {"result": False, "complete": True})
+        self.assertIn("ZeroDivisionError", expected[1][1])
+        self.assertEqual(run(True), expected)
+        self.assertEqual(run(True, WARM=True), expected)
+
+
+def bench(preload, n=50):
+    """
+    Compare the number of tests per second run by the python sandbox when
+    starting a new interpreter for each test, and when forking tests from a
+    warm interpreter which has already imported the given modules.
+    """
+    test = Test_Pythoncode("test_warm_sandbox")
+    test.setUp()
+    info = test.info
+    info["csq_code_post"] = ""
+    test.csq["get_sandbox"](info)
+    code = "".join("import %s\n" % i for i in preload) + sgd_function
+    results = {}
+    for warm in (False, True):
+        info["csq_sandbox_options"] = {"WARM": warm, "PRELOAD": preload}
+        info["sandbox_run_test"](info, code, sandbox_test)  # start the template
+        start = time.time()
+        for i in range(n):
+            info["sandbox_run_test"](info, code, sandbox_test)
+        results["warm" if warm else "cold"] = n / (time.time() - start)
+    return results
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["bench"]:
+        for k, v in bench(sys.argv[2:]).items():
+            print("%-10s %.1f tests/s" % (k, v))
+    else:
+        unittest.main()
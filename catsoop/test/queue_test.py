@@ -6,15 +6,23 @@ To run just this test:
 python setup.py test -s catsoop.test.queue_test.Test_Queue 
 '''
 
+import io
+import os
 import sys
 import json
+import time
+import shutil
 import logging
+import tempfile
+import urllib.parse
+import multiprocessing
 import catsoop
 
 from catsoop import cslog
 from catsoop import grader
 from catsoop import csqueue
 from catsoop import dispatch
+from catsoop.scripts import checker_scripts
 
 import catsoop.loader as loader
 import catsoop.base_context as base_context
@@ -110,6 +118,15 @@ class Test_Queue(CATSOOPTest):
 
         assert 'All of the numbers must be in the range' in result['response']
         assert result['score']==0.0
+
+        # resource accounting
+        assert result['job_enqueued'] <= result['job_complete']
+        assert result['resources']['utime'] >= 0
+        assert result['resources']['maxrss'] > 0
+        summary = checker_scripts.summarize([result])
+        assert [label for (label, n, _) in summary] == [
+            self.cname, "  %s/questions:%s" % (self.cname, qid)]
+        assert set(summary[0][2]) == {"cpu", "maxrss"}	# job_started is set by the checker loop
         
         # check problemstate log
         logpath = (job["username"], job["path"], "problemstate")
@@ -123,6 +140,39 @@ class Test_Queue(CATSOOPTest):
         assert data['checker_ids'][qid]==id_
         dispatch.auth.get_logged_in_user = old_gliu
 
+    def test_question_submit_inline(self):
+        '''
+        Test submission to a question whose type is graded inline: the result
+        comes back with the response, and is stored as the checker would.
+        '''
+        old_gliu = dispatch.auth.get_logged_in_user
+        dispatch.auth.get_logged_in_user = self.get_logged_in_user
+        csqueue.clear_all_queues(self.context)
+        qid = "q000000"	# smallbox
+        form_data = {'action': 'submit',
+                     'names': json.dumps([qid]),
+                     'api_token': '123',
+                     'data': json.dumps({qid: "Cat"}),
+        }
+        env = {"PATH_INFO": "/%s/questions" % self.cname,
+               'REMOTE_ADDR': 'dummy_ip',
+        }
+        status, retinfo, msg = dispatch.main(env, form_data=form_data)
+        qret = json.loads(msg)[qid]
+        assert qret['score'] == 1
+        assert csqueue.get_oldest_from_queue(self.context, move_to_running=False) is None
+
+        result = csqueue.get_results(qret['magic'])
+        assert result['score'] == 1
+        assert result['score_box'] == qret['score_display']
+
+        logpath = ("test_user", [self.cname, "questions"], "problemstate")
+        data = cslog.most_recent(*logpath, {}, lock=False)
+        assert data['checker_ids'][qid] == qret['magic']
+        assert data['last_submit_id'][qid] == qret['magic']
+        assert data['scores'][qid] == 1
+        dispatch.auth.get_logged_in_user = old_gliu
+
     def test_question_submit_and_watch_queue(self):
         '''
         Test submission to an asynchronousely graded problem,
@@ -209,10 +259,123 @@ class Test_Queue(CATSOOPTest):
         assert data['checker_ids'][qid]==id_
         dispatch.auth.get_logged_in_user = old_gliu
 
+    def test_regrade(self):
+        """
+        Regrading re-runs the latest submission in the regrade lane, and
+        reports the scores which changed
+        """
+        csqueue.clear_all_queues(self.context)
+        old_gliu = dispatch.auth.get_logged_in_user
+        dispatch.auth.get_logged_in_user = self.get_logged_in_user
+        qid = "q000005"
+        form_data = {'action': 'submit',
+                     'names': json.dumps([qid]),
+                     'api_token': '123',
+                     'data': json.dumps({qid: "[1,2,3,4]"}),
+        }
+        env = {"PATH_INFO": "/%s/questions" % self.cname, 'REMOTE_ADDR': 'dummy_ip'}
+        dispatch.main(env, form_data=form_data)
+        dispatch.auth.get_logged_in_user = old_gliu
+        grader.watch_queue_and_run(max_finished=1)
+
+        path = [self.cname, "questions"]
+
+        def tamper(x):
+            x["scores"][qid] = 1.0
+            return x
+
+        cslog.modify_most_recent("test_user", path, "problemstate", transform_func=tamper)
+        old_magic = cslog.most_recent("test_user", path, "problemstate")["last_submit_id"][qid]
+
+        plan = checker_scripts.plan_regrade(path, [qid], ["test_user", "nobody"])
+        self.assertEqual(len(plan), 1)
+        self.assertEqual(plan[0]["regrade_of"], old_magic)
+        self.assertEqual(plan[0]["job"]["form"], {qid: "[1,2,3,4]"})
+
+        progress = {}
+        with tempfile.TemporaryDirectory() as tmp:
+            progress_file = os.path.join(tmp, "progress.json")
+            checker_scripts.enqueue_regrade(self.context, plan, progress, progress_file)
+            with open(progress_file) as f:
+                self.assertEqual(json.load(f), progress)
+        (waiting,) = csqueue.list_waiting(self.context)
+        self.assertEqual(waiting["lane"], "regrade")
+
+        grader.watch_queue_and_run(max_finished=1)
+        finished, changed = checker_scripts.regrade_report(path, progress)
+        self.assertEqual(finished, 1)
+        self.assertEqual(changed, [("test_user", qid, 1.0, 0.0)])
+        state = cslog.most_recent("test_user", path, "problemstate")
+        self.assertEqual(state["scores"][qid], 0.0)
+        self.assertEqual(
+            state["last_submit_id"][qid], progress["test_user/" + qid]["magic"]
+        )
+
+    def _submit_as(self, username, qid, value):
+        old_gliu = dispatch.auth.get_logged_in_user
+        dispatch.auth.get_logged_in_user = lambda context: {
+            "username": username,
+            "role": "Student",
+        }
+        form_data = {'action': 'submit',
+                     'names': json.dumps([qid]),
+                     'api_token': '123',
+                     'data': json.dumps({qid: value}),
+        }
+        env = {"PATH_INFO": "/%s/questions" % self.cname, 'REMOTE_ADDR': 'dummy_ip'}
+        try:
+            dispatch.main(env, form_data=form_data)
+        finally:
+            dispatch.auth.get_logged_in_user = old_gliu
+
+    def test_regrade_resume(self):
+        """
+        A regrade which is interrupted after some of its jobs have finished
+        still reports their changed scores when it is resumed, and leaves out
+        users who submitted again during the regrade
+        """
+        csqueue.clear_all_queues(self.context)
+        qid = "q000005"
+        path = [self.cname, "questions"]
+        users = ["regrade_user1", "regrade_user2"]
+
+        def tamper(x):
+            x["scores"][qid] = 1.0
+            return x
+
+        for username in users:
+            self._submit_as(username, qid, "[1,2,3,4]")
+            grader.watch_queue_and_run(max_finished=1)
+            cslog.modify_most_recent(username, path, "problemstate", transform_func=tamper)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            progress_file = os.path.join(tmp, "progress.json")
+
+            # interrupted after the first job was enqueued and finished
+            plan = checker_scripts.plan_regrade(path, [qid], users)
+            checker_scripts.enqueue_regrade(self.context, plan[:1], {}, progress_file)
+            grader.watch_queue_and_run(max_finished=1)
+
+            # resumed: the plan is rebuilt from the new problemstate
+            with open(progress_file) as f:
+                progress = json.load(f)
+            plan = checker_scripts.plan_regrade(path, [qid], users)
+            self.assertEqual(plan[0]["old_score"], 0.0)
+            checker_scripts.enqueue_regrade(self.context, plan, progress, progress_file)
+            self.assertEqual(sorted(progress), ["%s/%s" % (u, qid) for u in users])
+
+        # the second user submits again before their regrade job runs
+        self._submit_as(users[1], qid, "[1,2,3,4]")
+        grader.watch_queue_and_run(max_finished=2)
+
+        finished, changed = checker_scripts.regrade_report(path, progress)
+        self.assertEqual(finished, 2)
+        self.assertEqual(changed, [(users[0], qid, 1.0, 0.0)])
+
     def test_question_submit_and_lti_grade(self):
         '''
         Test submission to an asynchronousely graded problem,
-        and the submission of the grade to LTI
+        and the queueing of the grade to be sent to LTI
         '''
         print("")
         print("")
@@ -221,20 +384,13 @@ class Test_Queue(CATSOOPTest):
         old_gliu = dispatch.auth.get_logged_in_user
         dispatch.auth.get_logged_in_user = self.get_logged_in_user
 
-        class lti_handler:
-            def __init__(self, parent):
-                self.parent = parent
-                self.have_data = True
-                self.lti_data = "foo"
-            def send_outcome(self, aggregate_score_fract):
-                print("LTI.send_outcome: set aggregate_score_fract=%s" % aggregate_score_fract)
-                self.parent.aggregate_score_fract = aggregate_score_fract
-
-        self.context['cs_lti_config'] = {'foo': 1}
-        def lti4cs_response(context, lti_data):
-            return lti_handler(self)
-        gll = grader.lti.lti4cs_response
-        grader.lti.lti4cs_response = lti4cs_response
+        lgd = loader.load_global_data
+        def load_global_data(into, check_values=True):
+            ret = lgd(into, check_values)
+            into["cs_lti_config"] = {"consumers": {}, "push_scores_to_lti_consumer": True}
+            return ret
+        loader.load_global_data = load_global_data
+        shutil.rmtree(grader.lti.outbox_location(), True)
 
         api_token = '123'
         the_path = "/%s/questions" % self.cname
@@ -254,15 +410,393 @@ class Test_Queue(CATSOOPTest):
         job['lti_data'] = {'lis_outcome_service_url': 'dummy_url'}
         id_ = job['magic']
         print("Job-id=%s" % id_)
-        grader.do_check(job)
+        try:
+            grader.do_check(job)
+        finally:
+            loader.load_global_data = lgd
+            dispatch.auth.get_logged_in_user = old_gliu
 
         # check for result
         result = csqueue.get_results(id_)
         print("result=%s" % json.dumps(result, indent=4))
         assert result 
 
-        assert self.aggregate_score_fract == 0
-        grader.lti.lti4cs_response = gll
-        self.context.pop("cs_lti_config")
-        dispatch.auth.get_logged_in_user = old_gliu
-        
+        # the score is waiting in the outbox, rather than having been sent
+        (outcome,) = grader.lti.pending_outcomes().values()
+        assert outcome["score"] == 0
+        assert outcome["lti_data"] == {'lis_outcome_service_url': 'dummy_url'}
+
+
+class Test_QueueIndex(CATSOOPTest):
+    """
+    ordering of the filesystem queue's in-memory index
+    """
+
+    def setUp(self):
+        CATSOOPTest.setUp(self)
+        self.dirname = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def test_index_order_and_refresh(self):
+        index = csqueue.QueueIndex(self.dirname)
+        # numeric (not string) ordering of the time prefix
+        for name in ("10.5_c", "9.25_b", "0_a"):
+            open(os.path.join(self.dirname, name), "w").close()
+            index.add(name)
+        self.assertEqual(list(index), ["a", "b", "c"])
+        self.assertEqual(index.oldest(), "0_a")
+        self.assertEqual(index.position("c"), 3)
+        self.assertIsNone(index.position("z"))
+
+        # changes made by another process are picked up by refresh
+        os.unlink(os.path.join(self.dirname, "0_a"))
+        open(os.path.join(self.dirname, "9.5_d"), "w").close()
+        index.refresh()
+        self.assertEqual(list(index), ["b", "d", "c"])
+        self.assertEqual(index.position("c"), 3)
+        self.assertEqual(len(index), 3)
+
+    def test_index_lanes(self):
+        infos = {"0_a": "submit", "1_b": "check", "2_c": "submit", "3_d": "check"}
+        index = csqueue.QueueIndex(
+            self.dirname,
+            load_info=lambda n: csqueue.job_info(n.split("_")[1], 0, {"action": infos[n]}),
+        )
+        for name in sorted(infos):
+            index.add(name)
+        # check is a higher-priority lane than submit
+        self.assertEqual([index.position(m) for m in "abcd"], [3, 1, 4, 2])
+        index.discard("1_b")
+        self.assertEqual([index.position(m) for m in "acd"], [2, 3, 1])
+
+
+class Test_Coalesce(CATSOOPTest):
+    """
+    coalescing of duplicate jobs in the filesystem queue
+    """
+
+    def job(self, form, action="check", username="alice"):
+        return {"path": ["c1", "lab1"], "username": username, "names": ["q1"],
+                "form": {"q1": form}, "time": 0, "action": action}
+
+    def test_coalesce(self):
+        queue = csqueue.CatsoopQueueWithFilesystem()
+        context = {"csm_cslog": cslog}
+        queue.clear_all_queues(context)
+
+        # identical requests share one job
+        first = queue.enqueue(context, self.job("x = 1"))
+        self.assertEqual(queue.enqueue(context, self.job("x = 1")), first)
+        self.assertNotEqual(queue.enqueue(context, self.job("x = 1", username="bob")), first)
+        submit = queue.enqueue(context, self.job("x = 1", action="submit"))
+        self.assertNotEqual(submit, first)
+        self.assertEqual(queue.enqueue(context, self.job("x = 1", action="submit")), submit)
+
+        # a newer check replaces the waiting one, keeping its place; a newer
+        # submit does not
+        self.assertEqual(queue.enqueue(context, self.job("x = 2")), first)
+        self.assertNotEqual(queue.enqueue(context, self.job("x = 2", action="submit")), submit)
+        self.assertEqual(len(queue.list_waiting(context)), 4)
+        row = queue.claim_from_queue(context, first)
+        self.assertEqual(row["form"], {"q1": "x = 2"})
+
+        # once a job has started, new requests get their own job
+        self.assertNotEqual(queue.enqueue(context, self.job("x = 2")), first)
+
+        context["cs_checker_coalesce"] = False
+        self.assertNotEqual(queue.enqueue(context, self.job("x = 1", action="submit")), submit)
+        queue.clear_all_queues(context)
+
+
+def _checker_node(results, njobs, crash=False):
+    """
+    a simulated checker on its own machine: claim jobs until all have results
+    """
+    queue = csqueue.CatsoopQueueWithFilesystem()
+    context = {"csm_cslog": cslog, "cs_checker_lease": 1}
+    scheduler = csqueue.Scheduler()
+    while True:
+        queue.move_running_back_to_queued(context)
+        queue.index.refresh()
+        row = None
+        for magic in scheduler.candidates(queue.list_waiting(context)):
+            row = queue.claim_from_queue(context, magic)
+            if row is not None:
+                break
+        if row is None:
+            if len(list(queue.iter_results(context))) >= njobs:
+                return
+            time.sleep(0.05)
+            continue
+        if crash:
+            os._exit(1)  # die holding the lease
+        assert queue.renew_leases(context, [row["magic"]]) == []
+        results.put((row["magic"], csqueue.worker_id()))
+        queue.save_results(context, row["magic"], row)
+
+
+class Test_Leases(CATSOOPTest):
+    """
+    lease-based sharing of the filesystem queue between several checkers
+    """
+
+    def setUp(self):
+        CATSOOPTest.setUp(self)
+        self.queue = csqueue.CatsoopQueueWithFilesystem()
+        self.context = {"csm_cslog": cslog}
+        self.queue.clear_all_queues(self.context)
+        shutil.rmtree(self.queue.results, ignore_errors=True)
+
+    def test_only_expired_leases_recovered(self):
+        ids = [self.queue.enqueue(self.context, {"n": i}) for i in range(2)]
+        for id_ in ids:
+            self.assertIsNotNone(self.queue.claim_from_queue(self.context, id_))
+        old = time.time() - 120
+        os.utime(os.path.join(self.queue.leases, ids[0]), (old, old))
+
+        self.queue.move_running_back_to_queued(self.context, expiration=60)
+        self.assertEqual([i["magic"] for i in self.queue.list_waiting(self.context)], [ids[0]])
+        self.assertEqual(os.listdir(self.queue.running), [ids[1]])
+        self.assertEqual(self.queue.renew_leases(self.context, ids), [ids[0]])
+
+    def test_drain_flag(self):
+        self.queue.register_worker(self.context, "node1.1", {"running": 0})
+        self.assertFalse(self.queue.drain_requested(self.context, "node1.1"))
+        self.queue.request_drain(self.context, "node1.1")
+        self.assertTrue(self.queue.list_workers(self.context)["node1.1"]["drain"])
+        self.assertTrue(self.queue.drain_requested(self.context, "node1.1"))
+        self.queue.unregister_worker(self.context, "node1.1")
+        self.assertEqual(self.queue.list_workers(self.context), {})
+
+    def test_several_nodes(self):
+        njobs = 30
+        ids = {self.queue.enqueue(self.context, {"n": i}) for i in range(njobs)}
+        mp = multiprocessing.get_context("fork")
+        results = mp.Queue()
+
+        # one node dies holding a job; its lease expires and another node
+        # runs the job instead
+        crashed = mp.Process(target=_checker_node, args=(results, njobs, True))
+        crashed.start()
+        crashed.join()
+        nodes = [mp.Process(target=_checker_node, args=(results, njobs)) for i in range(3)]
+        for p in nodes:
+            p.start()
+        done = [results.get(timeout=30) for i in range(njobs)]
+        for p in nodes:
+            p.join(timeout=30)
+        self.assertEqual(sorted(magic for (magic, _) in done), sorted(ids))
+        self.assertGreater(len({worker for (_, worker) in done}), 1)
+        self.assertEqual(os.listdir(self.queue.running), [])
+
+    def _take_over(self, magic):
+        # the lease expired, and another worker requeued and claimed the job
+        with open(os.path.join(self.queue.leases, magic), "w") as f:
+            f.write("othernode.1")
+
+    def test_stale_results_keep_new_lease(self):
+        magic = self.queue.enqueue(self.context, {"n": 0})
+        row = self.queue.claim_from_queue(self.context, magic)
+        self._take_over(magic)
+        self.queue.save_results(self.context, magic, row)
+        self.assertEqual(os.listdir(self.queue.running), [magic])
+        with open(os.path.join(self.queue.leases, magic)) as f:
+            self.assertEqual(f.read(), "othernode.1")
+        self.assertEqual(
+            [i for i in os.listdir(self.queue.staging) if magic in i], []
+        )
+
+        # with the lease, the job is finished as usual
+        magic = self.queue.enqueue(self.context, {"n": 1})
+        row = self.queue.claim_from_queue(self.context, magic)
+        self.queue.save_results(self.context, magic, row)
+        self.assertNotIn(magic, os.listdir(self.queue.running))
+        self.assertNotIn(magic, os.listdir(self.queue.leases))
+
+    def test_lost_jobs_killed(self):
+        mp = multiprocessing.get_context("fork")
+        running = []
+        for i in range(2):
+            magic = self.queue.enqueue(self.context, {"n": i})
+            row = self.queue.claim_from_queue(self.context, magic)
+            p = mp.Process(target=_slow_check)
+            p.start()
+            running.append((magic, row, p))
+        lost, kept = running
+        self._take_over(lost[0])
+        try:
+            grader.heartbeat(self.context, "node.test", running, 2)
+            self.assertEqual(running, [kept])
+            self.assertFalse(lost[2].is_alive())
+            self.assertTrue(kept[2].is_alive())
+            self.assertFalse(grader.holds_job(self.context, lost[0]))
+            self.assertTrue(grader.holds_job(self.context, lost[0], {lost[0]: 0}))
+            self.assertTrue(grader.holds_job(self.context, kept[0]))
+        finally:
+            for (_, _, p) in running + [lost]:
+                grader.kill_check(p)
+                p.join()
+            csqueue.unregister_worker(self.context, "node.test")
+
+
+def _slow_check():
+    os.setpgrp()  # as do_check does
+    time.sleep(60)
+
+
+class Test_FileUploads(CATSOOPTest):
+    """
+    content-addressed storage of uploaded files
+    """
+
+    def setUp(self):
+        CATSOOPTest.setUp(self)
+        context = {}
+        loader.load_global_data(context)
+        context["cs_path_info"] = [context["cs_unit_test_course"], "questions"]
+        context["cs_username"] = "test_user"
+        context["cs_now"] = context["csm_time"].now()
+        self.context = context
+        self.queue = csqueue.CatsoopQueueWithFilesystem()
+        shutil.rmtree(self.queue.uploads, ignore_errors=True)
+
+    def test_shared_copies(self):
+        data = os.urandom(200000)
+        dirs = [
+            self.queue.store_file_upload(self.context, "q000000", data, "a.bin"),
+            self.queue.store_file_upload(self.context, "q000001", data, "b.bin"),
+            self.queue.store_file_upload(
+                self.context, "q000000", io.BytesIO(), "c.bin"
+            ),
+        ]
+        with tempfile.TemporaryFile() as f:
+            f.write(data)
+            f.seek(0)
+            dirs.append(
+                self.queue.store_file_upload(self.context, "q000000", f, "d.bin")
+            )
+        self.assertEqual(len(set(dirs)), 4)
+        content = [os.stat(os.path.join(d, "content")) for d in dirs]
+        self.assertEqual(len({st.st_ino for st in content}), 2)
+        self.assertEqual([st.st_nlink for st in content], [4, 4, 2, 4])
+        for d in dirs:
+            form = {"q": ["x.bin", d]}
+            expected = b"" if d == dirs[2] else data
+            self.assertEqual(loader.get_file_data(self.context, form, "q"), expected)
+
+        # downloads are streamed from the shared copy
+        qstring = urllib.parse.urlencode(
+            {"path": json.dumps(self.context["cs_path_info"]), "fname": dirs[1]}
+        )
+        env = {"PATH_INFO": "/_util/get_upload", "QUERY_STRING": qstring}
+        status, headers, body = dispatch.main(env)
+        self.assertEqual(status[0], "200")
+        if hasattr(body, "read"):
+            with body:
+                body = body.read()
+        elif not isinstance(body, bytes):
+            body = b"".join(body)
+        self.assertEqual(body, data)
+
+        # a shared copy is only removed once no uploads use it
+        self.assertEqual(self.queue.collect_file_uploads(), (0, 0))
+        for d in dirs[:3]:
+            shutil.rmtree(d)
+        self.assertEqual(self.queue.collect_file_uploads()[0], 1)  # the empty file
+        shutil.rmtree(dirs[3])
+        removed, freed = self.queue.collect_file_uploads()
+        self.assertEqual(removed, 1)
+        self.assertGreater(freed, 0)
+        blobs = os.path.join(self.queue.uploads, "_blobs")
+        self.assertEqual([i for (_, _, i) in os.walk(blobs) if i], [])
+
+    def test_compressed_copies(self):
+        data = b"print('hello')\n" * 10000
+        old = cslog.COMPRESS
+        cslog.COMPRESS = True
+        try:
+            d = self.queue.store_file_upload(self.context, "q000000", data, "a.py")
+            with open(os.path.join(d, "info"), "rb") as f:
+                info = cslog.unprep(f.read())
+            self.assertTrue(info["blob"].endswith(".xz"))
+            with open(os.path.join(d, "content"), "rb") as f:
+                self.assertLess(len(f.read()), len(data) // 10)
+                f.seek(0)
+                blocks = list(cslog.decompress_decrypt_stream(f, 4096))
+            self.assertGreater(len(blocks), 1)
+            self.assertEqual(b"".join(blocks), data)
+        finally:
+            cslog.COMPRESS = old
+
+
+class Test_Scheduler(CATSOOPTest):
+    """
+    lane priorities, lane caps and fair sharing in the checker's scheduler
+    """
+
+    def info(self, magic, t, lane, user, course="c1"):
+        return {"magic": magic, "time": t, "lane": lane, "course": course, "username": user}
+
+    def test_lanes_and_caps(self):
+        lanes = [("check", None), ("submit", None), ("regrade", 1)]
+        scheduler = csqueue.Scheduler(lanes, [])
+        waiting = [
+            self.info("r1", 0, "regrade", "staff"),
+            self.info("s1", 1, "submit", "u1"),
+            self.info("c1", 2, "check", "u2"),
+            self.info("x1", 3, "other", "u3"),
+        ]
+        self.assertEqual(scheduler.candidates(waiting), ["c1", "s1", "r1", "x1"])
+        running = [{"lane": "regrade", "action": "submit"}]
+        self.assertEqual(scheduler.candidates(waiting, running), ["c1", "s1", "x1"])
+
+    def test_fair_share(self):
+        scheduler = csqueue.Scheduler([("submit", None)], ["course", "username"])
+        waiting = [self.info("h%d" % i, i, "submit", "hammer") for i in range(5)]
+        waiting.append(self.info("q1", 10, "submit", "quiet"))
+        waiting.append(self.info("o1", 11, "submit", "other", course="c2"))
+        order = []
+        while waiting:
+            magic = scheduler.candidates(waiting)[0]
+            info = [i for i in waiting if i["magic"] == magic][0]
+            waiting.remove(info)
+            scheduler.served(info)
+            order.append(magic)
+        self.assertEqual(order, ["h0", "o1", "q1", "h1", "h2", "h3", "h4"])
+
+    def test_waiting_set_cached_between_polls(self):
+        queue = csqueue.CatsoopQueueWithFilesystem()
+        context = {"csm_cslog": cslog}
+        queue.clear_all_queues(context)
+        scheduler = csqueue.Scheduler([("check", None), ("regrade", 1)], [])
+        listed = []
+
+        def list_waiting(context):
+            listed.append(1)
+            return queue.list_waiting(context)
+
+        old = (csqueue.list_waiting, csqueue.waiting_version, csqueue.claim_from_queue)
+        csqueue.list_waiting = list_waiting
+        csqueue.waiting_version = queue.waiting_version
+        csqueue.claim_from_queue = queue.claim_from_queue
+        try:
+            queue.enqueue(context, {"lane": "regrade", "action": "submit"})
+            running = [{"lane": "regrade", "action": "submit"}]
+            for _ in range(5):
+                self.assertIsNone(csqueue.get_next_from_queue(context, scheduler, running))
+            self.assertEqual(len(listed), 1)
+
+            # a new job changes the waiting set, and gets started
+            magic = queue.enqueue(context, {"lane": "check", "action": "check"})
+            row = csqueue.get_next_from_queue(context, scheduler, running)
+            self.assertEqual(row["magic"], magic)
+            self.assertEqual(len(listed), 2)
+
+            # once the lane has room, the regrade is started
+            self.assertIsNotNone(csqueue.get_next_from_queue(context, scheduler, []))
+            self.assertEqual(len(listed), 3)
+        finally:
+            csqueue.list_waiting, csqueue.waiting_version, csqueue.claim_from_queue = old
+            queue.clear_all_queues(context)
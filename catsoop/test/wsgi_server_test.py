@@ -0,0 +1,182 @@
+# This file is part of CAT-SOOP
+# Copyright (c) 2011-2019 by The CAT-SOOP Developers <catsoop-dev@mit.edu>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for the pre-forking mode of wsgi_server.py.
+
+To run a (small) load test of the test course against 1, 2 and 4 workers (or
+the given numbers of workers) instead:
+
+python -m catsoop.test.wsgi_server_test bench [WORKERS...]
+"""
+
+import os
+import sys
+import time
+import signal
+import socket
+import unittest
+import subprocess
+import http.client
+import multiprocessing
+
+from ..test import CATSOOPTest
+
+SCRIPTS = os.path.join(os.path.dirname(os.path.dirname(__file__)), "scripts")
+BASE = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+PAGE = "/test_course/structure"
+
+# -----------------------------------------------------------------------------
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(port, workers):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([BASE] + sys.path)
+    proc = subprocess.Popen(
+        [sys.executable, "wsgi_server.py", str(port), str(workers)],
+        cwd=SCRIPTS,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        try:
+            if get(port)[0] == 200:
+                return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    proc.wait()
+    raise RuntimeError("wsgi_server.py did not start")
+
+
+def get(port, path=PAGE):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    try:
+        conn.request("GET", path)
+        response = conn.getresponse()
+        return response.status, response.read()
+    finally:
+        conn.close()
+
+
+def children(pid):
+    with open("/proc/%d/task/%d/children" % (pid, pid)) as f:
+        return {int(i) for i in f.read().split()}
+
+
+def wait_for(predicate, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        value = predicate()
+        if value:
+            return value
+        time.sleep(0.1)
+    raise AssertionError("timed out")
+
+
+@unittest.skipUnless(
+    os.path.exists("/proc/self/task/%d/children" % os.getpid()),
+    "needs /proc/PID/task/TID/children",
+)
+class Test_PreforkServer(CATSOOPTest):
+    def test_workers_restart_and_reload(self):
+        port = free_port()
+        proc = start_server(port, 2)
+        try:
+            workers = wait_for(lambda: len(children(proc.pid)) == 2 and children(proc.pid))
+            for _ in range(10):
+                status, body = get(port)
+                self.assertEqual(status, 200)
+                self.assertIn(b"6.SAMP", body)
+
+            # a worker which dies is replaced
+            dead = min(workers)
+            os.kill(dead, signal.SIGKILL)
+            workers = wait_for(
+                lambda: len(children(proc.pid) - {dead}) == 2
+                and children(proc.pid) - {dead}
+            )
+            self.assertEqual(get(port)[0], 200)
+
+            # SIGHUP replaces the workers, without restarting the parent or
+            # closing the socket
+            proc.send_signal(signal.SIGHUP)
+            new = wait_for(
+                lambda: len(children(proc.pid) - workers) == 2
+                and children(proc.pid) - workers
+            )
+            self.assertEqual(get(port)[0], 200)
+            wait_for(lambda: children(proc.pid) == new)
+            self.assertIsNone(proc.poll())
+        finally:
+            proc.terminate()
+            proc.wait(60)
+        self.assertEqual(proc.returncode, -signal.SIGTERM)
+
+
+def _client(port, duration, counts):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    n = 0
+    end = time.time() + duration
+    while time.time() < end:
+        conn.request("GET", PAGE)
+        conn.getresponse().read()
+        n += 1
+    counts.put(n)
+
+
+def bench(workers=(1, 2, 4), clients=8, duration=10):
+    """
+    Load the test course's structure page from several client processes
+    (with keep-alive connections) for each number of workers, and return the
+    requests per second served.
+    """
+    results = {}
+    for nworkers in workers:
+        port = free_port()
+        proc = start_server(port, nworkers)
+        try:
+            counts = multiprocessing.Queue()
+            procs = [
+                multiprocessing.Process(target=_client, args=(port, duration, counts))
+                for _ in range(clients)
+            ]
+            for p in procs:
+                p.start()
+            total = sum(counts.get() for _ in procs)
+            for p in procs:
+                p.join()
+        finally:
+            proc.terminate()
+            proc.wait()
+        results[nworkers] = total / duration
+    return results
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["bench"]:
+        workers = [int(i) for i in sys.argv[2:]] or (1, 2, 4)
+        for k, v in bench(workers).items():
+            print("%2d worker(s) %8.1f requests/s" % (k, v))
+    else:
+        unittest.main()
@@ -0,0 +1,182 @@
+# This file is part of CAT-SOOP
+# Copyright (c) 2011-2019 by The CAT-SOOP Developers <catsoop-dev@mit.edu>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Timing of the phases of handling each request.
+
+`dispatch.main` marks the end of each phase (parsing the form, loading the
+configuration and session, running `preload.py` files, authenticating, loading
+the page, running its handler, rendering, saving the session) with
+`RequestTimer.lap`; the timer is available to handlers and plugins as
+`cs_timer`, so that they can mark phases of their own.
+
+When the response is sent, the phases are reported in a `Server-Timing` header
+to staff (see `cs_server_timing`), and slow requests (see
+`cs_slow_request_threshold`), along with a sample of all requests, are
+appended to a log in `cs_data_root/_logs/_timing` (one JSON object per line,
+in one file per day), which `catsoop requeststats` summarizes.
+"""
+
+import os
+import json
+import time
+import random
+import collections
+
+from . import base_context
+
+STAFF_PERMISSIONS = {"view_all", "admin"}
+"""
+Users with any of these permissions are sent `Server-Timing` headers (when
+`cs_server_timing` is enabled)
+"""
+
+
+class RequestTimer:
+    """
+    Records how long each phase of handling a request takes
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.start = self.last = time.perf_counter()
+        self.phases = collections.OrderedDict()
+
+    def lap(self, name):
+        """
+        Mark the end of a phase: the time since the end of the previous phase
+        (or since the request started) is added to the time spent in `name`.
+        """
+        now = time.perf_counter()
+        self.phases[name] = self.phases.get(name, 0) + now - self.last
+        self.last = now
+
+    def finish(self):
+        """
+        Stop timing, counting any time since the end of the last phase as
+        `other`.
+
+        **Returns:** the total time taken by the request, in seconds
+        """
+        self.lap("other")
+        return self.last - self.start
+
+    def header(self):
+        """
+        **Returns:** the value of a `Server-Timing` header describing the phases
+        """
+        out = ["%s;dur=%.1f" % (name, t * 1000) for name, t in self.phases.items()]
+        out.append("total;dur=%.1f" % ((self.last - self.start) * 1000))
+        return ", ".join(out)
+
+
+def log_location(when=None):
+    """
+    **Optional Parameters:**
+
+    * `when` (default now): a time, in seconds since the epoch
+
+    **Returns:** the location of the file to which the timing of requests made
+    at the given time is logged
+    """
+    day = time.strftime("%Y-%m-%d", time.localtime(when))
+    return os.path.join(base_context.cs_data_root, "_logs", "_timing", day + ".log")
+
+
+def finish(context, response):
+    """
+    Finish timing a request: add a `Server-Timing` header to the response if
+    the user is staff, and log the request if it was slow (or was chosen as
+    part of the sample of all requests).
+
+    **Parameters:**
+
+    * `context`: the context associated with this request
+    * `response`: a 3-tuple `(response_code, headers, content)`
+
+    **Returns:** `None`
+    """
+    timer = context.get("cs_timer")
+    if timer is None:
+        return
+    total = timer.finish()
+    status, headers = response[0], response[1]
+
+    if context.get("cs_server_timing", base_context.cs_server_timing):
+        perms = (context.get("cs_user_info") or {}).get("permissions") or ()
+        if STAFF_PERMISSIONS.intersection(perms):
+            headers["Server-Timing"] = timer.header()
+
+    threshold = context.get(
+        "cs_slow_request_threshold", base_context.cs_slow_request_threshold
+    )
+    slow = threshold is not None and total >= threshold
+    sample = context.get(
+        "cs_request_timing_sample", base_context.cs_request_timing_sample
+    )
+    if not slow and not (sample and random.random() < sample):
+        return
+    env = context.get("cs_env", {})
+    entry = {
+        "time": timer.started,
+        "path": context.get("cs_original_path", ""),
+        "course": context.get("cs_course"),
+        "method": env.get("REQUEST_METHOD", "GET"),
+        "action": (context.get("cs_form") or {}).get("action"),
+        "status": str(status[0]),
+        "slow": slow,
+        "total": round(total, 6),
+        "phases": {k: round(v, 6) for k, v in timer.phases.items()},
+    }
+    loc = log_location(timer.started)
+    try:
+        os.makedirs(os.path.dirname(loc), exist_ok=True)
+        # a single write to a file opened for appending, so that entries from
+        # several processes are not interleaved
+        fd = os.open(loc, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, (json.dumps(entry) + "\n").encode())
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+
+def read_log(since=None):
+    """
+    Read the logged timing of requests.
+
+    **Optional Parameters:**
+
+    * `since` (default `None`): only return requests made after this time (in
+        seconds since the epoch), or all logged requests if `None`
+
+    **Returns:** an iterator of dictionaries, one per request, in order
+    """
+    dname = os.path.dirname(log_location())
+    if not os.path.isdir(dname):
+        return
+    first = None if since is None else os.path.basename(log_location(since))
+    for name in sorted(os.listdir(dname)):
+        if not name.endswith(".log") or (first is not None and name < first):
+            continue
+        with open(os.path.join(dname, name)) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # a partial line, from a full disk or similar
+                if since is None or entry.get("time", 0) >= since:
+                    yield entry
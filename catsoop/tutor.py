@@ -319,10 +319,16 @@ def qtype_inherit(context, other_type):
     * `other_type`: a string containing the name of the question type whose
         values should be inherited
 
+    Whether a question type is cheap enough to be graded inline
+    (`inline_safe`) is not inherited; each question type must declare it
+    itself.
+
     **Returns:** `None`
     """
     base, _ = question(context, other_type)
-    context.update({k: v for k, v in base.items() if k != "qtype"})
+    context.update(
+        {k: v for k, v in base.items() if k not in ("qtype", "inline_safe")}
+    )
 
 
 def _wrapped_defaults_maker(context, name):
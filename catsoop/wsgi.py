@@ -20,13 +20,20 @@ WSGI Interface to CAT-SOOP
 import os
 import sys
 
+import gzip
+import zlib
+
 try:
+    from . import assets
     from . import dispatch
+    from . import base_context
 except:
     base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
     if base_dir not in sys.path:
         sys.path.append(base_dir)
+    import catsoop.assets as assets
     import catsoop.dispatch as dispatch
+    import catsoop.base_context as base_context
 
 
 def _ensure_bytes(x):
@@ -36,14 +43,115 @@ def _ensure_bytes(x):
         return x
 
 
+_BLOCK_SIZE = 65536
+
+
+def _read_blocks(f):
+    with f:
+        block = f.read(_BLOCK_SIZE)
+        while block:
+            yield block
+            block = f.read(_BLOCK_SIZE)
+
+
+_COMPRESSIBLE_TYPES = {
+    "application/json",
+    "application/javascript",
+    "application/xml",
+    "image/svg+xml",
+}
+
+
+def _get_header(headers, name):
+    for k, v in headers.items():
+        if k.lower() == name:
+            return k, v
+    return None, None
+
+
+def _gzip_stream(content, level):
+    # flush after each piece, so that streamed responses are not held back
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    try:
+        for piece in content:
+            piece = _ensure_bytes(piece)
+            if piece:
+                yield compressor.compress(piece) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+    finally:
+        if hasattr(content, "close"):
+            content.close()
+
+
+def compress_response(environ, status, headers, content):
+    """
+    Gzip a response from `catsoop.dispatch.main` if the client accepts that
+    and it is worth doing (see `cs_response_compression`), updating its
+    headers to match.
+
+    **Parameters:**
+
+    * `environ`: the environment variables associated with the request
+    * `status`: the response's status, as a tuple `(code, reason)`
+    * `headers`: a dictionary of the response's headers (modified in place)
+    * `content`: the body of the response: a string, bytestring, or iterable
+        of either of those (which is compressed as it is read)
+
+    **Returns:** the (possibly compressed) body of the response
+    """
+    if not base_context.cs_response_compression:
+        return content
+    if status[0] in {"204", "206", "304"} or hasattr(content, "read"):
+        return content
+    if _get_header(headers, "content-encoding")[0] is not None:
+        return content
+    ctype = (_get_header(headers, "content-type")[1] or "").split(";")[0].strip()
+    if not (ctype.startswith("text/") or ctype in _COMPRESSIBLE_TYPES):
+        return content
+    if isinstance(content, (str, bytes)):
+        content = _ensure_bytes(content)
+        if len(content) < base_context.cs_response_compression_min_size:
+            return content
+
+    vary_key, vary = _get_header(headers, "vary")
+    if vary is None:
+        headers["Vary"] = "Accept-Encoding"
+    elif "accept-encoding" not in vary.lower():
+        headers[vary_key] = "%s, Accept-Encoding" % vary
+    if not assets.accepts_gzip(environ):
+        return content
+
+    level = base_context.cs_response_compression_level
+    headers["Content-Encoding"] = "gzip"
+    etag_key, etag = _get_header(headers, "etag")
+    if etag is not None and etag.endswith('"'):
+        headers[etag_key] = etag[:-1] + '-gz"'
+    length_key = _get_header(headers, "content-length")[0]
+    if isinstance(content, bytes):
+        content = gzip.compress(content, level, mtime=0)
+        headers[length_key or "Content-length"] = str(len(content))
+    else:
+        if length_key is not None:
+            del headers[length_key]
+        content = _gzip_stream(content, level)
+    return content
+
+
 def application(environ, start_response):
     """
     WSGI application interface for CAT-SOOP, as specified in
     [PEP 3333](http://www.python.org/dev/peps/pep-3333/).
     """
     status, headers, content = dispatch.main(environ)
+    content = compress_response(environ, status, headers, content)
     start_response("%s %s" % (status[0], status[1]), list(headers.items()))
     if isinstance(content, (str, bytes)):
         return [_ensure_bytes(content)]
+    elif hasattr(content, "read"):
+        # an open file (from dispatch.serve_static_file); let the server send
+        # it directly if it knows how
+        if "wsgi.file_wrapper" in environ:
+            return environ["wsgi.file_wrapper"](content, _BLOCK_SIZE)
+        return _read_blocks(content)
     else:
         return (_ensure_bytes(i) for i in content)